@@ -9,9 +9,19 @@
 #                        [--collection COLLECTION_NAME]
 #                        --src-path COLLECTION_SRC_PATH
 #                        --dest-path COLLECTION_DEST_PATH
-#                        --role ROLE_NAME
+#                        --role ROLE_NAME [--role ROLE_NAME ...]
+#                        [--roles-from collection_release.yml]
+#                        [--role-jobs N]
+#                        [--phase-jobs N]
 #                        [--subrole-prefix STR]
 #                        [--replace-dot STR]
+#                        [--jobs N]
+#                        [--copy-mode copy|hardlink]
+#                        [--pipeline]
+#                        [--dry-run [diff|files]]
+#                        [--watch]
+#                        [--profile FILE [--profile-top N]]
+#                        [--cache-dir DIR]
 #                        [-h]
 # Or
 #
@@ -24,20 +34,54 @@
 #   Converted collections are placed in COLLECTION_DEST_PATH/ansible_collections/COLLECTION_NAMESPACE/COLLECTION_NAME
 
 import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import difflib
 import errno
 import fnmatch
+import functools
+import hashlib
+import io
+import json
 import logging
 import os
 import re
+import select
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
 import textwrap
-
+import threading
+import time
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from pathlib import Path
 from ruamel.yaml import YAML
-from shutil import copytree, copy2, copyfile, ignore_patterns, rmtree, which
+from shutil import (
+    copy2,
+    copyfile,
+    copyfileobj,
+    copymode,
+    copystat,
+    ignore_patterns,
+    rmtree,
+    which,
+)
 from operator import itemgetter
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 ALL_ROLE_DIRS = [
     "action_plugins",
     "defaults",
@@ -116,6 +160,55 @@ def get_item_type(item):
         raise LSRException(f"Error: unknown type of item: {item}")
 
 
+# the round-trip YAML engines of each thread, see get_yaml_engine
+yaml_engines = threading.local()
+
+
+def new_yaml_engine(explicit_start=False):
+    """Return a round-trip YAML configured to write the files the way the
+    converted files are written"""
+    yml = YAML(typ="rt")
+    yml.default_flow_style = False
+    yml.preserve_quotes = True
+    yml.width = 1024
+    if explicit_start:
+        yml.explicit_start = True
+    yml.indent(mapping=2, sequence=4, offset=2)
+    return yml
+
+
+def get_yaml_engine(explicit_start=False):
+    """Return the round-trip YAML of the current thread, created by
+    new_yaml_engine the first time.
+
+    Creating and configuring a YAML for each file is a noticeable part of
+    converting many small files, so one is reused for all of the files of all
+    of the roles.  A YAML cannot be used by two threads at once, so each
+    thread, and each worker process, has its own."""
+    engines = yaml_engines.__dict__
+    yml = engines.get(explicit_start)
+    if yml is None:
+        yml = engines[explicit_start] = new_yaml_engine(explicit_start)
+    return yml
+
+
+def yaml_load(yml, stream):
+    """Load the document in stream with the reused YAML yml.  Returns the data
+    and the %TAG directives of the document, to pass to yaml_dump."""
+    # each load records the document info, which is not needed afterwards
+    if getattr(yml, "doc_infos", None):
+        del yml.doc_infos[:]
+    data = yml.load(stream)
+    return data, getattr(yml, "tags", None)
+
+
+def yaml_dump(yml, data, tags, stream, **kwargs):
+    """Dump data loaded by yaml_load with the %TAG directives tags"""
+    if tags is not None:
+        yml.tags = tags
+    yml.dump(data, stream, **kwargs)
+
+
 class LSRFileTransformerBase(object):
     # we used to try to not deindent comment lines in the Ansible yaml,
     # but this changed the indentation when comments were used in
@@ -126,7 +219,9 @@ class LSRFileTransformerBase(object):
     HEADER_RE = re.compile(r"^(---\n|.*\n---\n)", flags=re.DOTALL)
     FOOTER_RE = re.compile(r"\n([.][.][.]|[.][.][.]\n.*)$", flags=re.DOTALL)
 
-    def __init__(self, filepath, rolename, newrolename, args):
+    def __init__(self, filepath, rolename, newrolename, args, data=None):
+        """data is the contents of filepath - if not given, it is read from
+        filepath"""
         self.filepath = filepath
         self.namespace = args["namespace"]
         self.collection = args["collection"]
@@ -143,8 +238,10 @@ class LSRFileTransformerBase(object):
         self.extra_mapping_src_role = args["extra_mapping_src_role"]
         self.extra_mapping_dest_prefix = args["extra_mapping_dest_prefix"]
         self.extra_mapping_dest_role = args["extra_mapping_dest_role"]
-        buf = open(filepath, encoding="utf-8").read()
-        self.ruamel_yaml = YAML(typ="rt")
+        if data is None:
+            buf = open(filepath, encoding="utf-8").read()
+        else:
+            buf = data
         match = re.search(LSRFileTransformerBase.HEADER_RE, buf)
         if match:
             self.header = match.group(1)
@@ -155,14 +252,20 @@ class LSRFileTransformerBase(object):
             self.footer = match.group(1) + "\n"
         else:
             self.footer = ""
-        self.ruamel_yaml.default_flow_style = False
-        self.ruamel_yaml.preserve_quotes = True
-        self.ruamel_yaml.width = 1024
-        self.ruamel_data = self.ruamel_yaml.load(buf)
-        self.ruamel_yaml.indent(mapping=2, sequence=4, offset=2)
+        self.ruamel_data, self.ruamel_tags = yaml_load(get_yaml_engine(), buf)
         self.file_type = get_file_type(self.ruamel_data)
         self.outputfile = None
         self.outputstream = sys.stdout
+        # set by the callbacks when they modify ruamel_data
+        self.changed = False
+
+    @classmethod
+    def get_prefilter(cls, role_name, args):
+        """Return an object with a may_change(data) method which tells whether
+        transforming a file with contents data could change it, or None if
+        every file has to be transformed.  Subclasses can override this to
+        skip parsing files which cannot contain anything to transform."""
+        return None
 
     def run(self):
         if self.file_type == "vars":
@@ -173,7 +276,7 @@ class LSRFileTransformerBase(object):
             for item in self.ruamel_data:
                 self.handle_item(item)
 
-    def write(self):
+    def dump(self, outstrm):
         def xform(thing):
             logging.debug(f"xform thing {thing}")
             if self.file_type == "tasks":
@@ -184,11 +287,30 @@ class LSRFileTransformerBase(object):
             thing = thing + self.footer
             return thing
 
+        yaml_dump(
+            get_yaml_engine(),
+            self.ruamel_data,
+            self.ruamel_tags,
+            outstrm,
+            transform=xform,
+        )
+
+    def dumps(self):
+        """Return the transformed file contents as a string"""
+        outstrm = io.StringIO()
+        self.dump(outstrm)
+        return outstrm.getvalue()
+
+    def write(self):
+        if self.outputfile == self.filepath and not self.changed:
+            # leave the file as it is - dumping it would only reformat it
+            logging.debug(f"No changes in {self.filepath}")
+            return
         if self.outputfile:
             outstrm = open(self.outputfile, "w", encoding="utf-8")
         else:
             outstrm = self.outputstream
-        self.ruamel_yaml.dump(self.ruamel_data, outstrm, transform=xform)
+        self.dump(outstrm)
 
     def task_cb(self, task):
         """subclass will override"""
@@ -251,6 +373,540 @@ def get_role_modules(role_path):
     return role_modules
 
 
+class LSRPrefilter(object):
+    """Cheap test on the raw bytes of a file for whether LSRFileTransformer
+    could change it.
+
+    LSRFileTransformer only changes roles/dependencies lists, include_role,
+    import_role, include_vars and roletoinclude which refer to this role, to
+    an --extra-mapping role or to role_path, and tasks which use a module
+    from the role library.  A file which does not contain one of those
+    keywords together with one of those names, or a role module name, is
+    not parsed at all."""
+
+    KEYWORDS_RE = re.compile(
+        rb"include_role|import_role|include_vars|roletoinclude|roles|dependencies"
+    )
+
+    def __init__(self, role_name, args):
+        targets = [b"role_path", ("/" + args["src_owner"] + ".").encode("utf-8")]
+        targets.extend(role.encode("utf-8") for role in args["extra_mapping_src_role"])
+        self.targets_re = re.compile(b"|".join(re.escape(tt) for tt in targets))
+        # comp_rolenames ignores the replace_dot and "." characters
+        self.ignore_chars = (args["replace_dot"] + ".").encode("utf-8")
+        self.role_core = role_name.encode("utf-8").translate(None, self.ignore_chars)
+        role_modules = sorted(args["role_modules"])
+        if role_modules:
+            self.modules_re = re.compile(
+                b"|".join(re.escape(mm.encode("utf-8")) for mm in role_modules)
+            )
+        else:
+            self.modules_re = None
+
+    def may_change(self, data):
+        """Return False if transforming the file contents data cannot change it"""
+        if self.modules_re and self.modules_re.search(data):
+            return True
+        if not self.KEYWORDS_RE.search(data):
+            return False
+        if self.targets_re.search(data):
+            return True
+        return self.role_core in data.translate(None, self.ignore_chars)
+
+
+xfrm_prefilter = {}
+
+
+def get_prefilter(role_name, args):
+    """Return the LSRPrefilter for role_name, creating it the first time"""
+    key = (
+        role_name,
+        args["src_owner"],
+        args["replace_dot"],
+        tuple(sorted(args["role_modules"])),
+        tuple(args["extra_mapping_src_role"]),
+    )
+    with xfrm_lock:
+        if key not in xfrm_prefilter:
+            xfrm_prefilter[key] = LSRPrefilter(role_name, args)
+        return xfrm_prefilter[key]
+
+
+class LSRRoleNames(object):
+    """Resolve the role names used in roles/dependencies lists, include_role
+    and import_role to their collection FQCN.
+
+    The names which the conversion is known to rewrite - the role itself as
+    SRC_OWNER.ROLE, ROLE and its replace_dot variants, and every spelling of
+    the --extra-mapping roles - are resolved when the table is built.  Any
+    other name is resolved by the same rules the first time it is seen, and
+    remembered, so that each name is resolved once per conversion."""
+
+    ROLE_PATH_RE = re.compile(r"{{ role_path }}/roles/([\w\d.]+)")
+
+    def __init__(self, role_name, new_role_name, args):
+        self.prefix = args["prefix"]
+        self.subrole_prefix = args["subrole_prefix"]
+        self.replace_dot = args["replace_dot"]
+        self.src_owner = args["src_owner"]
+        self.lsr_rolename = self.src_owner + "." + role_name
+        self.new_name = self.prefix + new_role_name
+        # role names are compared ignoring the replace_dot and "." characters
+        self.ignore_chars = str.maketrans("", "", self.replace_dot + ".")
+        self.role_core = role_name.translate(self.ignore_chars)
+        # --extra-mapping "SRC_OWNER0.SRC_ROLE0:DEST_PREFIX[.]DEST_ROLE1,
+        #                  SRC_ROLE1:DEST_PREFIX[.]DEST_ROLE1"
+        # Only the first mapping of a SRC_ROLE is used.  SRC_ROLE can be given
+        # without an owner, or with SRC_OWNER0 if given, or else SRC_OWNER.
+        self.mapped = {}
+        for src_owner, src_role, dest_prefix, dest_role in zip(
+            args["extra_mapping_src_owner"],
+            args["extra_mapping_src_role"],
+            args["extra_mapping_dest_prefix"],
+            args["extra_mapping_dest_role"],
+        ):
+            if src_role not in self.mapped:
+                self.mapped[src_role] = (
+                    src_owner or self.src_owner,
+                    (dest_prefix or self.prefix) + dest_role,
+                )
+        spellings = [
+            self.lsr_rolename,
+            role_name,
+            role_name.replace(".", self.replace_dot),
+            role_name.replace(self.replace_dot, "."),
+        ]
+        for src_role, (src_owner, _) in self.mapped.items():
+            spellings.extend([src_role, src_owner + "." + src_role])
+        self.names = {name: self.get_new_name(name) for name in spellings}
+
+    def get_new_name(self, rolename):
+        """Return the collection FQCN of rolename, or None if it is not
+        converted"""
+        if rolename == self.lsr_rolename or (
+            rolename.translate(self.ignore_chars) == self.role_core
+        ):
+            return self.new_name
+        if rolename.count(".") == 1:
+            _src_owner, _rolename_base = rolename.split(".")
+        else:
+            _src_owner = None
+            _rolename_base = rolename
+        if _rolename_base and _rolename_base in self.mapped:
+            src_owner, new_name = self.mapped[_rolename_base]
+            if not _src_owner or _src_owner == src_owner:
+                return new_name
+            return None
+        if rolename.startswith("{{ role_path }}"):
+            match = self.ROLE_PATH_RE.match(rolename)
+            if match.group(1).startswith(self.subrole_prefix):
+                return self.prefix + match.group(1).replace(".", self.replace_dot)
+            return (
+                self.prefix
+                + self.subrole_prefix
+                + match.group(1).replace(".", self.replace_dot)
+            )
+        return None
+
+    def resolve(self, rolename):
+        """Return the collection FQCN of rolename, or None if it is not
+        converted"""
+        try:
+            return self.names[rolename]
+        except KeyError:
+            new_name = self.names[rolename] = self.get_new_name(rolename)
+            return new_name
+
+
+xfrm_rolenames = {}
+
+
+def get_rolenames(role_name, new_role_name, args):
+    """Return the LSRRoleNames for role_name, creating it the first time"""
+    key = (
+        role_name,
+        new_role_name,
+        args["prefix"],
+        args["subrole_prefix"],
+        args["replace_dot"],
+        args["src_owner"],
+        tuple(args["extra_mapping_src_owner"]),
+        tuple(args["extra_mapping_src_role"]),
+        tuple(args["extra_mapping_dest_prefix"]),
+        tuple(args["extra_mapping_dest_role"]),
+    )
+    with xfrm_lock:
+        if key not in xfrm_rolenames:
+            xfrm_rolenames[key] = LSRRoleNames(role_name, new_role_name, args)
+        return xfrm_rolenames[key]
+
+
+def transform_file(file_xfrm_cls, filepath, role_name, new_role_name, transformer_args):
+    """Transform the file filepath in-place using file_xfrm_cls.
+    Returns the LSRException if the file could not be transformed, otherwise None"""
+    try:
+        lsrft = file_xfrm_cls(filepath, role_name, new_role_name, transformer_args)
+        lsrft.run()
+        lsrft.write()
+    except LSRException as lsrex:
+        return lsrex
+    return None
+
+
+def transform_data(
+    file_xfrm_cls, filepath, data, role_name, new_role_name, transformer_args
+):
+    """Transform data, the contents of the file filepath, in memory using
+    file_xfrm_cls.  Returns a tuple of the transformed contents, which are data
+    itself if nothing was changed, and the LSRException if the contents could
+    not be transformed, otherwise None"""
+    try:
+        # decode the same way as open() does, i.e. with universal newlines
+        text = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8").read()
+        lsrft = file_xfrm_cls(
+            filepath, role_name, new_role_name, transformer_args, data=text
+        )
+        lsrft.run()
+    except LSRException as lsrex:
+        return data, lsrex
+    if not lsrft.changed:
+        logging.debug(f"No changes in {filepath}")
+        return data, None
+    return lsrft.dumps().encode("utf-8"), None
+
+
+class LSRLogCollector(logging.Handler):
+    """Collect the log records emitted in a worker process so that the parent
+    can replay them in file order"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # make the record picklable - args may hold ruamel objects
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+def call_in_worker(func, *args):
+    """Process pool wrapper which calls func(*args).
+    Returns a tuple of the result of func and the collected log records"""
+    root_logger = logging.getLogger()
+    collector = LSRLogCollector()
+    saved_handlers = root_logger.handlers[:]
+    root_logger.handlers[:] = [collector]
+    try:
+        result = func(*args)
+    finally:
+        root_logger.handlers[:] = saved_handlers
+    return result, collector.records
+
+
+def transform_file_in_worker(
+    file_xfrm_cls, filepath, role_name, new_role_name, transformer_args
+):
+    """Process pool wrapper for transform_file.
+    Returns a tuple of the result of call_timed and the collected log records"""
+    return call_in_worker(
+        call_timed,
+        transform_file,
+        file_xfrm_cls,
+        filepath,
+        role_name,
+        new_role_name,
+        transformer_args,
+    )
+
+
+# guards xfrm_pool and xfrm_cache - roles may be converted in several threads
+xfrm_lock = threading.Lock()
+xfrm_pool = {}
+
+
+def get_xfrm_pool(jobs):
+    """Return the process pool with jobs workers, creating it the first time.
+    The pool is shared by all LSRTransformer instances in this process."""
+    with xfrm_lock:
+        if jobs not in xfrm_pool:
+            xfrm_pool[jobs] = ProcessPoolExecutor(max_workers=jobs)
+        return xfrm_pool[jobs]
+
+
+def start_xfrm_pool(jobs):
+    """Start the worker processes of the process pool with jobs workers, if
+    jobs is greater than 1.  The workers are forked, so they have to be
+    started before the threads which convert the roles are - a process forked
+    while another thread holds a lock, e.g. the logging one, may hang."""
+    if jobs > 1:
+        get_xfrm_pool(jobs).submit(int).result()
+
+
+converter_version = None
+
+
+def get_converter_version():
+    """Return a hash of this script - any change to the converter invalidates
+    the conversion cache"""
+    global converter_version
+    if not converter_version:
+        with open(__file__, "rb") as f:
+            converter_version = hashlib.sha256(f.read()).hexdigest()
+    return converter_version
+
+
+class LSRConversionCache(object):
+    """On-disk cache of converted file contents.
+
+    The manifest maps a key - the hash of the conversion context (converter
+    version, transformer arguments, etc.) and the source file contents - to
+    the hash of the converted contents, which are stored under objects/.
+    A file whose key is in the manifest does not have to be converted again."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.objects_dir = self.cache_dir / "objects"
+        self.manifest_path = self.cache_dir / "manifest.json"
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def context(self, *parts):
+        """Return the hash of the conversion context made of parts"""
+        data = json.dumps(
+            [get_converter_version()] + list(parts),
+            sort_keys=True,
+            default=lambda obj: sorted(obj) if isinstance(obj, set) else str(obj),
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def make_key(self, context, data):
+        """Return the manifest key for the contents data in the given context"""
+        return hashlib.sha256(context.encode("utf-8") + b"\0" + data).hexdigest()
+
+    def get(self, key):
+        """Return the cached converted contents, or None if not cached"""
+        digest = self.manifest.get(key)
+        if not digest:
+            return None
+        try:
+            return (self.objects_dir / digest[:2] / digest).read_bytes()
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        """Store the converted contents data under key"""
+        digest = hashlib.sha256(data).hexdigest()
+        obj = self.objects_dir / digest[:2] / digest
+        with self.lock:
+            if not obj.exists():
+                obj.parent.mkdir(parents=True, exist_ok=True)
+                tmp = obj.with_name(obj.name + ".tmp")
+                tmp.write_bytes(data)
+                os.replace(tmp, obj)
+            if self.manifest.get(key) != digest:
+                self.manifest[key] = digest
+                self.dirty = True
+
+    def save(self):
+        """Write the manifest if it was changed"""
+        with self.lock:
+            if not self.dirty:
+                return
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.manifest, f, sort_keys=True)
+            os.replace(tmp, self.manifest_path)
+            self.dirty = False
+
+
+xfrm_cache = {}
+
+
+def get_xfrm_cache(cache_dir):
+    """Return the conversion cache for cache_dir, or None if cache_dir is not set"""
+    if not cache_dir:
+        return None
+    cache_dir = str(cache_dir)
+    with xfrm_lock:
+        if cache_dir not in xfrm_cache:
+            xfrm_cache[cache_dir] = LSRConversionCache(cache_dir)
+        return xfrm_cache[cache_dir]
+
+
+class LSRProfiler(object):
+    """Record the wall and CPU time spent in each phase of the conversion, per
+    role, and the time spent converting each file.
+
+    The role being converted is kept per thread, so that the roles converted
+    concurrently are told apart.  The CPU time is the time of the thread, or
+    of the worker process for the files converted in a process pool.  The
+    phases must not be nested - each phase only times a step of the
+    conversion which does not contain other phases."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        # role -> {"wall": ..., "cpu": ..., "phases": {phase: times}}
+        self.roles = {}
+        self.files = []
+
+    def get_role(self):
+        return getattr(self.local, "role", None) or "collection"
+
+    def get_role_entry(self, role):
+        if role not in self.roles:
+            self.roles[role] = {"wall": 0.0, "cpu": 0.0, "phases": {}}
+        return self.roles[role]
+
+    @contextlib.contextmanager
+    def role(self, role, timed=True):
+        """Attribute the phases and files in the context to role, and the
+        time spent in it if timed"""
+        saved_role = getattr(self.local, "role", None)
+        self.local.role = role
+        if not timed:
+            try:
+                yield
+            finally:
+                self.local.role = saved_role
+            return
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            self.local.role = saved_role
+            with self.lock:
+                entry = self.get_role_entry(role)
+                entry["wall"] += wall
+                entry["cpu"] += cpu
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Record the time spent in the context as phase name"""
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            with self.lock:
+                phases = self.get_role_entry(self.get_role())["phases"]
+                if name not in phases:
+                    phases[name] = {"wall": 0.0, "cpu": 0.0, "count": 0}
+                phases[name]["wall"] += wall
+                phases[name]["cpu"] += cpu
+                phases[name]["count"] += 1
+
+    def add_file(self, kind, path, times):
+        """Record the (wall, cpu) times spent converting the file path"""
+        entry = {
+            "role": self.get_role(),
+            "kind": kind,
+            "path": str(path),
+            "wall": times[0],
+            "cpu": times[1],
+        }
+        with self.lock:
+            self.files.append(entry)
+
+    def get_report(self):
+        """Return the recorded times as a dict which can be dumped as JSON"""
+        with self.lock:
+            phases = {}
+            for entry in self.roles.values():
+                for name, times in entry["phases"].items():
+                    if name not in phases:
+                        phases[name] = {"wall": 0.0, "cpu": 0.0, "count": 0}
+                    for key in ("wall", "cpu", "count"):
+                        phases[name][key] += times[key]
+            return {
+                "wall": time.perf_counter() - self.wall,
+                "cpu": time.process_time() - self.cpu,
+                "phases": phases,
+                "roles": self.roles,
+                "files": sorted(self.files, key=lambda entry: -entry["wall"]),
+            }
+
+    def save(self, path, top=10):
+        """Write the report to path as JSON and print the summary of the
+        phases and of the top slowest files"""
+        report = self.get_report()
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Conversion took {report['wall']:.3f}s wall, {report['cpu']:.3f}s CPU")
+        print(f"{'wall':>9} {'cpu':>9} {'count':>6}  phase")
+        for name, times in sorted(
+            report["phases"].items(), key=lambda item: -item[1]["wall"]
+        ):
+            print(
+                f"{times['wall']:9.3f} {times['cpu']:9.3f} {times['count']:6d}  {name}"
+            )
+        if top and report["files"]:
+            print(f"{'wall':>9} {'cpu':>9}  slowest files")
+            for entry in report["files"][:top]:
+                print(
+                    f"{entry['wall']:9.3f} {entry['cpu']:9.3f}  "
+                    f"{entry['kind']} {entry['role']} {entry['path']}"
+                )
+        logging.info(f"Wrote the profile to {path}")
+
+
+# the LSRProfiler if --profile is given, otherwise None
+profiler = None
+NO_PROFILE = contextlib.nullcontext()
+
+
+def profile_role(role, timed=True):
+    """Return a context manager which attributes the phases and files in it,
+    and the time spent in it if timed, to role, if the conversion is
+    profiled"""
+    if profiler:
+        return profiler.role(role, timed)
+    return NO_PROFILE
+
+
+def profile_phase(name):
+    """Return a context manager which records the time spent in it as phase
+    name, if the conversion is profiled"""
+    if profiler:
+        return profiler.phase(name)
+    return NO_PROFILE
+
+
+def profile_file(kind, path, times):
+    """Record the (wall, cpu) times spent converting the file path, if the
+    conversion is profiled"""
+    if profiler:
+        profiler.add_file(kind, path, times)
+
+
+def call_timed(func, *args):
+    """Call func(*args).  Returns a tuple of the result of func and the wall
+    and CPU time of the call"""
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    result = func(*args)
+    return result, (time.perf_counter() - wall, time.thread_time() - cpu)
+
+
+# transformer_args which do not change the converted output
+NON_OUTPUT_ARGS = ("jobs", "cache_dir")
+
+
 class LSRTransformer(object):
     """Transform all of the .yml files in a role or role subdir"""
 
@@ -262,22 +918,54 @@ class LSRTransformer(object):
         role_name=None,
         new_role_name=None,
         file_xfrm_cls=LSRFileTransformerBase,
+        exclude=(),
     ):
         """Create a role transformer.  The user can specify the specific class
         to use for transforming each file, and the extra arguments to pass to the
         constructor of that class
         is_role_dir - if True, role_path is the role directory (with all of the usual role subdirs)
-                      if False, just operate on the .yml files found in role_path"""
+                      if False, just operate on the .yml files found in role_path
+        exclude - paths of .yml files not to transform, e.g. because they were
+                  already transformed when they were copied
+        If transformer_args["jobs"] is greater than 1, the files are transformed
+        in a pool of that many processes."""
         self.role_name = role_name
         self.new_role_name = new_role_name
         self.role_path = role_path
         self.is_role_dir = is_role_dir
         self.transformer_args = transformer_args
         self.file_xfrm_cls = file_xfrm_cls
+        self.exclude = exclude
+        self.jobs = transformer_args.get("jobs", 1)
         if self.is_role_dir and not self.role_name:
             self.role_name = os.path.basename(self.role_path)
+        self.prefilter = file_xfrm_cls.get_prefilter(
+            self.role_name, self.transformer_args
+        )
 
-    def run(self):
+    def may_change(self, filepath, data=None):
+        """Return False if the prefilter shows that transforming filepath,
+        with contents data, cannot change it"""
+        if not self.prefilter:
+            return True
+        if data is None:
+            with open(filepath, "rb") as f:
+                data = f.read()
+        if self.prefilter.may_change(data):
+            return True
+        logging.debug(f"Nothing to transform in {filepath}")
+        return False
+
+    @staticmethod
+    def is_yml_file(dirpath, filename):
+        """Return True if filename in dirpath is a .yml file to transform"""
+        if dirpath.endswith("/files") or dirpath.endswith("/templates"):
+            return False
+        return filename.endswith(".yml")
+
+    def get_filepaths(self):
+        """get the list of .yml files to transform, in os.walk order"""
+        filepaths = []
         for dirpath, _, filenames in os.walk(self.role_path):
             if dirpath.endswith("/files") or dirpath.endswith("/templates"):
                 continue
@@ -286,21 +974,177 @@ class LSRTransformer(object):
                 if not role_dir:
                     continue
             for filename in filenames:
-                if not filename.endswith(".yml"):
+                if not self.is_yml_file(dirpath, filename):
                     continue
                 filepath = os.path.join(dirpath, filename)
+                if filepath not in self.exclude:
+                    filepaths.append(filepath)
+        return filepaths
+
+    def get_cache_context(self, cache):
+        """Return the conversion cache context of the files transformed by
+        this transformer"""
+        return cache.context(
+            "yml",
+            self.file_xfrm_cls.__name__,
+            self.role_name,
+            self.new_role_name,
+            {
+                key: val
+                for key, val in self.transformer_args.items()
+                if key not in NON_OUTPUT_ARGS
+            },
+        )
+
+    def run(self):
+        filepaths = self.get_filepaths()
+        cache = get_xfrm_cache(self.transformer_args.get("cache_dir"))
+        if not cache:
+            self.transform_files(
+                [filepath for filepath in filepaths if self.may_change(filepath)]
+            )
+            return
+        context = self.get_cache_context(cache)
+        keys = {}
+        for filepath in filepaths:
+            with open(filepath, "rb") as f:
+                data = f.read()
+            if not self.may_change(filepath, data):
+                continue
+            key = cache.make_key(context, data)
+            cached = cache.get(key)
+            if cached is None:
+                keys[filepath] = key
+            elif cached != data:
+                logging.debug(f"Using cached transform for {filepath}")
+                with open(filepath, "wb") as f:
+                    f.write(cached)
+        todo = [filepath for filepath in filepaths if filepath in keys]
+        self.transform_files(todo)
+        for filepath in todo:
+            with open(filepath, "rb") as f:
+                cache.put(keys[filepath], f.read())
+        cache.save()
+
+    def transform_files(self, filepaths):
+        if self.jobs > 1 and len(filepaths) > 1:
+            pool = get_xfrm_pool(self.jobs)
+            futures = [
+                pool.submit(
+                    transform_file_in_worker,
+                    self.file_xfrm_cls,
+                    filepath,
+                    self.role_name,
+                    self.new_role_name,
+                    self.transformer_args,
+                )
+                for filepath in filepaths
+            ]
+            # report in file order, no matter which worker finished first
+            for filepath, future in zip(filepaths, futures):
                 logging.debug(f"filepath {filepath}")
-                try:
-                    lsrft = self.file_xfrm_cls(
-                        filepath,
-                        self.role_name,
-                        self.new_role_name,
-                        self.transformer_args,
-                    )
-                    lsrft.run()
-                    lsrft.write()
-                except LSRException as lsrex:
+                (lsrex, times), records = future.result()
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+                if lsrex:
+                    logging.debug(f"Could not transform {filepath}: {lsrex}")
+                profile_file("transform", filepath, times)
+        else:
+            for filepath in filepaths:
+                logging.debug(f"filepath {filepath}")
+                lsrex, times = call_timed(
+                    transform_file,
+                    self.file_xfrm_cls,
+                    filepath,
+                    self.role_name,
+                    self.new_role_name,
+                    self.transformer_args,
+                )
+                if lsrex:
+                    logging.debug(f"Could not transform {filepath}: {lsrex}")
+                profile_file("transform", filepath, times)
+
+    def transform_texts(self, filepaths, texts):
+        """Return the list of the transformed texts, the contents of the .yml
+        files filepaths, without reading or writing the files.  A text which
+        is not changed is returned as it is."""
+        results = list(texts)
+        todo = [
+            idx
+            for idx, (filepath, text) in enumerate(zip(filepaths, texts))
+            if self.may_change(filepath, text)
+        ]
+        cache = get_xfrm_cache(self.transformer_args.get("cache_dir"))
+        if cache:
+            context = self.get_cache_context(cache)
+            keys = {}
+            for idx in todo:
+                key = cache.make_key(context, texts[idx])
+                cached = cache.get(key)
+                if cached is None:
+                    keys[idx] = key
+                else:
+                    if cached != texts[idx]:
+                        logging.debug(f"Using cached transform for {filepaths[idx]}")
+                    results[idx] = cached
+            todo = [idx for idx in todo if idx in keys]
+        transformed = self.transform_datas(
+            [filepaths[idx] for idx in todo], [texts[idx] for idx in todo]
+        )
+        for idx, result in zip(todo, transformed):
+            results[idx] = result
+            if cache:
+                cache.put(keys[idx], result)
+        if cache:
+            cache.save()
+        return results
+
+    def transform_datas(self, filepaths, texts):
+        if self.jobs > 1 and len(filepaths) > 1:
+            pool = get_xfrm_pool(self.jobs)
+            futures = [
+                pool.submit(
+                    call_in_worker,
+                    call_timed,
+                    transform_data,
+                    self.file_xfrm_cls,
+                    filepath,
+                    text,
+                    self.role_name,
+                    self.new_role_name,
+                    self.transformer_args,
+                )
+                for filepath, text in zip(filepaths, texts)
+            ]
+            results = []
+            # report in file order, no matter which worker finished first
+            for filepath, future in zip(filepaths, futures):
+                logging.debug(f"filepath {filepath}")
+                ((result, lsrex), times), records = future.result()
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+                if lsrex:
                     logging.debug(f"Could not transform {filepath}: {lsrex}")
+                profile_file("transform", filepath, times)
+                results.append(result)
+            return results
+        results = []
+        for filepath, text in zip(filepaths, texts):
+            logging.debug(f"filepath {filepath}")
+            (result, lsrex), times = call_timed(
+                transform_data,
+                self.file_xfrm_cls,
+                filepath,
+                text,
+                self.role_name,
+                self.new_role_name,
+                self.transformer_args,
+            )
+            if lsrex:
+                logging.debug(f"Could not transform {filepath}: {lsrex}")
+            profile_file("transform", filepath, times)
+            results.append(result)
+        return results
 
 
 # ==============================================================================
@@ -406,53 +1250,20 @@ class LSRFileTransformer(LSRFileTransformerBase):
     """Do the role file transforms - fix role names, add FQCN
     to module names, etc."""
 
+    @classmethod
+    def get_prefilter(cls, role_name, args):
+        return get_prefilter(role_name, args)
+
+    def __init__(self, filepath, rolename, newrolename, args, data=None):
+        super().__init__(filepath, rolename, newrolename, args, data)
+        self.rolenames = get_rolenames(rolename, newrolename, args)
+
     def convert_rolename(self, rolename, lsr_rolename=None):
         """convert the given rolename to the new name"""
-        if rolename.count(".") == 1:
-            _src_owner, _rolename_base = rolename.split(".")
-        else:
-            _src_owner = None
-            _rolename_base = rolename
-        if not lsr_rolename:
-            lsr_rolename = self.src_owner + "." + self.rolename
         logging.debug(f"\ttask role {rolename}")
-        new_name = None
-        if rolename == lsr_rolename or self.comp_rolenames(rolename, self.rolename):
-            new_name = self.prefix + self.newrolename
-        elif _rolename_base and _rolename_base in self.extra_mapping_src_role:
-            _src_role_index = self.extra_mapping_src_role.index(_rolename_base)
-            # --extra-mapping "SRC_OWNER0.SRC_ROLE0:DEST_PREFIX[.]DEST_ROLE1,
-            #                  SRC_ROLE1:DEST_PREFIX[.]DEST_ROLE1"
-            # current _rolename_base is SRC_ROLE0 and
-            #   _src_owner is None or _src_owner is SRC_OWNER0
-            # or current _rolename_base is SRC_ROLE1
-            if (
-                not _src_owner
-                or (_src_owner == self.extra_mapping_src_owner[_src_role_index])
-                or (
-                    not self.extra_mapping_src_owner[_src_role_index]
-                    and _src_owner == self.src_owner
-                )
-            ):
-                new_name = "{0}{1}".format(
-                    (
-                        self.extra_mapping_dest_prefix[_src_role_index]
-                        if self.extra_mapping_dest_prefix[_src_role_index]
-                        else self.prefix
-                    ),
-                    self.extra_mapping_dest_role[_src_role_index],
-                )
-        elif rolename.startswith("{{ role_path }}"):
-            match = re.match(r"{{ role_path }}/roles/([\w\d.]+)", rolename)
-            if match.group(1).startswith(self.subrole_prefix):
-                new_name = self.prefix + match.group(1).replace(".", self.replace_dot)
-            else:
-                new_name = (
-                    self.prefix
-                    + self.subrole_prefix
-                    + match.group(1).replace(".", self.replace_dot)
-                )
-        return new_name
+        if lsr_rolename and rolename == lsr_rolename:
+            return self.prefix + self.newrolename
+        return self.rolenames.resolve(rolename)
 
     def task_cb(self, task):
         """do something with a task item"""
@@ -479,8 +1290,9 @@ class LSRFileTransformer(LSRFileTransformerBase):
                     break
         if is_include_or_import:
             new_rolename = self.convert_rolename(task[module_name]["name"])
-            if new_rolename:
+            if new_rolename and new_rolename != task[module_name]["name"]:
                 task[module_name]["name"] = new_rolename
+                self.changed = True
         elif is_include_vars:
             """
             Convert include_vars in the test playbook.
@@ -518,6 +1330,7 @@ class LSRFileTransformer(LSRFileTransformerBase):
                             _match.group(2),
                         )
                     )
+                    self.changed = True
             elif (
                 isinstance(task[module_name], str)
                 and _src_owner_match in task[module_name]
@@ -533,6 +1346,7 @@ class LSRFileTransformer(LSRFileTransformerBase):
                         _match.group(2),
                     )
                 )
+                self.changed = True
         elif role_module_name:
             logging.debug(f"\ttask role module {role_module_name}")
             # assumes task is an orderreddict
@@ -540,6 +1354,7 @@ class LSRFileTransformer(LSRFileTransformerBase):
             val = task[role_module_name]
             task.insert(idx, self.prefix + role_module_name, val)
             del task[role_module_name]
+            self.changed = True
 
     def other_cb(self, item):
         """do something with the other non-task information in an item
@@ -554,6 +1369,7 @@ class LSRFileTransformer(LSRFileTransformerBase):
                 lsr_rolename = self.src_owner + "." + self.rolename
                 if item["vars"][var] == lsr_rolename:
                     item["vars"][var] = self.prefix + self.newrolename
+                    self.changed = True
         return
 
     def meta_cb(self, item):
@@ -564,10 +1380,9 @@ class LSRFileTransformer(LSRFileTransformerBase):
         if name0 == name1:
             return True
         else:
-            # self.rolename_regex is default to "[_.]".
-            core0 = re.sub(self.rolename_regex, "", name0)
-            core1 = re.sub(self.rolename_regex, "", name1)
-            return core0 == core1
+            # the replace_dot and "." characters are ignored
+            ignore_chars = self.rolenames.ignore_chars
+            return name0.translate(ignore_chars) == name1.translate(ignore_chars)
 
     def change_roles(self, item, roles_kw):
         """ru_item is an item which may contain a roles or dependencies
@@ -586,16 +1401,17 @@ class LSRFileTransformer(LSRFileTransformerBase):
                 else:
                     key = "role"
                 new_rolename = self.convert_rolename(role[key], lsr_rolename)
-                if new_rolename:
+                if new_rolename and new_rolename != role[key]:
                     role[key] = new_rolename
                     changed = True
             else:
                 new_rolename = self.convert_rolename(role, lsr_rolename)
-                if new_rolename:
+                if new_rolename and new_rolename != role:
                     role = new_rolename
                     changed = True
             if changed:
                 item[roles_kw][idx] = role
+                self.changed = True
 
     def write(self):
         """assume we are operating on files already copied to the dest dir,
@@ -604,21 +1420,182 @@ class LSRFileTransformer(LSRFileTransformerBase):
         super().write()
 
 
-def lsr_copyleaf(src, dest, symlinks=True, ignore=None):
+# Files matching these patterns may be rewritten in place after they are
+# copied, so they are never hardlinked to the source files.
+REWRITTEN_FILES = ("*.yml", "*.yaml", "*.md", "*.html", "*.py")
+
+# How lsr_copyfile copies the data of a file:
+# "copy" - copy the data, cloning it with a reflink or copy_file_range if the
+#          filesystem supports it
+# "hardlink" - hardlink the files which are not in REWRITTEN_FILES, and copy
+#              the others
+copy_mode = "copy"
+
+# ioctl to clone a file with a reflink on btrfs, xfs, etc. - see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def same_file_contents(src, dest):
+    """Return True if dest is a regular file with the same size, mtime and
+    contents as src"""
+    try:
+        src_st = os.stat(src)
+        dest_st = os.lstat(dest)
+    except OSError:
+        return False
+    if not stat.S_ISREG(dest_st.st_mode):
+        return False
+    if os.path.samestat(src_st, dest_st):
+        return True
+    if src_st.st_size != dest_st.st_size or src_st.st_mtime_ns != dest_st.st_mtime_ns:
+        return False
+    with open(src, "rb") as fsrc, open(dest, "rb") as fdest:
+        while True:
+            src_buf = fsrc.read(1 << 20)
+            if src_buf != fdest.read(1 << 20):
+                return False
+            if not src_buf:
+                return True
+
+
+def fast_copyfile(src, dest):
+    """Copy the data of the file src to the new file dest.  Use a reflink or
+    copy_file_range, which do not move the data through user space, when the
+    filesystem supports them."""
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        if fcntl:
+            try:
+                fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdest.fileno(), 1 << 30):
+                    pass
+                return
+            except OSError:
+                # e.g. not supported across filesystems - start again
+                fsrc.seek(0)
+                fdest.seek(0)
+                fdest.truncate()
+        copyfileobj(fsrc, fdest)
+
+
+def lsr_copyfile(src, dest, follow_symlinks=True, copy_stat=True):
+    """Copy the file src to dest like copy2, or like copyfile if copy_stat is
+    False.  If dest is already a copy of src - same size, mtime and
+    contents - it is left alone.  An existing dest is replaced, not written
+    through, so that a hardlink or symlink in dest never changes its target.
+    Returns dest."""
+    if os.path.isdir(dest) and not os.path.islink(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    if not follow_symlinks and os.path.islink(src):
+        linkto = os.readlink(src)
+        if os.path.islink(dest) and os.readlink(dest) == linkto:
+            return dest
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        os.symlink(linkto, dest)
+        return dest
+    if same_file_contents(src, dest):
+        return dest
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    if copy_mode == "hardlink" and not any(
+        fnmatch.fnmatch(os.path.basename(dest), pattern) for pattern in REWRITTEN_FILES
+    ):
+        try:
+            os.link(src, dest)
+            return dest
+        except OSError:
+            # e.g. src and dest are on different filesystems
+            pass
+    fast_copyfile(src, dest)
+    if copy_stat:
+        copystat(src, dest)
+    else:
+        # keep the mtime so that the copy is recognized by same_file_contents
+        src_st = os.stat(src)
+        os.utime(dest, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+    return dest
+
+
+def lsr_remove(path):
+    """Remove the file, symlink or directory tree path"""
+    if path.is_dir() and not path.is_symlink():
+        rmtree(path)
+    else:
+        path.unlink()
+
+
+def lsr_copyleaf(src, dest, symlinks=True, ignore=None, copy_function=lsr_copyfile):
     if src.is_symlink() and symlinks:
         # symlinks=True --> symlink in dest
-        copyfile(src, dest, follow_symlinks=(not symlinks))
+        copy_function(src, dest, follow_symlinks=(not symlinks), copy_stat=False)
     elif src.is_dir():
         # symlinks=True --> symlink in dest
         # symlinks=False --> copy in dest
-        copytree(src, dest, symlinks=symlinks, ignore=ignore)
+        lsr_synctree(
+            src, dest, symlinks=symlinks, ignore=ignore, copy_function=copy_function
+        )
+    else:
+        copy_function(src, dest, copy_stat=False)
+
+
+def lsr_synctree(src, dest, symlinks=True, ignore=None, copy_function=lsr_copyfile):
+    """Make dest a copy of the tree src like copytree does, without copying
+    again the files in an existing dest which are already the same as in src.
+    Anything in dest which is not in src is removed.  Every file and symlink
+    is copied with copy_function, which takes the same arguments as
+    lsr_copyfile."""
+    if (src.is_symlink() and symlinks) or not src.is_dir():
+        if dest.is_dir() and not dest.is_symlink():
+            rmtree(dest)
+        lsr_copyleaf(
+            src, dest, symlinks=symlinks, ignore=ignore, copy_function=copy_function
+        )
+        return
+    if os.path.lexists(dest) and (dest.is_symlink() or not dest.is_dir()):
+        dest.unlink()
+    dest.mkdir(parents=True, exist_ok=True)
+    names = os.listdir(src)
+    if ignore:
+        ignored_names = ignore(os.fspath(src), names)
     else:
-        copyfile(src, dest)
+        ignored_names = set()
+    names = [name for name in names if name not in ignored_names]
+    for name in names:
+        subsrc = src / name
+        subdest = dest / name
+        if (subsrc.is_symlink() and symlinks) or not subsrc.is_dir():
+            if subdest.is_dir() and not subdest.is_symlink():
+                rmtree(subdest)
+            # the same as copytree does
+            copy_function(subsrc, subdest, follow_symlinks=(not symlinks))
+        else:
+            lsr_synctree(
+                subsrc,
+                subdest,
+                symlinks=symlinks,
+                ignore=ignore,
+                copy_function=copy_function,
+            )
+    for name in set(os.listdir(dest)).difference(names):
+        lsr_remove(dest / name)
+    copystat(src, dest)
 
 
 # Once python 3.8 is available in Travis CI,
 # replace lsr_copytree with shutil.copytree with dirs_exist_ok=True.
-def lsr_copytree(src, dest, symlinks=True, dirs_exist_ok=False, ignore=None):
+def lsr_copytree(
+    src,
+    dest,
+    symlinks=True,
+    dirs_exist_ok=False,
+    ignore=None,
+    copy_function=lsr_copyfile,
+):
     if dest.exists():
         if dest.is_dir():
             for sr in src.iterdir():
@@ -628,41 +1605,64 @@ def lsr_copytree(src, dest, symlinks=True, dirs_exist_ok=False, ignore=None):
                     if sr.name != ignore:
                         if subsrc.is_dir():
                             if subdest.exists() and dirs_exist_ok:
-                                rmtree(subdest)
-                            lsr_copytree(
+                                lsr_synctree(
+                                    subsrc,
+                                    subdest,
+                                    symlinks=symlinks,
+                                    ignore=ignore,
+                                    copy_function=copy_function,
+                                )
+                            else:
+                                lsr_copytree(
+                                    subsrc,
+                                    subdest,
+                                    symlinks=symlinks,
+                                    ignore=ignore,
+                                    dirs_exist_ok=True,
+                                    copy_function=copy_function,
+                                )
+                        else:
+                            lsr_copyleaf(
                                 subsrc,
                                 subdest,
                                 symlinks=symlinks,
                                 ignore=ignore,
-                                dirs_exist_ok=True,
-                            )
-                        else:
-                            if subdest.exists() and dirs_exist_ok:
-                                subdest.unlink()
-                            lsr_copyleaf(
-                                subsrc, subdest, symlinks=symlinks, ignore=ignore
+                                copy_function=copy_function,
                             )
                 else:
                     if subsrc.is_dir():
                         if subdest.exists() and dirs_exist_ok:
-                            rmtree(subdest)
-                        lsr_copytree(
-                            subsrc,
-                            subdest,
-                            symlinks=symlinks,
-                            dirs_exist_ok=dirs_exist_ok,
-                        )
+                            lsr_synctree(
+                                subsrc,
+                                subdest,
+                                symlinks=symlinks,
+                                copy_function=copy_function,
+                            )
+                        else:
+                            lsr_copytree(
+                                subsrc,
+                                subdest,
+                                symlinks=symlinks,
+                                dirs_exist_ok=dirs_exist_ok,
+                                copy_function=copy_function,
+                            )
                     else:
-                        if (subdest.exists() or subdest.is_symlink()) and dirs_exist_ok:
-                            subdest.unlink()
                         # symlinks=False --> copy in dest
-                        copy2(subsrc, subdest, follow_symlinks=(not symlinks))
+                        copy_function(subsrc, subdest, follow_symlinks=(not symlinks))
         else:
-            if dest.exists() and dirs_exist_ok:
+            if src.is_dir() and dirs_exist_ok:
                 dest.unlink()
-            lsr_copyleaf(src, dest, symlinks=symlinks, ignore=ignore)
+            lsr_copyleaf(
+                src,
+                dest,
+                symlinks=symlinks,
+                ignore=ignore,
+                copy_function=copy_function,
+            )
     else:
-        lsr_copyleaf(src, dest, symlinks=symlinks, ignore=ignore)
+        lsr_copyleaf(
+            src, dest, symlinks=symlinks, ignore=ignore, copy_function=copy_function
+        )
 
 
 def dir_to_plugin(v):
@@ -673,20 +1673,110 @@ def dir_to_plugin(v):
     return v
 
 
+# the find patterns which cannot be put in an alternation with other
+# patterns - backreferences by number or name, named groups, conditionals
+# and global flags
+UNCOMBINED_FIND_RE = re.compile(r"\\[1-9]|\(\?(?:P[<=]|\(|[aiLmsux])")
+
+
+class LSRReplacer(object):
+    """Apply a list of (find, replace) mappings to files in a single pass.
+
+    find is a regex and replace is a re.sub replacement string, as with
+    re.sub.  The find patterns are compiled into one alternation, so
+    each file is read once, every mapping is applied in one scan of the
+    text, and the file is written only if the text changed.  A piece of text
+    is replaced at most once - if several mappings match at the same
+    position, the one earlier in the list wins.  The patterns which cannot
+    be combined, e.g. the ones with backreferences, are applied on their
+    own, in list order, to the output of the mappings before them."""
+
+    def __init__(self, mappings):
+        self.mappings = list(mappings)
+        # (regex, replacement) applied in turn by sub()
+        self.steps = []
+        combined = []
+        for find, replace in self.mappings:
+            pattern = re.compile(find)
+            if UNCOMBINED_FIND_RE.search(find):
+                self.add_combined_step(combined)
+                combined = []
+                self.steps.append((pattern, replace))
+            else:
+                combined.append((find, pattern, replace))
+        self.add_combined_step(combined)
+
+    def add_combined_step(self, combined):
+        """Add the step which applies the (find, pattern, replace) mappings
+        in combined in one alternation"""
+        if not combined:
+            return
+        if len(combined) == 1:
+            self.steps.append(combined[0][1:])
+            return
+        regex = re.compile(
+            "|".join(
+                "(?P<_lsr{0}>{1})".format(idx, find)
+                for idx, (find, _, _) in enumerate(combined)
+            )
+        )
+
+        def replace_match(match):
+            _, pattern, replace = combined[int(match.lastgroup[4:])]
+            if "\\" not in replace:
+                return replace
+            # replacement has escapes or group references - expand it using
+            # the original pattern, whose groups are numbered differently
+            return pattern.match(match.string, match.start()).expand(replace)
+
+        self.steps.append((regex, replace_match))
+
+    def sub(self, text):
+        """Return text with all of the mappings applied"""
+        for regex, replace in self.steps:
+            text = regex.sub(replace, text)
+        return text
+
+    def sub_data(self, data):
+        """Return the file contents data, as bytes, with all of the mappings
+        applied.  The data is returned as it is if nothing was replaced."""
+        if not self.steps:
+            return data
+        # decode the same way as open() does, i.e. with universal newlines
+        text = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8").read()
+        new_text = self.sub(text)
+        if new_text == text:
+            return data
+        return new_text.encode("utf-8")
+
+    def replace_in_tree(self, path, file_patterns, exclude=()):
+        """
+        Apply the mappings to the files that match `file_patterns` under `path`,
+        except for the paths in `exclude`.
+        """
+        if not self.steps:
+            return
+        for root, dirs, files in os.walk(os.path.abspath(path)):
+            for filename in files:
+                if not any(fnmatch.fnmatch(filename, fp) for fp in file_patterns):
+                    continue
+                filepath = os.path.join(root, filename)
+                if filepath in exclude:
+                    continue
+                with open(filepath, encoding="utf-8") as f:
+                    s = f.read()
+                new_s = self.sub(s)
+                if new_s != s:
+                    with open(filepath, "w", encoding="utf-8") as f:
+                        f.write(new_s)
+
+
 def file_replace(path, find, replace, file_patterns):
     """
     Replace a pattern `find` with `replace` in the files that match
     `file_patterns` under `path`.
     """
-    for root, dirs, files in os.walk(os.path.abspath(path)):
-        for file_pattern in file_patterns:
-            for filename in fnmatch.filter(files, file_pattern):
-                filepath = os.path.join(root, filename)
-                with open(filepath, encoding="utf-8") as f:
-                    s = f.read()
-                s = re.sub(find, replace, s)
-                with open(filepath, "w", encoding="utf-8") as f:
-                    f.write(s)
+    LSRReplacer([(find, replace)]).replace_in_tree(path, file_patterns)
 
 
 def copy_tree_with_replace(
@@ -699,6 +1789,7 @@ def copy_tree_with_replace(
     isrole=True,
     ignoreme=None,
     symlinks=True,
+    pipeline=None,
 ):
     """
     1. Copy files and dirs in the dir to
@@ -707,6 +1798,8 @@ def copy_tree_with_replace(
        DEST_PATH/ansible_collections/NAMESPACE/COLLECTION/dir/ROLE.
     2. Parse the source tree to look for task_roles
     3. Replace the task_roles with FQCN
+    If pipeline, an LSRPipeline, is given, the files are converted by it while
+    they are copied.
     """
     for dirname in TUPLE:
         src = src_path / dirname
@@ -716,109 +1809,159 @@ def copy_tree_with_replace(
             else:
                 dest = dest_path / dirname / new_role
             logging.info(f"Copying role {src} to {dest}")
+            kwargs = {}
             if ignoreme:
-                lsr_copytree(
-                    src,
-                    dest,
-                    ignore=ignore_patterns(*ignoreme),
-                    symlinks=symlinks,
-                    dirs_exist_ok=True,
-                )
-            else:
-                lsr_copytree(src, dest, symlinks=symlinks, dirs_exist_ok=True)
+                kwargs["ignore"] = ignore_patterns(*ignoreme)
             lsrxfrm = LSRTransformer(
                 dest, transformer_args, False, role, new_role, LSRFileTransformer
             )
-            lsrxfrm.run()
+            if pipeline:
+                with profile_phase("pipeline"):
+                    pipeline.copy_tree(
+                        src,
+                        dest,
+                        lsrxfrm,
+                        symlinks=symlinks,
+                        dirs_exist_ok=True,
+                        **kwargs,
+                    )
+                    pipeline.flush()
+            else:
+                with profile_phase("copy"):
+                    lsr_copytree(
+                        src, dest, symlinks=symlinks, dirs_exist_ok=True, **kwargs
+                    )
+                with profile_phase("transform"):
+                    lsrxfrm.run()
 
 
-def convert_tests_plugin_symlinks(tests_path, new_role, dest_path):
-    """
-    Convert symlinks in tests plugin directories to point to collection plugins.
+# (plugin dir, regex) matching a symlink target in each plugin directory of
+# the role, e.g. ../../library/my_module.py or ../../module_utils/myrole_lsr.
+# A target is classified by the first plugin dir, in PLUGINS order, in it.
+PLUGIN_LINK_RES = tuple(
+    (plugin, re.compile(r"(?:^|.*/){0}(?:/(.*))?$".format(re.escape(plugin))))
+    for plugin in PLUGINS
+)
 
-    In role tests, there may be plugin directories (library, module_utils, etc.)
-    containing symlinks that point back to the role's plugin directories. These
-    need to be converted to point to the collection's plugins directory.
-    """
-    if not tests_path.exists():
-        return
 
-    for plugin_dir_name in PLUGINS:
-        plugin_test_dir = tests_path / plugin_dir_name
-        if not plugin_test_dir.is_dir():
-            continue
+class LSRSymlinks(object):
+    """The symlinks and the directories in the tree path, collected by a single
+    scan which does not follow the symlinks.  The contents of a directory come
+    before the directory itself."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.links = []
+        self.dirs = []
+        if os.path.isdir(self.path):
+            self.scan(self.path)
+
+    def scan(self, dirpath):
+        with os.scandir(dirpath) as it:
+            entries = list(it)
+        for entry in entries:
+            if entry.is_symlink():
+                self.links.append(entry.path)
+            elif entry.is_dir(follow_symlinks=False):
+                self.scan(entry.path)
+                self.dirs.append(entry.path)
+
+    def cleanup(self, role, rmlist):
+        """Remove the symlinks named in rmlist, the symlinks in path/roles,
+        the empty linux-system-roles.ROLE directories, and path/roles if it
+        is empty"""
+        rmset = set(rmlist)
+        roles_dir = os.path.join(self.path, "roles")
+        dirnames = {"linux-system-roles." + role}
+        if role == "sshd":
+            dirnames.add("ansible-sshd")
+        links = []
+        for link in self.links:
+            parent, name = os.path.split(link)
+            if name in rmset or parent == roles_dir:
+                os.unlink(link)
+            else:
+                links.append(link)
+        self.links = links
+        removed = set()
+        for dirpath in self.dirs:
+            if os.path.basename(dirpath) in dirnames and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+                removed.add(dirpath)
+        if roles_dir not in removed and roles_dir in self.dirs:
+            if not os.listdir(roles_dir):
+                os.rmdir(roles_dir)
+                removed.add(roles_dir)
+        self.dirs = [dirpath for dirpath in self.dirs if dirpath not in removed]
+
+    def convert_plugins(self, new_role, dest_path):
+        """
+        Convert symlinks in tests plugin directories to point to collection plugins.
 
-        for item in plugin_test_dir.iterdir():
-            if not item.is_symlink():
+        In role tests, there may be plugin directories (library, module_utils, etc.)
+        containing symlinks that point back to the role's plugin directories. These
+        need to be converted to point to the collection's plugins directory.
+        """
+        plugin_dirs = {os.path.join(self.path, plugin) for plugin in PLUGINS}
+        for link in self.links:
+            parent, name = os.path.split(link)
+            if parent not in plugin_dirs:
                 continue
-
-            link_target = os.readlink(item)
-
-            for src_plugin_dir in PLUGINS:
-                pattern = re.compile(
-                    r"(?:^|.*/){}(?:/(.*))?$".format(re.escape(src_plugin_dir))
-                )
-                match = pattern.match(link_target)
+            link_target = os.readlink(link)
+            for src_plugin_dir, plugin_link_re in PLUGIN_LINK_RES:
+                match = plugin_link_re.match(link_target)
                 if match:
-                    rel_in_plugin = match.group(1) if match.group(1) else item.name
-                    src_plugin_name = dir_to_plugin(src_plugin_dir)
-
-                    if src_plugin_dir == "module_utils":
-                        new_target = (
-                            dest_path
-                            / "plugins"
-                            / src_plugin_name
-                            / (new_role + "_lsr")
-                            / rel_in_plugin
-                        )
-                    else:
-                        new_target = (
-                            dest_path / "plugins" / src_plugin_name / rel_in_plugin
-                        )
-
-                    if new_target.exists():
-                        rel_path = os.path.relpath(new_target, item.parent)
-                        logging.info(
-                            f"Converting symlink {item} to point to {rel_path}"
-                        )
-                        item.unlink()
-                        item.symlink_to(rel_path)
-                    else:
-                        logging.info(
-                            f"Matched plugin path for symlink {item} (plugin '{src_plugin_dir}', "
-                            f"relative '{rel_in_plugin}'), but computed target {new_target} does not exist; "
-                            "leaving symlink unchanged"
-                        )
                     break
+            else:
+                continue
+            rel_in_plugin = match.group(1) or name
+            src_plugin_name = dir_to_plugin(src_plugin_dir)
+            if src_plugin_dir == "module_utils":
+                new_target = (
+                    dest_path
+                    / "plugins"
+                    / src_plugin_name
+                    / (new_role + "_lsr")
+                    / rel_in_plugin
+                )
+            else:
+                new_target = dest_path / "plugins" / src_plugin_name / rel_in_plugin
+
+            if new_target.exists():
+                rel_path = os.path.relpath(new_target, parent)
+                logging.info(f"Converting symlink {link} to point to {rel_path}")
+                os.unlink(link)
+                os.symlink(rel_path, link)
+            else:
+                logging.info(
+                    f"Matched plugin path for symlink {link} (plugin '{src_plugin_dir}', "
+                    f"relative '{rel_in_plugin}'), but computed target {new_target} does not exist; "
+                    "leaving symlink unchanged"
+                )
+
+
+def convert_tests_plugin_symlinks(tests_path, new_role, dest_path):
+    """
+    Convert symlinks in tests plugin directories to point to collection plugins.
+    """
+    LSRSymlinks(tests_path).convert_plugins(new_role, dest_path)
 
 
 def cleanup_symlinks(path, role, rmlist):
     """
     Clean up symlinks in tests/roles
     """
-    if path.exists():
-        nodes = sorted(list(path.rglob("*")), reverse=True)
-        for node in nodes:
-            for item in rmlist:
-                if item == node.name:
-                    if node.is_symlink():
-                        node.unlink()
-            if (
-                node.is_dir()
-                and (
-                    r"linux-system-roles." + role == node.name
-                    or (role == "sshd" and node.name == "ansible-sshd")
-                )
-                and not any(node.iterdir())
-            ):
-                node.rmdir()
-        roles_dir = path / "roles"
-        if roles_dir.exists():
-            for sr in roles_dir.iterdir():
-                if sr.is_symlink():
-                    sr.unlink()
-            if not any(roles_dir.iterdir()):
-                roles_dir.rmdir()
+    LSRSymlinks(path).cleanup(role, rmlist)
+
+
+def get_module_utils_parts(module_utils_dir, path):
+    """Return the module_utils parts of the python file path in module_utils_dir,
+    e.g. [b"ROLE", b"subdir", b"module"]"""
+    full_path = Path(path).relative_to(module_utils_dir)
+    parts = bytes(full_path)[:-3].split(b"/")
+    if parts[-1] == b"__init__":
+        del parts[-1]
+    return parts
 
 
 def gather_module_utils_parts(module_utils_dir):
@@ -828,190 +1971,332 @@ def gather_module_utils_parts(module_utils_dir):
             for filename in files:
                 if os.path.splitext(filename)[1] != ".py":
                     continue
-                full_path = (Path(root) / filename).relative_to(module_utils_dir)
-                parts = bytes(full_path)[:-3].split(b"/")
-                if parts[-1] == b"__init__":
-                    del parts[-1]
-                module_utils.append(parts)
+                module_utils.append(
+                    get_module_utils_parts(module_utils_dir, Path(root) / filename)
+                )
     return module_utils
 
 
-def import_replace(match):
-    """
-    If 'import ansible.module_utils.something ...' matches,
-    'import ansible_collections.NAMESPACE.COLLECTION.plugins.module_utils.something ...'
-    is returned to replace.
-    """
-    _src_path = config["src_path"]
-    _namespace = config["namespace"]
-    _collection = config["collection"]
-    _role = config["role"]
-    _module_utils = config["module_utils"]
-    _additional_rewrites = config["additional_rewrites"]
-    _module_utils_dir = config["module_utils_dir"]
-    parts = match.group(3).split(b".")
-    match_group3 = match.group(3)
-    src_module_path = _src_path / "module_utils" / match.group(3).decode("utf-8")
-    dest_module_path0 = _module_utils_dir / match.group(3).decode("utf-8")
-    dest_module_path1 = _module_utils_dir / _role
-    if len(parts) == 1:
-        if not src_module_path.is_dir() and (
-            dest_module_path0.is_dir() or dest_module_path1.is_dir()
-        ):
-            match_group3 = (_role + "." + match.group(3).decode("utf-8")).encode()
-            parts = match_group3.split(b".")
-    if parts in _module_utils:
-        if match.group(1) == b"import" and match.group(4) == b"":
-            _additional_rewrites.append(parts)
-            if src_module_path.exists() or Path(str(src_module_path) + ".py").exists():
-                return b"import ansible_collections.%s.%s.plugins.module_utils.%s%s" % (
-                    bytes(_namespace, "utf-8"),
-                    bytes(_collection, "utf-8"),
-                    match_group3,
-                    match.group(5),
+class LSRModuleUtilsIndex(object):
+    """The module_utils known to the import rewriter, with a set based index
+    of the files and directories in the given module_utils trees.
+
+    import_replace and from_replace check several paths for every import
+    they match.  The paths in the indexed trees are looked up in the index
+    instead of in the filesystem - other paths, e.g. ones which are only
+    found after lower casing the whole path, are still checked with stat."""
+
+    def __init__(self, module_utils, roots=()):
+        # the module_utils as tuples of bytes, e.g. (b"ROLE", b"subdir", b"module")
+        self.modules = set(tuple(parts) for parts in module_utils)
+        self.roots = []
+        self.dirs = set()
+        self.files = set()
+        for root in roots:
+            root = os.path.abspath(root)
+            self.roots.append(root)
+            if os.path.isdir(root):
+                self.dirs.add(root)
+                self.add_tree(root)
+
+    def add_tree(self, top):
+        """Add the files and directories under top, following symlinks
+        the same way is_dir and is_file do"""
+        visited = set()
+        todo = [top]
+        while todo:
+            path = todo.pop()
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        self.dirs.add(entry.path)
+                        if entry.is_symlink():
+                            realpath = os.path.realpath(entry.path)
+                            if realpath in visited:
+                                continue
+                            visited.add(realpath)
+                        todo.append(entry.path)
+                    elif entry.is_file():
+                        self.files.add(entry.path)
+
+    def add_file(self, path):
+        """Add the file path, which may not be written yet, if it is in one of
+        the indexed trees.  Its directory must already exist."""
+        path = os.path.abspath(path)
+        if self.is_indexed(path):
+            self.files.add(path)
+
+    def get_listing(self):
+        """Return the sorted lists of the indexed paths relative to each root.
+        Directories have a trailing /."""
+        listing = []
+        for root in self.roots:
+            prefix = root + os.sep
+            dirs = [path for path in self.dirs if path.startswith(prefix)]
+            files = [path for path in self.files if path.startswith(prefix)]
+            listing.append(
+                sorted(
+                    [os.path.relpath(path, root) + "/" for path in dirs]
+                    + [os.path.relpath(path, root) for path in files]
                 )
-            else:
-                return (
-                    b"import ansible_collections.%s.%s.plugins.module_utils.%s as %s%s"
-                    % (
-                        bytes(_namespace, "utf-8"),
-                        bytes(_collection, "utf-8"),
-                        match_group3,
-                        parts[-1],
-                        match.group(5),
-                    )
-                )
-        return b"%s ansible_collections.%s.%s.plugins.module_utils.%s%s%s" % (
-            match.group(1),
-            bytes(_namespace, "utf-8"),
-            bytes(_collection, "utf-8"),
-            match_group3,
-            match.group(4),
-            match.group(5),
+            )
+        return listing
+
+    def __contains__(self, parts):
+        return tuple(parts) in self.modules
+
+    def is_indexed(self, path):
+        """Return True if path is in one of the indexed trees"""
+        if ".." in Path(path).parts:
+            return False
+        return any(
+            path == root or path.startswith(root + os.sep) for root in self.roots
         )
-    return match.group(0)
 
+    def is_dir(self, path):
+        path = os.path.abspath(path)
+        if self.is_indexed(path):
+            return path in self.dirs
+        return os.path.isdir(path)
 
-def get_candidates(parts3, parts5):
-    from_file0 = config["dest_path"] / "plugins" / "module_utils"
-    for p3 in parts3:
-        from_file0 = from_file0 / p3.decode("utf-8")
-    from_file1 = from_file0
-    for p5 in parts5:
-        from_file1 = from_file1 / p5.decode("utf-8").strip(", ")
-    from_file0 = Path(str(from_file0) + ".py")
-    lfrom_file0 = Path(str(from_file0).lower())
-    from_file1 = Path(str(from_file1) + ".py")
-    lfrom_file1 = Path(str(from_file1).lower())
-    return from_file0, lfrom_file0, from_file1, lfrom_file1
+    def is_file(self, path):
+        path = os.path.abspath(path)
+        if self.is_indexed(path):
+            return path in self.files
+        return os.path.isfile(path)
 
+    def exists(self, path):
+        return self.is_dir(path) or self.is_file(path)
 
-def from_replace(match):
-    """
-    case 1:
-    If it matches:
-      from ansible.module_utils.ROLE.somedir import module
-    and if plugins/module_utils/ROLE/somedir/module.py does not exist
-    in the converted tree,
-    'from ansible_collections.NAMESPACE.COLLECTION.plugins.module_utils.ROLE.somedir.__init__ import module'
-    is returned to replace.
-
-    case 2:
-    If it matches:
-      from ansible.module_utils.ROLE.subdir.something import (\n
-    and if plugins/module_utils/ROLE/subdir/something.py exists in the
-    converted tree,
-    'from ansible_collections.NAMESPACE.COLLECTION.plugins.module_utils.ROLE.subdir.something import (\n'
-    is returned to replace.
-
-    Legend:
-    - group1 - from
-    - group2 - ansible.module_utils
-    - group3 - name if any
-    - group4 - ( if any
-    - group5 - identifier
-    """
-    _src_path = config["src_path"]
-    _namespace = config["namespace"]
-    _collection = config["collection"]
-    _role = config["role"]
-    _module_utils = config["module_utils"]
-    _module_utils_dir = config["module_utils_dir"]
-    try:
-        parts3 = match.group(3).split(b".")
-    except AttributeError:
-        parts3 = []
-    try:
-        parts5 = match.group(5).split(b".")
-    except AttributeError:
-        parts5 = []
-    # parts3 (e.g., [b'ROLE', b'subdir', b'module']) matches one module_utils or
-    # size of parts3 is 1 (e.g., [b'module']), in this case, module.py was moved
-    # to ROLE/module.py or module is a dir.
-    # If latter, match.group(3) has to be converted to b'ROLE.module'.
-    match_group3 = match.group(3)
-    if len(parts3) == 1:
-        src_module_path = _src_path / "module_utils" / match.group(3).decode("utf-8")
-        dest_module_path0 = _module_utils_dir / match.group(3).decode("utf-8")
-        dest_module_path1 = _module_utils_dir / _role
-        if not src_module_path.is_dir() and (
-            dest_module_path0.is_dir() or dest_module_path1.is_dir()
-        ):
-            match_group3 = (_role + "." + match.group(3).decode("utf-8")).encode()
-            parts3 = match_group3.split(b".")
-    if parts3 in _module_utils:
-        from_file0, lfrom_file0, from_file1, lfrom_file1 = get_candidates(
-            parts3, parts5
+    def any_file(self, *paths):
+        """Return True if any of paths is a file"""
+        return any(self.is_file(path) for path in paths)
+
+
+# below this total size of the python files of a role, their imports are
+# rewritten in this process - sending them to the worker processes would
+# take longer than rewriting them
+REWRITE_POOL_MIN_SIZE = 256 * 1024
+
+
+class LSRImportRewriter(object):
+    """Rewrite the imports of ansible.module_utils in the python files of a
+    role to import from the module_utils of the collection.
+
+    The rewriter only holds the state of one role and keeps the state of
+    each file in rewrite(), so it can be used by several threads or pickled
+    to a process pool to rewrite many files at once."""
+
+    def __init__(
+        self,
+        namespace,
+        collection,
+        role,
+        src_path,
+        dest_path,
+        module_utils_dir,
+        module_utils,
+    ):
+        """module_utils is the LSRModuleUtilsIndex of the source and the
+        collection module_utils, or a list of the module_utils parts"""
+        self.namespace = namespace
+        self.collection = collection
+        self.role = role
+        self.src_path = src_path
+        self.dest_path = dest_path
+        self.module_utils_dir = module_utils_dir
+        if not isinstance(module_utils, LSRModuleUtilsIndex):
+            # just a list of module_utils - check the paths in the filesystem
+            module_utils = LSRModuleUtilsIndex(module_utils)
+        self.module_utils = module_utils
+
+    def rewrite(self, text):
+        """Return text with the imports rewritten"""
+        additional_rewrites = []
+        text = IMPORT_RE.sub(
+            lambda match: self.import_replace(match, additional_rewrites), text
         )
+        text = FROM_RE.sub(self.from_replace, text)
+        if additional_rewrites:
+            # references to the modules imported without "as" have to use the
+            # module name, e.g. ansible.module_utils.ROLE.util.func() -> util.func()
+            rewrites_re, replacements = get_additional_rewrites_re(
+                tuple(tuple(parts) for parts in additional_rewrites)
+            )
+            text = rewrites_re.sub(lambda match: replacements[match.group(0)], text)
+        return text
+
+    def rewrite_texts(self, texts, jobs=1):
+        """Return the list of the rewritten texts.  If jobs is greater than 1,
+        the texts are rewritten in a pool of that many processes."""
+        return [text for text, _ in self.rewrite_texts_timed(texts, jobs)]
+
+    def rewrite_texts_timed(self, texts, jobs=1):
+        """Like rewrite_texts, but return the list of the tuples of the
+        rewritten text and the wall and CPU time it took to rewrite it"""
         if (
-            from_file0.is_file()
-            or from_file1.is_file()
-            or lfrom_file0.is_file()
-            or lfrom_file1.is_file()
+            jobs > 1
+            and len(texts) > 1
+            and sum(len(text) for text in texts) >= REWRITE_POOL_MIN_SIZE
         ):
-            return (
-                b"%s ansible_collections.%s.%s.plugins.module_utils.%s import %s%s%s"
-                % (
-                    match.group(1),
-                    bytes(_namespace, "utf-8"),
-                    bytes(_collection, "utf-8"),
-                    match_group3,
-                    match.group(4),
-                    match.group(5),
-                    match.group(6),
-                )
+            # one batch of texts for each worker, so that the rewriter, with
+            # its module_utils index, is pickled once per worker instead of
+            # with every few texts
+            batches = [texts[idx::jobs] for idx in range(jobs)]
+            pool = get_xfrm_pool(jobs)
+            rewritten = [None] * len(texts)
+            for idx, batch in enumerate(pool.map(self.rewrite_batch, batches)):
+                rewritten[idx::jobs] = batch
+            return rewritten
+        return self.rewrite_batch(texts)
+
+    def rewrite_batch(self, texts):
+        """Return the list of the results of call_timed of rewrite for each
+        of texts"""
+        return [call_timed(self.rewrite, text) for text in texts]
+
+    def import_replace(self, match, additional_rewrites):
+        """
+        If 'import ansible.module_utils.something ...' matches,
+        'import ansible_collections.NAMESPACE.COLLECTION.plugins.module_utils.something ...'
+        is returned to replace.
+        """
+        _src_path = self.src_path
+        _namespace = self.namespace
+        _collection = self.collection
+        _role = self.role
+        _module_utils = self.module_utils
+        _additional_rewrites = additional_rewrites
+        _module_utils_dir = self.module_utils_dir
+        parts = match.group(3).split(b".")
+        match_group3 = match.group(3)
+        src_module_path = _src_path / "module_utils" / match.group(3).decode("utf-8")
+        dest_module_path0 = _module_utils_dir / match.group(3).decode("utf-8")
+        dest_module_path1 = _module_utils_dir / _role
+        if len(parts) == 1:
+            if not _module_utils.is_dir(src_module_path) and (
+                _module_utils.is_dir(dest_module_path0)
+                or _module_utils.is_dir(dest_module_path1)
+            ):
+                match_group3 = (_role + "." + match.group(3).decode("utf-8")).encode()
+                parts = match_group3.split(b".")
+        if parts in _module_utils:
+            if match.group(1) == b"import" and match.group(4) == b"":
+                _additional_rewrites.append(parts)
+                if _module_utils.exists(src_module_path) or _module_utils.exists(
+                    str(src_module_path) + ".py"
+                ):
+                    return (
+                        b"import ansible_collections.%s.%s.plugins.module_utils.%s%s"
+                        % (
+                            bytes(_namespace, "utf-8"),
+                            bytes(_collection, "utf-8"),
+                            match_group3,
+                            match.group(5),
+                        )
+                    )
+                else:
+                    return (
+                        b"import ansible_collections.%s.%s.plugins.module_utils.%s as %s%s"
+                        % (
+                            bytes(_namespace, "utf-8"),
+                            bytes(_collection, "utf-8"),
+                            match_group3,
+                            parts[-1],
+                            match.group(5),
+                        )
+                    )
+            return b"%s ansible_collections.%s.%s.plugins.module_utils.%s%s%s" % (
+                match.group(1),
+                bytes(_namespace, "utf-8"),
+                bytes(_collection, "utf-8"),
+                match_group3,
+                match.group(4),
+                match.group(5),
             )
-        else:
-            return (
-                b"%s ansible_collections.%s.%s.plugins.module_utils.%s.__init__ import %s%s%s"
-                % (
-                    match.group(1),
-                    bytes(_namespace, "utf-8"),
-                    bytes(_collection, "utf-8"),
-                    match_group3,
-                    match.group(4),
-                    match.group(5),
-                    match.group(6),
-                )
+        return match.group(0)
+
+    def get_candidates(self, parts3, parts5):
+        from_file0 = self.dest_path / "plugins" / "module_utils"
+        for p3 in parts3:
+            from_file0 = from_file0 / p3.decode("utf-8")
+        from_file1 = from_file0
+        for p5 in parts5:
+            from_file1 = from_file1 / p5.decode("utf-8").strip(", ")
+        from_file0 = Path(str(from_file0) + ".py")
+        lfrom_file0 = Path(str(from_file0).lower())
+        from_file1 = Path(str(from_file1) + ".py")
+        lfrom_file1 = Path(str(from_file1).lower())
+        return from_file0, lfrom_file0, from_file1, lfrom_file1
+
+    def from_replace(self, match):
+        """
+        case 1:
+        If it matches:
+          from ansible.module_utils.ROLE.somedir import module
+        and if plugins/module_utils/ROLE/somedir/module.py does not exist
+        in the converted tree,
+        'from ansible_collections.NAMESPACE.COLLECTION.plugins.module_utils.ROLE.somedir.__init__ import module'
+        is returned to replace.
+
+        case 2:
+        If it matches:
+          from ansible.module_utils.ROLE.subdir.something import (\n
+        and if plugins/module_utils/ROLE/subdir/something.py exists in the
+        converted tree,
+        'from ansible_collections.NAMESPACE.COLLECTION.plugins.module_utils.ROLE.subdir.something import (\n'
+        is returned to replace.
+
+        Legend:
+        - group1 - from
+        - group2 - ansible.module_utils
+        - group3 - name if any
+        - group4 - ( if any
+        - group5 - identifier
+        """
+        _src_path = self.src_path
+        _namespace = self.namespace
+        _collection = self.collection
+        _role = self.role
+        _module_utils = self.module_utils
+        _module_utils_dir = self.module_utils_dir
+        try:
+            parts3 = match.group(3).split(b".")
+        except AttributeError:
+            parts3 = []
+        try:
+            parts5 = match.group(5).split(b".")
+        except AttributeError:
+            parts5 = []
+        # parts3 (e.g., [b'ROLE', b'subdir', b'module']) matches one module_utils or
+        # size of parts3 is 1 (e.g., [b'module']), in this case, module.py was moved
+        # to ROLE/module.py or module is a dir.
+        # If latter, match.group(3) has to be converted to b'ROLE.module'.
+        match_group3 = match.group(3)
+        if len(parts3) == 1:
+            src_module_path = (
+                _src_path / "module_utils" / match.group(3).decode("utf-8")
             )
-    if parts5 in _module_utils:
-        from_file0, lfrom_file0, from_file1, lfrom_file1 = get_candidates(
-            parts3, parts5
-        )
-        if parts3:
-            if (
-                from_file0.is_file()
-                or from_file1.is_file()
-                or lfrom_file0.is_file()
-                or lfrom_file1.is_file()
+            dest_module_path0 = _module_utils_dir / match.group(3).decode("utf-8")
+            dest_module_path1 = _module_utils_dir / _role
+            if not _module_utils.is_dir(src_module_path) and (
+                _module_utils.is_dir(dest_module_path0)
+                or _module_utils.is_dir(dest_module_path1)
             ):
+                match_group3 = (_role + "." + match.group(3).decode("utf-8")).encode()
+                parts3 = match_group3.split(b".")
+        if parts3 in _module_utils:
+            from_file0, lfrom_file0, from_file1, lfrom_file1 = self.get_candidates(
+                parts3, parts5
+            )
+            if _module_utils.any_file(from_file0, from_file1, lfrom_file0, lfrom_file1):
                 return (
                     b"%s ansible_collections.%s.%s.plugins.module_utils.%s import %s%s%s"
                     % (
                         match.group(1),
                         bytes(_namespace, "utf-8"),
                         bytes(_collection, "utf-8"),
-                        match.group(3),
+                        match_group3,
                         match.group(4),
                         match.group(5),
                         match.group(6),
@@ -1024,42 +2309,264 @@ def from_replace(match):
                         match.group(1),
                         bytes(_namespace, "utf-8"),
                         bytes(_collection, "utf-8"),
-                        match.group(3),
+                        match_group3,
                         match.group(4),
                         match.group(5),
                         match.group(6),
                     )
                 )
-        if (
-            from_file0.is_file()
-            or from_file1.is_file()
-            or lfrom_file0.is_file()
-            or lfrom_file1.is_file()
-        ):
-            return (
-                b"%s ansible_collections.%s.%s.plugins.module_utils import %s%s%s"
-                % (
-                    match.group(1),
-                    bytes(_namespace, "utf-8"),
-                    bytes(_collection, "utf-8"),
-                    match.group(4),
-                    match.group(5),
-                    match.group(6),
+        if parts5 in _module_utils:
+            from_file0, lfrom_file0, from_file1, lfrom_file1 = self.get_candidates(
+                parts3, parts5
+            )
+            if parts3:
+                if _module_utils.any_file(
+                    from_file0, from_file1, lfrom_file0, lfrom_file1
+                ):
+                    return (
+                        b"%s ansible_collections.%s.%s.plugins.module_utils.%s import %s%s%s"
+                        % (
+                            match.group(1),
+                            bytes(_namespace, "utf-8"),
+                            bytes(_collection, "utf-8"),
+                            match.group(3),
+                            match.group(4),
+                            match.group(5),
+                            match.group(6),
+                        )
+                    )
+                else:
+                    return (
+                        b"%s ansible_collections.%s.%s.plugins.module_utils.%s.__init__ import %s%s%s"
+                        % (
+                            match.group(1),
+                            bytes(_namespace, "utf-8"),
+                            bytes(_collection, "utf-8"),
+                            match.group(3),
+                            match.group(4),
+                            match.group(5),
+                            match.group(6),
+                        )
+                    )
+            if _module_utils.any_file(from_file0, from_file1, lfrom_file0, lfrom_file1):
+                return (
+                    b"%s ansible_collections.%s.%s.plugins.module_utils import %s%s%s"
+                    % (
+                        match.group(1),
+                        bytes(_namespace, "utf-8"),
+                        bytes(_collection, "utf-8"),
+                        match.group(4),
+                        match.group(5),
+                        match.group(6),
+                    )
+                )
+            else:
+                return (
+                    b"%s ansible_collections.%s.%s.plugins.module_utils.__init__ import %s%s%s"
+                    % (
+                        match.group(1),
+                        bytes(_namespace, "utf-8"),
+                        bytes(_collection, "utf-8"),
+                        match.group(4),
+                        match.group(5),
+                        match.group(6),
+                    )
                 )
+        return match.group(0)
+
+
+@functools.lru_cache(maxsize=256)
+def get_additional_rewrites_re(additional_rewrites):
+    """Return a regex matching any of the ansible.module_utils.MODULE names in
+    additional_rewrites, a tuple of module parts, and the dict of the names to
+    their replacements - the last part of the module name.  The names all have
+    the same prefix, so matching them in one pass gives the same result as
+    replacing them one after the other."""
+    replacements = {}
+    for parts in additional_rewrites:
+        name = b"ansible.module_utils.%s" % b".".join(parts)
+        replacements.setdefault(name, parts[-1])
+    rewrites_re = re.compile(b"|".join(re.escape(name) for name in replacements))
+    return rewrites_re, replacements
+
+
+def lsr_writefile(src, dest, data, copy_stat=True):
+    """Write data, the converted contents of the file src, to dest, unless dest
+    already has those contents.  The mode of src is copied if copy_stat is True.
+    An existing dest is replaced, not written through, like lsr_copyfile does."""
+    try:
+        dest_st = os.lstat(dest)
+    except OSError:
+        dest_st = None
+    if (
+        dest_st
+        and stat.S_ISREG(dest_st.st_mode)
+        and dest_st.st_size == len(data)
+        and Path(dest).read_bytes() == data
+    ):
+        logging.debug(f"{dest} is already up to date")
+    else:
+        if dest_st:
+            os.unlink(dest)
+        with open(dest, "wb") as f:
+            f.write(data)
+    if copy_stat:
+        copymode(src, dest)
+
+
+class LSRPipeline(object):
+    """Copy files into the collection, converting them on the way.
+
+    copy_file is a copy_function for lsr_copytree.  It only records the files
+    which have to be converted - the .yml files to transform, the files to
+    apply the string mappings to and the python files whose imports are to be
+    rewritten - and flush() converts them: each source file is read once, all
+    of the conversions are done in memory, and the result is written once to
+    the destination.  The other files are copied with lsr_copyfile right away.
+
+    The conversions are done in the same order as when the files are
+    converted in place after they are copied - transform, mappings, imports."""
+
+    def __init__(self, replacer=None, replace_dirs=(), rewrite_dirs=()):
+        """replacer - the LSRReplacer to apply to the files in replace_dirs,
+                      a list of (dir, file_patterns) tuples
+        rewrite_dirs - the dirs of the python files whose imports are rewritten"""
+        self.replacer = replacer
+        self.replace_dirs = [
+            (os.path.abspath(path), file_patterns)
+            for path, file_patterns in replace_dirs
+        ]
+        self.rewrite_dirs = [os.path.abspath(path) for path in rewrite_dirs]
+        # the LSRTransformer for the .yml files copied by copy_tree
+        self.transformer = None
+        # (src, dest, copy_stat, transformer, replace, rewrite) for each file
+        # to convert by flush()
+        self.pending = []
+        # the paths of the files which were transformed and which had the
+        # mappings applied by flush()
+        self.transformed = set()
+        self.replaced = set()
+        # copy_file may be called by several threads
+        self.lock = threading.Lock()
+
+    def update(self, other):
+        """Record the files converted by the LSRPipeline other as converted"""
+        self.transformed.update(other.transformed)
+        self.replaced.update(other.replaced)
+
+    @staticmethod
+    def in_dir(path, dirpath):
+        return path.startswith(dirpath + os.sep)
+
+    def copy_tree(self, src, dest, transformer=None, **kwargs):
+        """lsr_copytree src to dest with copy_file.  transformer is the
+        LSRTransformer for the .yml files in the tree."""
+        self.transformer = transformer
+        try:
+            lsr_copytree(src, dest, copy_function=self.copy_file, **kwargs)
+        finally:
+            self.transformer = None
+
+    def copy_file(self, src, dest, follow_symlinks=True, copy_stat=True):
+        """lsr_copyfile src to dest, or record it to be converted by flush().
+        Returns dest."""
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            dest = os.path.join(dest, os.path.basename(src))
+        dest = os.path.abspath(dest)
+        dirpath, filename = os.path.split(dest)
+        transformer = None
+        if self.transformer and LSRTransformer.is_yml_file(dirpath, filename):
+            transformer = self.transformer
+        replace = bool(
+            self.replacer
+            and self.replacer.steps
+            and any(
+                self.in_dir(dest, path)
+                and any(fnmatch.fnmatch(filename, fp) for fp in file_patterns)
+                for path, file_patterns in self.replace_dirs
             )
-        else:
-            return (
-                b"%s ansible_collections.%s.%s.plugins.module_utils.__init__ import %s%s%s"
-                % (
-                    match.group(1),
-                    bytes(_namespace, "utf-8"),
-                    bytes(_collection, "utf-8"),
-                    match.group(4),
-                    match.group(5),
-                    match.group(6),
+        )
+        rewrite = os.path.splitext(filename)[1] == ".py" and any(
+            self.in_dir(dest, path) for path in self.rewrite_dirs
+        )
+        if not follow_symlinks and os.path.islink(src):
+            lsr_copyfile(src, dest, follow_symlinks=False)
+            # the file the symlink points to is converted through the
+            # symlink, the same as when it is converted in place
+            src = None
+        elif not (transformer or replace or rewrite):
+            return lsr_copyfile(src, dest, copy_stat=copy_stat)
+        if transformer or replace or rewrite:
+            with self.lock:
+                self.pending.append(
+                    (src, dest, copy_stat, transformer, replace, rewrite)
                 )
+        return dest
+
+    def get_pending_files(self):
+        """Return the paths of the files which are not written yet"""
+        return [dest for src, dest, _, _, _, _ in self.pending if src]
+
+    def flush(self, rewrite_imports=None):
+        """Convert and write the recorded files.  rewrite_imports(paths, texts)
+        returns the texts of the python files with the imports rewritten."""
+        pending, self.pending = self.pending, []
+        datas = []
+        for src, dest, _, _, _, _ in pending:
+            if not src and not os.path.isfile(dest):
+                # dangling symlink
+                datas.append(None)
+                continue
+            with open(src or dest, "rb") as f:
+                datas.append(f.read())
+        new_datas = list(datas)
+
+        transformers = []
+        for _, _, _, transformer, _, _ in pending:
+            if transformer and transformer not in transformers:
+                transformers.append(transformer)
+        for transformer in transformers:
+            todo = [
+                idx
+                for idx, item in enumerate(pending)
+                if item[3] is transformer and datas[idx] is not None
+            ]
+            transformed = transformer.transform_texts(
+                [pending[idx][1] for idx in todo], [datas[idx] for idx in todo]
+            )
+            for idx, new_data in zip(todo, transformed):
+                new_datas[idx] = new_data
+                self.transformed.add(pending[idx][1])
+
+        for idx, (_, dest, _, _, replace, _) in enumerate(pending):
+            if replace and new_datas[idx] is not None:
+                new_datas[idx] = self.replacer.sub_data(new_datas[idx])
+                self.replaced.add(dest)
+
+        if rewrite_imports:
+            todo = [
+                idx
+                for idx, item in enumerate(pending)
+                if item[5] and datas[idx] is not None
+            ]
+            rewritten = rewrite_imports(
+                [Path(pending[idx][1]) for idx in todo],
+                [new_datas[idx] for idx in todo],
             )
-    return match.group(0)
+            for idx, new_data in zip(todo, rewritten):
+                new_datas[idx] = new_data
+
+        for (src, dest, copy_stat, _, _, _), data, new_data in zip(
+            pending, datas, new_datas
+        ):
+            if not src:
+                if new_data != data:
+                    with open(dest, "wb") as f:
+                        f.write(new_data)
+            elif new_data == data:
+                lsr_copyfile(src, dest, copy_stat=copy_stat)
+            else:
+                lsr_writefile(src, dest, new_data, copy_stat=copy_stat)
 
 
 def add_rolename(filename, rolename):
@@ -1080,15 +2587,10 @@ def add_rolename(filename, rolename):
 
 def process_ansible_lint(extra, dest, new_role):
     """Fixup paths to refer to collection."""
-    yml = YAML(typ="rt")
-    yml.default_flow_style = False
-    yml.preserve_quotes = True
-    yml.width = 1024
-    yml.explicit_start = True
+    yml = get_yaml_engine(explicit_start=True)
 
     with open(extra) as af_src:
-        ansible_lint = yml.load(af_src)
-        yml.indent(mapping=2, sequence=4, offset=2)
+        ansible_lint, tags = yaml_load(yml, af_src)
         with open(dest, "w") as af_dest:
             for key, items in list(ansible_lint.items()):
                 if key == "exclude_paths":
@@ -1099,13 +2601,1660 @@ def process_ansible_lint(extra, dest, new_role):
                             # make relative to collection role
                             new_item = "roles/" + new_role + "/" + item
                         ansible_lint["exclude_paths"][idx] = new_item
-            yml.dump(ansible_lint, af_dest)
+            yaml_dump(yml, ansible_lint, tags, af_dest)
+
+
+# Assume fedora is the default namespace and linux_system_roles is
+# the default collection.
+#
+# Input: "a-owner.role0:newrole0,\
+#         a-owner.role1:linux_system_roles.role1,\
+#         a-owner.role2:fedora.linux_system_roles.role2,\
+#         my_namespace.my_collection.role3:redhat.rhel_system_roles.role3,\
+#         my_namespace.my_collection.role4:linux_system_roles.role4,\
+#         my_namespace.my_collection.role5:role5,\
+#         my_namespace0.my_collection0:my_namespace1.my_collection1"
+# Output:
+# [
+#   {'src_name': {'src_owner': 'linux-system-roles', 'role': 'role0'},
+#    'dest_name': {'dest_prefix': None, 'role': 'newrole0'}},
+#   {'src_name': {'src_owner': 'a-owner', 'role': 'role1'},
+#    'dest_name': {'dest_prefix': 'fedora.linux_system_roles', 'role': 'role1'},
+#   {'src_name': {'src_owner': 'a-owner', 'role': 'role2'},
+#    'dest_name': {'dest_prefix': 'fedora.linux_system_roles', 'role': 'role2'}}
+# ],
+# [
+#   {'src_name': {'src_coll': 'my_namespace.my_collection.role3'},
+#    'dest_name': {'dest_coll': 'redhat.rhel_system_roles.role3}},
+#   {'src_name': {'src_coll': 'my_namespace.my_collection.role4'},
+#    'dest_name': {'dest_coll': 'fedora.linux_system_roles.role4}},
+#   {'src_name': {'src_coll': 'my_namespace.my_collection.role3'},
+#    'dest_name': {'dest_coll': 'fedora.linux_system_roles.role3'}},
+#   {'src_name': {'src_coll': 'my_namespace0.my_collection0'},
+#    'dest_name': {'dest_coll': 'my_namespace1.my_collection1'}},
+# ]
+# Note: Skip if the role in the given src_name is the role to be converted.
+def parse_extra_mapping(mapping_str, namespace, collection, role):
+    _mapping_list = mapping_str.split(",")
+    _mapping_role_list = []
+    _mapping_coll_list = []
+    for _map in _mapping_list:
+        _item = _map.split(":")
+        if len(_item) == 2:
+            # src and dest are identical
+            if _item[0] == _item[1]:
+                continue
+            _mapping_dict = {}
+            _src = _item[0].split(".")
+            _src_name = {}
+            if len(_src) == 1:
+                # "rolename"
+                if _src[0] == role:
+                    continue
+                _src_name["src_owner"] = None
+                _src_name["role"] = _src[0]
+                _mapping_dict["src_name"] = _src_name
+            elif len(_src) == 2:
+                # "linux-system-roles.rolename" or "fedora.linux_system_roles"
+                if _src[1] == role:
+                    continue
+                elif _src[0] == "fedora" and _src[1] == "linux_system_roles":
+                    _src_name["src_coll"] = _item[0]
+                else:
+                    _src_name["src_owner"] = _src[0]
+                    _src_name["role"] = _src[1]
+                _mapping_dict["src_name"] = _src_name
+            elif len(_src) == 3:
+                # FQCN
+                _src_name["src_coll"] = _item[0]
+                _mapping_dict["src_name"] = _src_name
+
+            _dest = _item[1].split(".")
+            _dest_name = {}
+            if len(_src) == 1 or len(_src) == 2:
+                if len(_dest) == 1:
+                    # "rolename"
+                    _dest_name["dest_prefix"] = None
+                    _dest_name["role"] = _dest[0]
+                elif len(_dest) == 2:
+                    # "collection.rolename" or "namespace.collection"
+                    if (_src[0] == "fedora" and _src[1] == "linux_system_roles") or (
+                        _dest[0] == namespace and _dest[1] == collection
+                    ):
+                        _dest_name["dest_coll"] = _item[1]
+                    else:
+                        _dest_name["dest_prefix"] = "{0}.{1}.".format(
+                            namespace, _dest[0]
+                        )
+                        _dest_name["role"] = _dest[1]
+                elif len(_dest) == 3:
+                    # "namespace.collection.rolename"
+                    _dest_name["dest_prefix"] = "{0}.{1}.".format(_dest[0], _dest[1])
+                    _dest_name["role"] = _dest[2]
+                _mapping_dict["dest_name"] = _dest_name
+                if (
+                    "dest_coll" in _dest_name.keys()
+                    and _dest_name["dest_coll"] == _item[1]
+                ):
+                    _mapping_coll_list.append(_mapping_dict)
+                else:
+                    _mapping_role_list.append(_mapping_dict)
+            elif len(_src) == 3:
+                if len(_dest) == 1:
+                    # "rolename"
+                    _dest_name["dest_coll"] = "{0}.{1}.{2}".format(
+                        namespace, collection, _item[1]
+                    )
+                elif len(_dest) == 2:
+                    # "collection.rolename"
+                    _dest_name["dest_coll"] = "{0}.{1}".format(namespace, _item[1])
+                elif len(_dest) == 3:
+                    # FQCN
+                    _dest_name["dest_coll"] = _item[1]
+                _mapping_dict["dest_name"] = _dest_name
+                _mapping_coll_list.append(_mapping_dict)
+            else:
+                print("ERROR: Ignoring invalid extra-mapping value {0}".format(_map))
+    return _mapping_role_list, _mapping_coll_list
+
+
+class LSRCollectionReadme(object):
+    """The links to the role README files in the collection README.md.
+
+    The README is free text with sections of links, each one a comment line,
+    e.g. "### Supported Roles", a blank line, and the list of links between
+    <!--ts--> and <!--te-->.  The links of all of the roles are added to the
+    model, and the README is rendered and written once.  The model can be
+    loaded from an existing collection README.md, so that a later run adds
+    its links to the ones already there."""
+
+    SECTION_RE = re.compile(
+        r"^([^\n]*)\n\n<!--ts-->\n(.*?)<!--te-->", flags=re.M | re.S
+    )
+    LINK_RE = re.compile(r"^ *\* (.*?)\r?$", flags=re.M)
+
+    def __init__(self, text):
+        # parts of the README - the text between the sections, and the
+        # comment of each section, which is a key in self.sections
+        self.parts = []
+        # comment: list of the link lines of the section
+        self.sections = {}
+        self.titles = set()
+        self.changed = False
+        start = 0
+        for match in self.SECTION_RE.finditer(text):
+            comment, links = match.group(1), match.group(2)
+            if comment in self.sections:
+                # only the first section with a comment is updated
+                continue
+            end = match.start()
+            self.parts.append(text[start:end])
+            self.parts.append((comment,))
+            self.sections[comment] = [links] if links else []
+            self.titles.update(self.LINK_RE.findall(links))
+            start = match.end()
+        self.parts.append(text[start:])
+
+    @classmethod
+    def load(cls, path):
+        """Return the model of the existing collection README.md path"""
+        with open(path, encoding="utf-8") as f:
+            return cls(f.read())
+
+    @classmethod
+    def from_template(cls, readme_path, namespace, collection):
+        """Return the model of a new collection README.md, which starts with
+        the contents of readme_path, or with a title if it is not given"""
+        if readme_path and Path(readme_path).exists():
+            with open(readme_path, encoding="utf-8") as f:
+                text = f.read()
+        else:
+            text = textwrap.dedent("""\
+                # {0} {1} collections
+                """).format(namespace, collection)
+        return cls(text + "\n")
+
+    def add_link(self, filename, rolename, comment):
+        """Add a link to the README filename of rolename in the section
+        comment, unless the README already has a link with its title"""
+        if not filename.startswith("README"):
+            return
+        if filename == "README.md":
+            title = rolename
+        else:
+            m = re.match(r"README(.*)(\.md)", filename)
+            title = rolename + m.group(1)
+        if title in self.titles:
+            return
+        if comment not in self.sections:
+            self.parts.extend(["\n", (comment,), "\n"])
+            self.sections[comment] = []
+        self.sections[comment].append("  * {0}\n".format(title))
+        self.titles.add(title)
+        self.changed = True
+
+    def render(self):
+        """Return the text of the README"""
+        text = []
+        for part in self.parts:
+            if isinstance(part, tuple):
+                comment = part[0]
+                text.append(comment + "\n\n<!--ts-->\n")
+                text.extend(self.sections[comment])
+                text.append("<!--te-->")
+            else:
+                text.append(part)
+        return "".join(text)
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+
+
+def update_readme(
+    main_doc, readme_path, namespace, collection, filename, rolename, comment
+):
+    """Add a link to the README filename of rolename to the collection
+    README.md main_doc, in the list under comment"""
+    if main_doc.exists():
+        readme = LSRCollectionReadme.load(main_doc)
+    else:
+        readme = LSRCollectionReadme.from_template(readme_path, namespace, collection)
+    readme.add_link(filename, rolename, comment)
+    if readme.changed:
+        readme.write(main_doc)
+
+
+def get_roles_from_release_yml(release_yml):
+    """Return the names of the roles listed in a collection_release.yml file"""
+    with open(release_yml, encoding="utf-8") as f:
+        coll_rel = YAML(typ="safe").load(f)
+    return [role for role in coll_rel if role != "mainid"]
+
+
+# Directories in memory, in which --dry-run stages the converted collection
+DRY_RUN_STAGING_DIRS = ("/dev/shm",)
+
+
+def get_staging_dir():
+    """Return the directory in which to stage a --dry-run conversion - in
+    memory if possible, else None for the default temporary directory"""
+    for staging_dir in DRY_RUN_STAGING_DIRS:
+        if os.path.isdir(staging_dir) and os.access(staging_dir, os.W_OK):
+            return staging_dir
+    return None
+
+
+def lsr_stagefile(src, dest, follow_symlinks=True, copy_stat=True):
+    """Copy the file src to the new file dest, keeping its mode and times.
+    Unlike lsr_copyfile, the copy is never a hardlink, so that it can be
+    written through without changing src."""
+    if not follow_symlinks and os.path.islink(src):
+        os.symlink(os.readlink(src), dest)
+        return dest
+    fast_copyfile(src, dest)
+    copystat(src, dest)
+    return dest
+
+
+def list_tree_files(top):
+    """Return the set of the paths relative to top of the files and symlinks
+    in the tree top"""
+    paths = set()
+    for root, dirs, files in os.walk(top):
+        # os.walk lists the symlinks to directories in dirs
+        links = [name for name in dirs if os.path.islink(os.path.join(root, name))]
+        for name in files + links:
+            paths.add(os.path.relpath(os.path.join(root, name), top))
+    return paths
+
+
+def read_tree_file(path):
+    """Return the contents of the file path as bytes - for a symlink, its
+    target"""
+    if os.path.islink(path):
+        return "symlink to {0}\n".format(os.readlink(path)).encode("utf-8")
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def get_tree_file_mode(path):
+    """Return the mode of the file path as git records it"""
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        return "120000"
+    if st.st_mode & stat.S_IXUSR:
+        return "100755"
+    return "100644"
+
+
+def diff_trees(old_top, new_top):
+    """Compare the tree new_top to the tree old_top.  Return the sorted list
+    of (status, path) for the files and symlinks which differ, where status is
+    "A" if path was added, "D" if it was deleted, or "M" if it was modified -
+    its contents, symlink target or executable bits."""
+    old_paths = list_tree_files(old_top) if os.path.isdir(old_top) else set()
+    new_paths = list_tree_files(new_top)
+    changes = [("A", path) for path in new_paths - old_paths]
+    changes.extend(("D", path) for path in old_paths - new_paths)
+    for path in old_paths & new_paths:
+        old_path = os.path.join(old_top, path)
+        new_path = os.path.join(new_top, path)
+        if get_tree_file_mode(old_path) != get_tree_file_mode(new_path):
+            changes.append(("M", path))
+        elif read_tree_file(old_path) != read_tree_file(new_path):
+            changes.append(("M", path))
+    return sorted(changes, key=itemgetter(1))
+
+
+def get_tree_file_diff(old_path, new_path, label):
+    """Return the unified diff of the file old_path, which is missing if
+    None, and the file new_path, which is missing if None, as a string"""
+    lines = []
+    old_mode = get_tree_file_mode(old_path) if old_path else None
+    new_mode = get_tree_file_mode(new_path) if new_path else None
+    if old_mode and new_mode and old_mode != new_mode:
+        lines.append("old mode {0}\nnew mode {1}\n".format(old_mode, new_mode))
+    old_data = read_tree_file(old_path) if old_path else b""
+    new_data = read_tree_file(new_path) if new_path else b""
+    if old_data == new_data:
+        return "diff a/{0} b/{0}\n{1}".format(label, "".join(lines))
+    old_file = "a/" + label if old_path else "/dev/null"
+    new_file = "b/" + label if new_path else "/dev/null"
+    try:
+        old_text = old_data.decode("utf-8").splitlines(keepends=True)
+        new_text = new_data.decode("utf-8").splitlines(keepends=True)
+    except UnicodeDecodeError:
+        lines.append("Binary files {0} and {1} differ\n".format(old_file, new_file))
+    else:
+        for line in difflib.unified_diff(old_text, new_text, old_file, new_file):
+            lines.append(line if line.endswith("\n") else line + "\n")
+    return "diff a/{0} b/{0}\n{1}".format(label, "".join(lines))
+
+
+# inotify(7) events
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class LSRWatcher(object):
+    """Watch the source trees of the roles for changes with inotify(7).
+
+    Every directory of the trees is watched, except the .git directories.
+    A file or directory which is renamed is reported as changed under both of
+    its names, so that it is deleted under the old name and created under the
+    new one."""
+
+    MASK = (
+        IN_ATTRIB
+        | IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_DELETE_SELF
+        | IN_MOVE_SELF
+    )
+
+    def __init__(self, paths, delay=0.2):
+        """paths - the trees to watch
+        delay - the time in seconds without any change after which the
+                changes are reported"""
+        self.delay = delay
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise LSRException("--watch requires inotify, which is not available.")
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise LSRException(f"inotify_init1 failed: {os.strerror(err)}")
+        # the watched dir of each watch descriptor
+        self.dirs = {}
+        for path in paths:
+            self.add_tree(path)
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_tree(self, top):
+        """Watch top and every directory under it"""
+        for dirpath, dirs, _ in os.walk(top):
+            dirs[:] = [name for name in dirs if name != ".git"]
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dirpath), ctypes.c_uint32(self.MASK)
+            )
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOENT:
+                    # removed in the meantime
+                    continue
+                msg = f"Cannot watch {dirpath}: {os.strerror(err)}."
+                if err == errno.ENOSPC:
+                    msg += "  Increase the fs.inotify.max_user_watches limit."
+                raise LSRException(msg)
+            self.dirs[wd] = dirpath
+
+    def read_events(self, paths):
+        """Read the pending events, and add the changed files and directories
+        to paths.  Returns False if the event queue overflowed, i.e. if some
+        changes may be missing."""
+        complete = True
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            end = offset + length
+            name = os.fsdecode(data[offset:end].rstrip(b"\0"))
+            offset = end
+            if mask & IN_Q_OVERFLOW:
+                complete = False
+                continue
+            dirpath = self.dirs.get(wd)
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            if dirpath is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue
+            path = os.path.join(dirpath, name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                if name != ".git":
+                    self.add_tree(path)
+            paths.add(path)
+        return complete
+
+    def wait(self):
+        """Wait for changes, and return the set of the changed paths, once
+        nothing has changed for delay seconds.  Returns None if some changes
+        may be missing."""
+        paths = set()
+        complete = True
+        timeout = None
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                return paths if complete else None
+            complete = self.read_events(paths) and complete
+            timeout = self.delay
+
+
+class LSRScheduler(object):
+    """Run the steps of the conversion of a role, each one as soon as the
+    steps it depends on are done.
+
+    With jobs greater than 1, the steps run in a pool of that many threads -
+    the steps mostly copy files, and transform the .yml files in the process
+    pool of --jobs - otherwise they run one by one, in the order in which
+    they were added.  Steps which write the same files must depend on each
+    other."""
+
+    def __init__(self, jobs=1, role=None):
+        """role - the role to attribute the profiled phases of the steps to"""
+        self.jobs = jobs
+        self.role = role
+        # (func, args, kwargs, deps) of each step
+        self.steps = []
+
+    def add(self, func, *args, deps=(), **kwargs):
+        """Add a step which calls func(*args, **kwargs) once the steps deps
+        are done.  Returns the step, to give in the deps of other steps."""
+        step = len(self.steps)
+        self.steps.append((func, args, kwargs, tuple(deps)))
+        return step
+
+    def call(self, step):
+        func, args, kwargs, _ = self.steps[step]
+        with profile_role(self.role, timed=False):
+            return func(*args, **kwargs)
+
+    def run(self):
+        """Run the steps, and return the list of their results.  If a step
+        fails, no more steps are started, and once the running ones are done,
+        its exception is raised."""
+        if self.jobs <= 1:
+            return [func(*args, **kwargs) for func, args, kwargs, _ in self.steps]
+        results = [None] * len(self.steps)
+        todo = list(range(len(self.steps)))
+        done = set()
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while todo or running:
+                if error is None:
+                    ready = [
+                        step for step in todo if done.issuperset(self.steps[step][3])
+                    ]
+                    for step in ready:
+                        todo.remove(step)
+                        running[pool.submit(self.call, step)] = step
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    try:
+                        results[step] = future.result()
+                    except Exception as exc:
+                        if error is None:
+                            error = exc
+                        continue
+                    done.add(step)
+        if error is not None:
+            raise error
+        return results
+
+
+class LSRCollectionConverter(object):
+    """Convert one or more roles into a collection.
+
+    The state shared by all of the roles - the destination paths, the links
+    for the collection README.md, etc. - is kept here so that many roles can
+    be converted in one process.  The collection README.md and
+    meta/runtime.yml are written once, by finish()."""
+
+    def __init__(self, args):
+        global copy_mode, profiler
+        copy_mode = args.copy_mode
+        profiler = LSRProfiler() if args.profile else None
+        self.args = args
+        self.namespace = args.namespace
+        self.collection = args.collection
+        self.prefix = self.namespace + "." + self.collection + "."
+        top_dest_path = args.dest_path.resolve()
+        self.current_dest = os.path.expanduser(str(top_dest_path))
+        self.readme_path = args.readme
+        self.src_meta_runtime = Path(args.meta_runtime)
+
+        self.dest_path = Path.joinpath(
+            top_dest_path,
+            "ansible_collections/" + self.namespace + "/" + self.collection,
+        )
+        _tests_dest_path = args.tests_dest_path
+        if _tests_dest_path:
+            self.tests_dest_path = Path(_tests_dest_path)
+        else:
+            self.tests_dest_path = self.dest_path
+
+        # With --dry-run, the roles are converted into a copy of the collection
+        # in a staging directory, and finish() compares it with the collection.
+        # (collection path, staged path, label) for each staged tree
+        self.staged = []
+        self.staging = None
+        # (status, path) for each file which the conversion changes
+        self.changes = []
+        if args.dry_run:
+            self.stage(top_dest_path, bool(_tests_dest_path))
+
+        os.makedirs(self.dest_path, exist_ok=True)
+
+        self.roles_dir = self.dest_path / "roles"
+        self.tests_dir = self.tests_dest_path / "tests"
+        self.plugin_dir = self.dest_path / "plugins"
+        self.modules_dir = self.plugin_dir / "modules"
+        self.module_utils_dir = self.plugin_dir / "module_utils"
+        self.docs_dir = self.dest_path / "docs"
+        self.meta_dir = self.dest_path / "meta"
+
+        # (filename, rolename, comment) for each link in the collection README.md
+        self.readme_entries = []
+        # --extra-mapping FQCN0:FQCN1 pairs to apply to meta/runtime.yml
+        self.meta_mappings = []
+
+    def stage(self, top_dest_path, separate_tests):
+        """Copy the collection, and its tests if separate_tests, to a staging
+        directory, and convert the roles there instead.  The staged trees are
+        laid out like the real ones, so that the relative symlinks between
+        them are the same."""
+        self.staging = tempfile.TemporaryDirectory(
+            prefix="lsr-dry-run-", dir=get_staging_dir()
+        )
+        trees = [(self.dest_path, os.path.relpath(self.dest_path, top_dest_path))]
+        if separate_tests:
+            trees.append((self.tests_dest_path / "tests", "tests"))
+        common = os.path.commonpath([str(path) for path, _ in trees])
+        staging = Path(self.staging.name)
+        for path, label in trees:
+            staged_path = staging / os.path.relpath(path, common)
+            self.staged.append((path, staged_path, label))
+            if path.is_dir():
+                logging.info(f"Staging {path} in {staged_path}")
+                lsr_copytree(path, staged_path, copy_function=lsr_stagefile)
+        self.dest_path = self.staged[0][1]
+        if separate_tests:
+            self.tests_dest_path = self.staged[1][1].parent
+        else:
+            self.tests_dest_path = self.dest_path
+
+    def report_changes(self):
+        """Compare the staged trees with the collection, and print the diff,
+        or the list of the changed files if --dry-run files"""
+        for path, staged_path, label in self.staged:
+            for status, changed in diff_trees(path, staged_path):
+                changed_label = os.path.join(label, changed)
+                self.changes.append((status, changed_label))
+                if self.args.dry_run == "files":
+                    print("{0} {1}".format(status, changed_label))
+                    continue
+                sys.stdout.write(
+                    get_tree_file_diff(
+                        None if status == "A" else os.path.join(path, changed),
+                        None if status == "D" else os.path.join(staged_path, changed),
+                        changed_label,
+                    )
+                )
+
+    def role_converter(
+        self, role, new_role=None, subrole_prefix=None, extra_mapping=None
+    ):
+        """Return the LSRRoleConverter for role.  subrole_prefix and extra_mapping
+        default to the values given in the arguments."""
+        if subrole_prefix is None:
+            subrole_prefix = self.args.subrole_prefix
+        if extra_mapping is None:
+            extra_mapping = self.args.extra_mapping
+        return LSRRoleConverter(
+            self, role, new_role or role, subrole_prefix, extra_mapping
+        )
+
+    def add_role(self, role_conv):
+        """Record the README links and meta mappings of a converted role"""
+        self.add_entries(role_conv.readme_entries, role_conv.coll_mappings)
+
+    def add_entries(self, readme_entries, coll_mappings):
+        """Record README links and meta mappings, e.g. of a role converted
+        by another LSRCollectionConverter"""
+        self.readme_entries.extend(readme_entries)
+        for mapping in coll_mappings:
+            if mapping not in self.meta_mappings:
+                self.meta_mappings.append(mapping)
+
+    def convert_role_files(self, role_conv):
+        with profile_role(role_conv.new_role):
+            role_conv.convert_role_files()
+
+    def convert_shared_files(self, role_conv):
+        with profile_role(role_conv.new_role):
+            role_conv.convert_shared_files()
+        self.add_role(role_conv)
+
+    def convert_role(self, role, **kwargs):
+        """Convert role into the collection.  kwargs are passed to role_converter."""
+        role_conv = self.role_converter(role, **kwargs)
+        self.convert_role_files(role_conv)
+        self.convert_shared_files(role_conv)
+
+    def convert_roles(self, roles, jobs=1):
+        """Convert the roles into the collection.  roles is an iterable of
+        dicts of the keyword arguments for role_converter.
+
+        If jobs is greater than 1, the files private to each role - the role
+        dirs, tests and docs - are converted in a pool of jobs threads.  The
+        files shared with the other roles - plugins, module_utils imports,
+        extra files, etc. - are converted afterwards, one role at a time, in
+        the given order.  A role is submitted to the pool as soon as roles
+        yields it, so roles may be a generator which waits for the sources of
+        each role to be ready.  Returns the LSRRoleConverter of each role."""
+        start_xfrm_pool(self.args.jobs)
+        role_convs = []
+        if jobs > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = []
+                for role in roles:
+                    role_conv = self.role_converter(**role)
+                    role_convs.append(role_conv)
+                    futures.append(pool.submit(self.convert_role_files, role_conv))
+                for future in futures:
+                    future.result()
+            for role_conv in role_convs:
+                self.convert_shared_files(role_conv)
+        else:
+            for role in roles:
+                role_conv = self.role_converter(**role)
+                role_convs.append(role_conv)
+                self.convert_role_files(role_conv)
+                self.convert_shared_files(role_conv)
+        return role_convs
+
+    def finish(self):
+        """Write the collection README.md and meta/runtime.yml, and the
+        profile if --profile is given"""
+        main_doc = self.dest_path / "README.md"
+        with profile_phase("readme"):
+            if self.readme_entries:
+                if main_doc.exists():
+                    readme = LSRCollectionReadme.load(main_doc)
+                else:
+                    readme = LSRCollectionReadme.from_template(
+                        self.readme_path, self.namespace, self.collection
+                    )
+                for filename, rolename, comment in self.readme_entries:
+                    readme.add_link(filename, rolename, comment)
+                if readme.changed:
+                    readme.write(main_doc)
+
+        with profile_phase("runtime"):
+            if not self.meta_dir.exists():
+                self.meta_dir.mkdir()
+            copyfile(self.src_meta_runtime, self.meta_dir / "runtime.yml")
+            # Handle --extra-mapping FQCN0:FQCN1 or FQCN2:ROLE3
+            LSRReplacer(self.meta_mappings).replace_in_tree(
+                self.meta_dir, ["*.yml", "*.md"]
+            )
+
+        if self.staging:
+            with profile_phase("dry run"):
+                self.report_changes()
+            self.staging.cleanup()
+
+        if profiler:
+            profiler.save(self.args.profile, self.args.profile_top)
+
+        default_collections_paths = (
+            "~/.ansible/collections:/usr/share/ansible/collections"
+        )
+        default_collections_paths_list = list(
+            map(os.path.expanduser, default_collections_paths.split(":"))
+        )
+        # top_dest_path is not in the default collections path.
+        # suggest to run ansible-playbook with ANSIBLE_COLLECTIONS_PATH env var.
+        if self.current_dest not in default_collections_paths_list:
+            ansible_collections_paths = (
+                self.current_dest + ":" + default_collections_paths
+            )
+            logging.debug(
+                f"Run ansible-playbook with environment variable ANSIBLE_COLLECTIONS_PATH={ansible_collections_paths}"
+            )
+
+    def watch(self, roles, jobs=1):
+        """Convert the roles as convert_roles does, and then watch their
+        sources, and convert the changed files again, until interrupted.
+
+        The files which are only copied or transformed - the role dirs, the
+        tests, the python files of the existing plugins and the READMEs - are
+        converted one by one.  Any other change, e.g. to a sub-role, a symlink
+        or a new directory, converts the role again as a whole."""
+        role_convs = self.convert_roles(roles, jobs)
+        self.finish()
+        src_paths = [role_conv.src_path for role_conv in role_convs]
+        watcher = LSRWatcher(src_paths)
+        print("Watching {0} for changes".format(", ".join(map(str, src_paths))))
+        try:
+            while True:
+                paths = watcher.wait()
+                start = time.monotonic()
+                for idx, role_conv in enumerate(role_convs):
+                    if paths is None:
+                        role_paths = None
+                    else:
+                        prefix = str(role_conv.src_path) + os.sep
+                        role_paths = [path for path in paths if path.startswith(prefix)]
+                        if not role_paths:
+                            continue
+                    try:
+                        if role_paths and role_conv.update_files(role_paths):
+                            what = "{0} changed files of {1}".format(
+                                len(role_paths), role_conv.role
+                            )
+                        else:
+                            what = role_conv.role
+                            self.readme_entries = []
+                            role_convs[idx] = self.convert_roles([roles[idx]])[0]
+                            self.finish()
+                    except Exception as exc:
+                        # e.g. a file is saved while it is being edited
+                        logging.error(f"Converting {role_conv.role} failed: {exc}")
+                        continue
+                    print(
+                        "Converted {0} in {1:.2f}s".format(
+                            what, time.monotonic() - start
+                        )
+                    )
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+
+class LSRRoleConverter(object):
+    """Convert one role into the collection of an LSRCollectionConverter"""
+
+    # the files in the tests dir which are not copied to the collection
+    TESTS_IGNORE = [
+        "artifacts",
+        "linux-system-roles.*",
+        "__pycache__",
+        ".git*",
+        "ansible-sshd",
+    ]
+
+    def __init__(self, coll, role, new_role, subrole_prefix, extra_mapping_str):
+        self.coll = coll
+        self.role = role
+        self.new_role = new_role
+        self.subrole_prefix = subrole_prefix
+        namespace = coll.namespace
+        collection = coll.collection
+        args = coll.args
+
+        self.extra_mapping, self.extra_coll_mapping = parse_extra_mapping(
+            extra_mapping_str, namespace, collection, role
+        )
+        # Replacing SRC_OWNER.ROLE with FQCN
+        self.coll_mappings = [
+            (_emap["src_name"]["src_coll"], _emap["dest_name"]["dest_coll"])
+            for _emap in self.extra_coll_mapping
+        ]
+
+        extra_mapping_src_owner = list(
+            map(
+                itemgetter("src_owner"),
+                list(map(itemgetter("src_name"), self.extra_mapping)),
+            )
+        )
+        extra_mapping_src_role = list(
+            map(
+                itemgetter("role"),
+                list(map(itemgetter("src_name"), self.extra_mapping)),
+            )
+        )
+        extra_mapping_dest_prefix = list(
+            map(
+                itemgetter("dest_prefix"),
+                list(map(itemgetter("dest_name"), self.extra_mapping)),
+            )
+        )
+        extra_mapping_dest_role = list(
+            map(
+                itemgetter("role"),
+                list(map(itemgetter("dest_name"), self.extra_mapping)),
+            )
+        )
+
+        src_path = args.src_path.resolve()
+        src_owner = args.src_owner
+        if not src_owner:
+            src_owner = os.path.basename(src_path)
+        _tasks_main = src_path / "tasks/main.yml"
+        if not _tasks_main.exists():
+            src_path = src_path / role
+            _tasks_main = src_path / "tasks/main.yml"
+
+        if not _tasks_main.exists():
+            raise LSRException(
+                f"Neither {src_path} nor {src_path.parent} is a role top directory."
+            )
+        self.src_path = src_path
+        self.src_owner = src_owner
+
+        extra_script = args.extra_script
+        if extra_script and not which(extra_script):
+            raise LSRException(f"The extra-script {extra_script} is not an executable.")
+        elif not extra_script:
+            extra_script = src_path / EXTRA_SCRIPT
+            if not which(extra_script):
+                extra_script = None
+        self.extra_script = extra_script
+
+        _extras = set(os.listdir(src_path)).difference(ALL_DIRS)
+        for dir in (".git", "plans"):
+            try:
+                _extras.remove(dir)
+            except KeyError:
+                pass
+        self.extras = [src_path / e for e in _extras]
+
+        self.transformer_args = {
+            "namespace": namespace,
+            "collection": collection,
+            "prefix": coll.prefix,
+            "subrole_prefix": subrole_prefix,
+            "replace_dot": args.replace_dot,
+            # get role modules - will need to find and convert these to use FQCN
+            "role_modules": get_role_modules(src_path),
+            "src_owner": src_owner,
+            "top_dir": coll.current_dest,
+            "extra_mapping_src_owner": extra_mapping_src_owner,
+            "extra_mapping_src_role": extra_mapping_src_role,
+            "extra_mapping_dest_prefix": extra_mapping_dest_prefix,
+            "extra_mapping_dest_role": extra_mapping_dest_role,
+            "jobs": args.jobs,
+            "cache_dir": args.cache_dir,
+        }
+
+        # (filename, rolename, comment) for each link in the collection README.md
+        self.readme_entries = []
+
+        self.pipeline = None
+        if args.pipeline:
+            self.pipeline = self.get_pipeline()
+
+    def get_subroles(self):
+        """Return the list of (src, new name) of the sub-roles in the roles dir"""
+        subroles = []
+        roles = self.src_path / "roles"
+        if roles in self.extras and roles.is_dir():
+            replace_dot = self.coll.args.replace_dot
+            for sr in roles.iterdir():
+                # If a role name contains '.', replace it with replace_dot
+                # convert nested subroles to prefix name with subrole_prefix.
+                dr = sr.name.replace(".", replace_dot)
+                if self.subrole_prefix and not dr.startswith(self.subrole_prefix):
+                    dr = self.subrole_prefix + dr
+                subroles.append((sr, dr))
+        return subroles
+
+    def get_pipeline(self):
+        """Return the LSRPipeline which converts the files of the role while
+        they are copied"""
+        coll = self.coll
+        replace_dirs = []
+        # The --extra-mapping FQCN mappings are applied after the extra script
+        # is run and after the renamed sub-roles are replaced, so they can only
+        # be applied while copying if there is neither.  The .md files in the
+        # roles dir get the README mappings first, so they are left to
+        # convert_shared_files.
+        if not self.extra_script and all(
+            sr.name == dr for sr, dr in self.get_subroles()
+        ):
+            replace_dirs.append((coll.roles_dir / self.new_role, ["*.yml"]))
+            replace_dirs.extend(
+                (coll.roles_dir / dr, ["*.yml"]) for _, dr in self.get_subroles()
+            )
+            replace_dirs.append((coll.tests_dir / self.new_role, ["*.yml", "*.md"]))
+            replace_dirs.append((coll.docs_dir / self.new_role, ["*.yml", "*.md"]))
+        return LSRPipeline(
+            LSRReplacer(self.coll_mappings),
+            replace_dirs,
+            [coll.module_utils_dir, coll.modules_dir],
+        )
+
+    def copy_tree(self, src_path, dest_path, role, new_role, TUPLE, **kwargs):
+        """copy_tree_with_replace, with an LSRPipeline of its own if
+        --pipeline, so that several trees can be copied at once.  Returns the
+        LSRPipeline, or None."""
+        pipeline = self.get_pipeline() if self.pipeline else None
+        copy_tree_with_replace(
+            src_path,
+            dest_path,
+            role,
+            new_role,
+            TUPLE,
+            self.transformer_args,
+            pipeline=pipeline,
+            **kwargs,
+        )
+        return pipeline
+
+    def copy_docs(self):
+        """Copy the docs dirs of the role to the docs dir of the collection.
+        Returns the LSRPipeline which converted them, or None."""
+        coll = self.coll
+        role = self.role
+        new_role = self.new_role
+        pipeline = self.get_pipeline() if self.pipeline else None
+        ignoreme = ["linux-system-roles.*"]
+        dest = coll.docs_dir / new_role
+        for doc in DOCS:
+            src = self.src_path / doc
+            if src.is_dir():
+                logging.info(f"Copying docs {src} to {dest}")
+                lsrxfrm = LSRTransformer(
+                    dest,
+                    self.transformer_args,
+                    False,
+                    role,
+                    new_role,
+                    LSRFileTransformer,
+                )
+                if pipeline:
+                    # all of the .yml files in the docs are transformed
+                    # eventually - see convert_shared_files
+                    with profile_phase("pipeline"):
+                        pipeline.copy_tree(
+                            src,
+                            dest,
+                            lsrxfrm,
+                            symlinks=False,
+                            ignore=ignore_patterns(*ignoreme),
+                            dirs_exist_ok=True,
+                        )
+                        pipeline.flush()
+                else:
+                    with profile_phase("copy"):
+                        lsr_copytree(
+                            src,
+                            dest,
+                            symlinks=False,
+                            ignore=ignore_patterns(*ignoreme),
+                            dirs_exist_ok=True,
+                        )
+                    if doc == "examples":
+                        with profile_phase("transform"):
+                            lsrxfrm.run()
+        return pipeline
+
+    def cleanup_symlinks(self, path, role, rmlist):
+        """Remove the symlinks of the tree path, see LSRSymlinks.cleanup.
+        Returns the LSRSymlinks of the remaining symlinks."""
+        with profile_phase("symlinks"):
+            symlinks = LSRSymlinks(path)
+            symlinks.cleanup(role, rmlist)
+        return symlinks
+
+    def convert_role_files(self):
+        """Convert the files which belong only to this role - the role dirs,
+        the tests and the docs.  The steps which write different trees run
+        at once with --phase-jobs."""
+        coll = self.coll
+        src_path = self.src_path
+        role = self.role
+        new_role = self.new_role
+        sched = LSRScheduler(coll.args.phase_jobs, new_role)
+
+        # Role - copy subdirectories, tasks, defaults, vars, etc., in the system role to
+        # DEST_PATH/ansible_collections/NAMESPACE/COLLECTION/roles/ROLE.
+        role_steps = [
+            sched.add(
+                self.copy_tree, src_path, coll.dest_path, role, new_role, (dirname,)
+            )
+            for dirname in ROLE_DIRS
+        ]
+
+        # ==============================================================================
+
+        tests_step = sched.add(
+            self.copy_tree,
+            src_path,
+            coll.tests_dest_path,
+            role,
+            new_role,
+            TESTS,
+            isrole=False,
+            ignoreme=self.TESTS_IGNORE,
+        )
+
+        # remove symlinks in the tests/role.  The remaining symlinks are
+        # converted by convert_shared_files once the plugins are copied.
+        removeme = ["library", "modules", "module_utils", "roles"]
+        tests_symlinks_step = sched.add(
+            self.cleanup_symlinks,
+            coll.tests_dir / new_role,
+            role,
+            removeme,
+            deps=[tests_step],
+        )
+
+        # ==============================================================================
+
+        # The docs dirs are all copied to docs/ROLE, one after the other.
+        docs_step = sched.add(self.copy_docs)
+        # The README mappings are applied to all of the .md files in roles/ROLE.
+        sched.add(self.process_readmes, deps=role_steps)
+
+        # Remove symlinks in the docs/role (e.g., in the examples).
+        sched.add(
+            self.cleanup_symlinks,
+            coll.docs_dir / new_role,
+            new_role,
+            removeme,
+            deps=[docs_step],
+        )
+
+        results = sched.run()
+        self.tests_symlinks = results[tests_symlinks_step]
+        if self.pipeline:
+            for step in role_steps + [tests_step, docs_step]:
+                self.pipeline.update(results[step])
 
+    def process_readmes(self):
+        """process_readme the READMEs and the other doc files of the role"""
+        for doc in DOCS:
+            if (self.src_path / doc).is_file():
+                self.process_readme(self.src_path, doc, self.role, self.new_role)
 
-config = {}
+    # Copy docs, design_docs, and examples to
+    # DEST_PATH/ansible_collections/NAMESPACE/COLLECTION/docs/ROLE.
+    # Copy README.md to DEST_PATH/ansible_collections/NAMESPACE/COLLECTION/roles/ROLE.
+    # Generate a top level README.md which contains links to roles/ROLE/README.md.
+    def process_readme(
+        self, src_path, filename, role, new_role, original=None, issubrole=False
+    ):
+        """
+        Copy src_path/filename to dest_path/docs/new_role.
+        filename could be README.md, README-something.md, or something.md.
+        Record a link for the primary README.md in dest_path, which points to
+        dest_path/docs/new_role/filename with the title new_role or new_role-something.
+        """
+        with profile_phase("readme"):
+            prefix = self.coll.prefix
+            src_owner = self.src_owner
+            src = src_path / filename
+            dest = self.coll.roles_dir / new_role / filename
+            # copy
+            logging.info(f"Copying doc {filename} to {dest}")
+            copy2(src, dest, follow_symlinks=False)
+            dest = self.coll.roles_dir / new_role
+            file_patterns = ["*.md", "*.html"]
+            mappings = [(src_owner + "." + role, prefix + new_role)]
+            # --extra-mapping SRCROLENAME:DESTROLENAME(or FQCN)
+            for _emap in self.extra_mapping:
+                # Replacing SRC_OWNER.ROLE with FQCN
+                _from = "{0}.{1}".format(
+                    (
+                        _emap["src_name"]["src_owner"]
+                        if _emap["src_name"]["src_owner"]
+                        else src_owner
+                    ),
+                    _emap["src_name"]["role"],
+                )
+                _to = "{0}{1}".format(
+                    (
+                        _emap["dest_name"]["dest_prefix"]
+                        if _emap["dest_name"]["dest_prefix"]
+                        else prefix
+                    ),
+                    _emap["dest_name"]["role"],
+                )
+                mappings.append((_from, _to))
+                # Replacing unprefixed ROLE with FQCN
+                _from = " {0}".format(_emap["src_name"]["role"])
+                _to = " {0}{1}".format(
+                    (
+                        _emap["dest_name"]["dest_prefix"]
+                        if _emap["dest_name"]["dest_prefix"]
+                        else prefix
+                    ),
+                    _emap["dest_name"]["role"],
+                )
+                mappings.append((_from, _to))
+            if original:
+                mappings.append((original, prefix + new_role))
+            LSRReplacer(mappings).replace_in_tree(dest, file_patterns)
+            if filename == "README.md":
+                if issubrole:
+                    comment = "### Private Roles"
+                else:
+                    comment = "### Supported Roles"
+                self.readme_entries.append((filename, new_role, comment))
+
+    def get_import_rewriter(self, pending=()):
+        """Return the LSRImportRewriter for the python files of the role.
+        pending are the paths of the files which are copied to the collection
+        but are not written yet."""
+        coll = self.coll
+        module_utils_dir = coll.module_utils_dir
+        module_utils = gather_module_utils_parts(module_utils_dir)
+        for path in pending:
+            if (
+                path.startswith(str(module_utils_dir) + os.sep)
+                and os.path.splitext(path)[1] == ".py"
+            ):
+                module_utils.append(get_module_utils_parts(module_utils_dir, path))
+        index = LSRModuleUtilsIndex(
+            module_utils, [self.src_path / "module_utils", module_utils_dir]
+        )
+        for path in pending:
+            index.add_file(path)
+        return LSRImportRewriter(
+            coll.namespace,
+            coll.collection,
+            self.new_role,
+            self.src_path,
+            coll.dest_path,
+            module_utils_dir,
+            index,
+        )
+
+    def rewrite_imports(self, rewriter, paths, texts):
+        """Return the texts of the python files paths with the imports
+        rewritten by rewriter, taking them from the conversion cache if the
+        same texts were rewritten before"""
+        coll = self.coll
+        cache = get_xfrm_cache(coll.args.cache_dir)
+        new_texts = [None] * len(texts)
+        if cache:
+            # the rewrite depends on which module_utils exist in the source
+            # and in the collection
+            context = cache.context(
+                "imports",
+                coll.namespace,
+                coll.collection,
+                self.new_role,
+                self.src_path,
+                rewriter.module_utils.get_listing(),
+            )
+            keys = [cache.make_key(context, text) for text in texts]
+            new_texts = [cache.get(key) for key in keys]
+        todo = [idx for idx, new_text in enumerate(new_texts) if new_text is None]
+        rewritten = rewriter.rewrite_texts_timed(
+            [texts[idx] for idx in todo], coll.args.jobs
+        )
+        for idx, (new_text, times) in zip(todo, rewritten):
+            new_texts[idx] = new_text
+            profile_file("imports", paths[idx], times)
+            if cache:
+                cache.put(keys[idx], new_text)
+        if cache:
+            cache.save()
+        for path, text, new_text in zip(paths, texts, new_texts):
+            if text != new_text:
+                logging.info("Rewriting imports for {}".format(path))
+        return new_texts
+
+    def copy_plugin(self, plugin):
+        """Copy the plugin dir of the role to the plugins dir of the
+        collection"""
+        coll = self.coll
+        pipeline = self.pipeline
+        if pipeline:
+            copy_function = pipeline.copy_file
+        else:
+            copy_function = lsr_copyfile
+        src = self.src_path / plugin
+        plugin_name = dir_to_plugin(plugin)
+        # Library and plugins are copied to dest_path/plugins
+        # If plugin is in SUBDIR (currently, just module_utils),
+        #   module_utils/*.py are to dest_path/plugins/module_utils/ROLE/*.py
+        #   module_utils/subdir/*.py are to dest_path/plugins/module_utils/subdir/*.py
+        SUBDIR = ("module_utils",)
+        with profile_phase("copy"):
+            if plugin in SUBDIR:
+                for sr in src.iterdir():
+                    if sr.is_dir():
+                        # If src/sr is a directory, copy it to the dest
+                        dest = coll.plugin_dir / plugin_name / sr.name
+                        logging.info(f"Copying plugin {sr} to {dest}")
+                        lsr_copytree(sr, dest, copy_function=copy_function)
+                    else:
+                        # Otherwise, copy it to the plugins/plugin_name/ROLE
+                        dest = coll.plugin_dir / plugin_name / self.new_role
+                        dest.mkdir(parents=True, exist_ok=True)
+                        logging.info(f"Copying plugin {sr} to {dest}")
+                        if pipeline:
+                            pipeline.copy_file(sr, dest, follow_symlinks=False)
+                        else:
+                            copy2(sr, dest, follow_symlinks=False)
+            else:
+                dest = coll.plugin_dir / plugin_name
+                logging.info(f"Copying plugin {src} to {dest}")
+                lsr_copytree(src, dest, copy_function=copy_function)
+
+    def flush_plugins(self):
+        """Write the plugins copied by the LSRPipeline, with the imports
+        rewritten"""
+        pipeline = self.pipeline
+        with profile_phase("pipeline"):
+            rewriter = self.get_import_rewriter(pipeline.get_pending_files())
+            pipeline.flush(functools.partial(self.rewrite_imports, rewriter))
+
+    def rewrite_plugin_imports(self):
+        """Rewrite the imports of the python files in the plugins dirs of the
+        collection"""
+        coll = self.coll
+        with profile_phase("imports"):
+            rewriter = self.get_import_rewriter()
+            rewrite_paths = []
+            for rewrite_dir in (coll.module_utils_dir, coll.modules_dir):
+                if rewrite_dir.is_dir():
+                    for root, dirs, files in os.walk(rewrite_dir):
+                        for filename in files:
+                            if os.path.splitext(filename)[1] == ".py":
+                                rewrite_paths.append(Path(root) / filename)
+            texts = [full_path.read_bytes() for full_path in rewrite_paths]
+            new_texts = self.rewrite_imports(rewriter, rewrite_paths, texts)
+            for full_path, text, new_text in zip(rewrite_paths, texts, new_texts):
+                if text != new_text:
+                    full_path.write_bytes(new_text)
+
+    def convert_symlinks(self, symlinks, new_role):
+        """Convert the symlinks in the tests plugin dirs of the LSRSymlinks
+        symlinks to point to the collection plugins"""
+        with profile_phase("symlinks"):
+            symlinks.convert_plugins(new_role, self.coll.dest_path)
+
+    def convert_subrole_symlinks(self, path, new_role, rmlist):
+        """Remove the symlinks of the sub-role tests path, and convert the
+        ones to the plugins"""
+        symlinks = self.cleanup_symlinks(path, new_role, rmlist)
+        self.convert_symlinks(symlinks, new_role)
+
+    def convert_shared_files(self):
+        """Convert the files which are shared with the other roles in the
+        collection - the plugins, the extra files and the sub-roles - and
+        run the extra script"""
+        coll = self.coll
+        src_path = self.src_path
+        role = self.role
+        new_role = self.new_role
+        subrole_prefix = self.subrole_prefix
+        namespace = coll.namespace
+        collection = coll.collection
+        transformer_args = self.transformer_args
+        dest_path = coll.dest_path
+        tests_dest_path = coll.tests_dest_path
+        roles_dir = coll.roles_dir
+        tests_dir = coll.tests_dir
+        docs_dir = coll.docs_dir
+
+        pipeline = self.pipeline
+        sched = LSRScheduler(coll.args.phase_jobs, new_role)
+
+        # Copy library, module_utils, plugins
+        plugin_steps = [
+            sched.add(self.copy_plugin, plugin)
+            for plugin in PLUGINS
+            if (src_path / plugin).is_dir()
+        ]
+
+        if pipeline:
+            # The imports are rewritten while the python files are written, so
+            # the rewriter has to know the module_utils which are not written yet.
+            # Only the python files of this role are rewritten.
+            plugin_steps = [sched.add(self.flush_plugins, deps=plugin_steps)]
+        else:
+            # Update the python codes which import modules in plugins/{modules,modules_dir}.
+            sched.add(self.rewrite_plugin_imports, deps=plugin_steps)
+
+        # Convert symlinks in tests plugin directories to point to collection plugins.
+        sched.add(
+            self.convert_symlinks, self.tests_symlinks, new_role, deps=plugin_steps
+        )
+
+        # Copying sub-roles to the roles dir and their tests is also handled in the
+        # same way as the parent role's is.  Their READMEs are processed with the
+        # other extra files.
+        subrole_steps = []
+        removeme = ["library", "modules", "module_utils", "roles"]
+        for sr, dr in self.get_subroles():
+            subrole_steps.append(
+                sched.add(self.copy_tree, sr, dest_path, dr, dr, ROLE_DIRS)
+            )
+            # copy tests dir to dest_path/"tests"
+            tests_step = sched.add(
+                self.copy_tree,
+                sr,
+                tests_dest_path,
+                dr,
+                dr,
+                TESTS,
+                isrole=False,
+                ignoreme=[
+                    "artifacts",
+                    "linux-system-roles.*",
+                    "__pycache__",
+                    ".git*",
+                ],
+            )
+            subrole_steps.append(tests_step)
+            # remove symlinks in the tests/new_role, and convert
+            # symlinks in tests plugin directories to point to
+            # collection plugins.
+            sched.add(
+                self.convert_subrole_symlinks,
+                tests_dir / dr,
+                dr,
+                removeme,
+                deps=[tests_step] + plugin_steps,
+            )
+
+        results = sched.run()
+        if pipeline:
+            for step in subrole_steps:
+                pipeline.update(results[step])
+
+        # ==============================================================================
+
+        # Extra files and directories including the sub-roles
+        for extra in self.extras:
+            if extra.name in TOX:
+                continue
+            if extra.name.endswith(".md"):
+                # E.g., contributing.md, README-devel.md and README-testing.md
+                self.process_readme(extra.parent, extra.name, role, new_role)
+            elif extra.is_dir():
+                # Copying sub-roles to the roles dir and its tests and README are also
+                # handled in the same way as the parent role's are.
+                if extra.name == "roles":
+                    for sr, dr in self.get_subroles():
+                        # copy README.md to dest_path/roles/sr.name
+                        _readme = sr / "README.md"
+                        if _readme.is_file():
+                            self.process_readme(
+                                sr,
+                                "README.md",
+                                dr,
+                                dr,
+                                original=sr.name,
+                                issubrole=True,
+                            )
+                        if sr.name != dr:
+                            # replace "sr.name" with "dr" in role_dir
+                            dirs = ["roles", "docs", "tests"]
+                            file_patterns = ["*.yml", "*.md"]
+                            sr_replacer = LSRReplacer(
+                                [(re.escape("\b" + sr.name + "\b"), dr)]
+                            )
+                            with profile_phase("mappings"):
+                                for dir in dirs:
+                                    role_dir = dest_path / dir
+                                    sr_replacer.replace_in_tree(role_dir, file_patterns)
+                elif extra.name == ".ostree":
+                    # copy to role directory within collection
+                    dest = dest_path / "roles" / new_role / extra.name
+                    logging.info(f"Copying extra {extra} to {dest}")
+                    with profile_phase("copy"):
+                        lsr_copytree(extra, dest)
+                # Other extra directories are copied to the collection dir as they are.
+                else:
+                    dest = dest_path / extra.name
+                    logging.info(f"Copying extra {extra} to {dest}")
+                    with profile_phase("copy"):
+                        lsr_copytree(extra, dest)
+            # Other extra files.
+            else:
+                do_copy = True
+                if extra.name.endswith(".yml") and "playbook" in extra.name:
+                    # some-playbook.yml is copied to docs/role dir.
+                    dest = dest_path / "docs" / new_role
+                    dest.mkdir(parents=True, exist_ok=True)
+                elif extra.name == ".ansible-lint":
+                    # process .ansible-lint
+                    dest = dest_path / "roles" / new_role / ".ansible-lint"
+                    with profile_phase("ansible-lint"):
+                        process_ansible_lint(extra, dest, new_role)
+                    do_copy = False
+                else:
+                    # If the extra file 'filename' has no extension, it is copied to the collection dir as
+                    # 'filename-ROLE'. If the extra file is 'filename.ext', it is copied to 'filename-ROLE.ext'.
+                    dest = dest_path / add_rolename(extra.name, new_role)
+                if do_copy:
+                    logging.info(f"Copying extra {extra} to {dest}")
+                    with profile_phase("copy"):
+                        copy2(extra, dest, follow_symlinks=False)
+
+        dest = dest_path / "docs" / new_role
+        if dest.is_dir():
+            lsrxfrm = LSRTransformer(
+                dest,
+                transformer_args,
+                False,
+                role,
+                new_role,
+                LSRFileTransformer,
+                exclude=pipeline.transformed if pipeline else (),
+            )
+            with profile_phase("transform"):
+                lsrxfrm.run()
+
+        extra_script = self.extra_script
+        if extra_script:
+            env = {}
+            env.update(os.environ)
+            env.update(
+                {
+                    "LSR_ROLES_DIR": roles_dir / role,
+                    "LSR_TESTS_DIR": tests_dir / role,
+                    "LSR_NAMESPACE": namespace,
+                    "LSR_COLLECTION": collection,
+                    "LSR_ROLE": role,
+                    "LSR_NEW_ROLE": new_role,
+                }
+            )
+            with profile_phase("extra script"):
+                subprocess.check_call(
+                    [str(extra_script.resolve())],
+                    cwd=roles_dir / role,
+                    env=env,
+                )
+
+        # Handle --extra-mapping FQCN0:FQCN1 or FQCN2:ROLE3
+        # meta/runtime.yml is shared by the roles and handled in finish().
+        file_patterns = ["*.yml", "*.md"]
+        coll_replacer = LSRReplacer(self.coll_mappings)
+        # role
+        coll_dirs = [roles_dir / new_role]
+        # subroles
+        for sr in roles_dir.iterdir():
+            if (
+                sr.name.startswith(subrole_prefix)
+                and roles_dir / sr.name not in coll_dirs
+            ):
+                coll_dirs.append(roles_dir / sr.name)
+        # tests, docs
+        coll_dirs.extend([tests_dir / new_role, docs_dir / new_role])
+        with profile_phase("mappings"):
+            for coll_dir in coll_dirs:
+                coll_replacer.replace_in_tree(
+                    coll_dir,
+                    file_patterns,
+                    exclude=pipeline.replaced if pipeline else (),
+                )
+
+        # Copy processed README.md to the docs dir after renaming it to README_ROLENAME.md
+        role_readmes = [
+            roles_dir / new_role / "README.md",
+            roles_dir / new_role / "README.html",
+        ]
+        for readme in role_readmes:
+            if readme.is_file():
+                if not docs_dir.is_dir():
+                    if docs_dir.exists():
+                        docs_dir.unlink()
+                    docs_dir.mkdir()
+                docs_readme = docs_dir / "README_{0}{1}".format(
+                    new_role, os.path.splitext(readme)[1]
+                )
+                with profile_phase("copy"):
+                    copyfile(readme, docs_readme)
+
+        # Copy CHANGELOG.md to the docs dir after renaming it to CHANGELOG_ROLENAME.md
+        changelog_md = src_path / "CHANGELOG.md"
+        if changelog_md.is_file():
+            if not docs_dir.is_dir():
+                if docs_dir.exists():
+                    docs_dir.unlink()
+                docs_dir.mkdir()
+            role_changelog_md = docs_dir / "CHANGELOG_{0}.md".format(new_role)
+            with profile_phase("copy"):
+                copyfile(changelog_md, role_changelog_md)
+
+    def get_watch_target(self, path):
+        """Return (kind, dest, transformer dir) for the changed source file
+        path of the role, where kind is
+        "copy" - dest is converted from path, with the .yml files transformed
+                 as the files in the transformer dir are
+        "plugin" - dest is the plugin converted from path
+        "readme" - dest is the README or other doc processed from path
+        "ignore" - path is not copied to the collection
+        or None if the role has to be converted again as a whole."""
+        coll = self.coll
+        new_role = self.new_role
+        parts = Path(os.path.relpath(path, self.src_path)).parts
+        if parts[0] == os.pardir:
+            return None
+        top = parts[0]
+        rest = os.path.join(*parts[1:]) if len(parts) > 1 else None
+        # a new directory or symlink needs the whole conversion, a removed
+        # one is removed from the collection like a file
+        if os.path.islink(path) or os.path.isdir(path):
+            return None
+        if top in (".git", "plans") or top in TOX or top in DO_NOT_COPY:
+            return ("ignore", None, None)
+        if top in ROLE_DIRS and rest:
+            # the .md files get the --extra-mapping mappings after the README
+            # mappings, see get_pipeline
+            if rest.endswith(".md"):
+                return None
+            root = coll.roles_dir / new_role / top
+            return ("copy", root / rest, root)
+        if top in TESTS and rest:
+            ignore = ignore_patterns(*self.TESTS_IGNORE)
+            dirpath = os.path.join(self.src_path, top)
+            for name in parts[1:]:
+                if ignore(dirpath, [name]):
+                    return ("ignore", None, None)
+                dirpath = os.path.join(dirpath, name)
+            root = coll.tests_dir / new_role
+            return ("copy", root / rest, root)
+        if top in PLUGINS and rest:
+            plugin_dir = coll.plugin_dir / dir_to_plugin(top)
+            if top == "module_utils" and len(parts) == 2:
+                return ("plugin", plugin_dir / new_role / rest, None)
+            return ("plugin", plugin_dir / rest, None)
+        if not rest and (top in DOCS or top.endswith(".md")):
+            return ("readme", coll.roles_dir / new_role / top, None)
+        return None
+
+    def update_files(self, paths):
+        """Convert the changed source files paths of the role into the
+        collection again.  The files which were removed from the source are
+        removed from the collection.  Returns False if the role has to be
+        converted again as a whole instead, e.g. because a sub-role, a symlink
+        or the set of the plugins changed."""
+        coll = self.coll
+        targets = [(path, self.get_watch_target(path)) for path in sorted(paths)]
+        # The extra script and the renaming of the sub-roles may change any file.
+        complete = not self.extra_script and all(
+            sr.name == dr for sr, dr in self.get_subroles()
+        )
+        for path, target in targets:
+            if target is None:
+                complete = False
+                continue
+            kind, dest, _ = target
+            if os.path.lexists(path):
+                # a new plugin changes how the imports are rewritten
+                if kind == "plugin" and not dest.exists():
+                    complete = False
+                continue
+            if dest and os.path.lexists(dest):
+                logging.info(f"Removing {dest}")
+                lsr_remove(dest)
+            # so does a removed plugin, and a removed README changes the links
+            # in the collection README.md
+            if kind in ("plugin", "readme"):
+                complete = False
+        if not complete:
+            return False
+
+        pipeline = self.get_pipeline()
+        transformers = {}
+        readmes = []
+        for path, (kind, dest, root) in targets:
+            if kind == "ignore" or not os.path.lexists(path):
+                continue
+            if kind == "readme":
+                readmes.append(dest.name)
+                continue
+            if root and root not in transformers:
+                transformers[root] = LSRTransformer(
+                    root,
+                    self.transformer_args,
+                    False,
+                    self.role,
+                    self.new_role,
+                    LSRFileTransformer,
+                )
+            pipeline.transformer = transformers.get(root)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            logging.info(f"Copying {path} to {dest}")
+            pipeline.copy_file(path, dest)
+        pipeline.transformer = None
+        rewriter = self.get_import_rewriter(pipeline.get_pending_files())
+        pipeline.flush(functools.partial(self.rewrite_imports, rewriter))
+
+        # the same as convert_role_files and convert_shared_files do
+        coll_replacer = LSRReplacer(self.coll_mappings)
+        for filename in readmes:
+            self.process_readme(self.src_path, filename, self.role, self.new_role)
+            dest = coll.roles_dir / self.new_role / filename
+            if fnmatch.fnmatch(filename, "*.md"):
+                data = dest.read_bytes()
+                new_data = coll_replacer.sub_data(data)
+                if new_data != data:
+                    dest.write_bytes(new_data)
+            if filename in ("README.md", "README.html"):
+                docs_readme = coll.docs_dir / "README_{0}{1}".format(
+                    self.new_role, os.path.splitext(filename)[1]
+                )
+                coll.docs_dir.mkdir(exist_ok=True)
+                copyfile(dest, docs_readme)
+        return True
 
 
-def role2collection():
+def get_parser():
+    """Return the parser for the command line arguments"""
     HOME = os.environ.get("HOME")
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -1147,8 +4296,21 @@ def role2collection():
     parser.add_argument(
         "--role",
         type=str,
-        default=os.environ.get("COLLECTION_ROLE"),
-        help="Role to convert to collection",
+        action="append",
+        help=(
+            "Role to convert to collection; may be given more than once to "
+            "convert several roles in one run; default to the value of "
+            "COLLECTION_ROLE, which may be a comma delimited list of roles"
+        ),
+    )
+    parser.add_argument(
+        "--roles-from",
+        type=Path,
+        default=os.environ.get("COLLECTION_ROLES_FROM", None),
+        help=(
+            "Path to a collection_release.yml file; convert all of the roles "
+            "listed in it in addition to the ones given with '--role'"
+        ),
     )
     parser.add_argument(
         "--new-role",
@@ -1212,656 +4374,172 @@ def role2collection():
             f"is {EXTRA_SCRIPT} in the role root directory."
         ),
     )
-    args, unknown = parser.parse_known_args()
-
-    role = args.role
-    if not role:
-        parser.print_help()
-        logging.error("Message: role is not specified.")
-        os._exit(errno.EINVAL)
-
-    src_meta_runtime = Path(args.meta_runtime)
-    if not src_meta_runtime.exists():
-        parser.print_help()
-        logging.error("There is no source file specified for the meta/runtime.yml")
-        os._exit(errno.EINVAL)
-
-    new_role = args.new_role
-    if not new_role:
-        new_role = role
-
-    namespace = args.namespace
-    collection = args.collection
-    prefix = namespace + "." + collection + "."
-    top_dest_path = args.dest_path.resolve()
-    current_dest = os.path.expanduser(str(top_dest_path))
-    replace_dot = args.replace_dot
-    subrole_prefix = args.subrole_prefix
-    readme_path = args.readme
-
-    # Assume fedora is the default namespace and linux_system_roles is
-    # the default collection.
-    #
-    # Input: "a-owner.role0:newrole0,\
-    #         a-owner.role1:linux_system_roles.role1,\
-    #         a-owner.role2:fedora.linux_system_roles.role2,\
-    #         my_namespace.my_collection.role3:redhat.rhel_system_roles.role3,\
-    #         my_namespace.my_collection.role4:linux_system_roles.role4,\
-    #         my_namespace.my_collection.role5:role5,\
-    #         my_namespace0.my_collection0:my_namespace1.my_collection1"
-    # Output:
-    # [
-    #   {'src_name': {'src_owner': 'linux-system-roles', 'role': 'role0'},
-    #    'dest_name': {'dest_prefix': None, 'role': 'newrole0'}},
-    #   {'src_name': {'src_owner': 'a-owner', 'role': 'role1'},
-    #    'dest_name': {'dest_prefix': 'fedora.linux_system_roles', 'role': 'role1'},
-    #   {'src_name': {'src_owner': 'a-owner', 'role': 'role2'},
-    #    'dest_name': {'dest_prefix': 'fedora.linux_system_roles', 'role': 'role2'}}
-    # ],
-    # [
-    #   {'src_name': {'src_coll': 'my_namespace.my_collection.role3'},
-    #    'dest_name': {'dest_coll': 'redhat.rhel_system_roles.role3}},
-    #   {'src_name': {'src_coll': 'my_namespace.my_collection.role4'},
-    #    'dest_name': {'dest_coll': 'fedora.linux_system_roles.role4}},
-    #   {'src_name': {'src_coll': 'my_namespace.my_collection.role3'},
-    #    'dest_name': {'dest_coll': 'fedora.linux_system_roles.role3'}},
-    #   {'src_name': {'src_coll': 'my_namespace0.my_collection0'},
-    #    'dest_name': {'dest_coll': 'my_namespace1.my_collection1'}},
-    # ]
-    # Note: Skip if the role in the given src_name is the role to be converted.
-    def parse_extra_mapping(mapping_str, namespace, collection, role):
-        _mapping_list = mapping_str.split(",")
-        _mapping_role_list = []
-        _mapping_coll_list = []
-        for _map in _mapping_list:
-            _item = _map.split(":")
-            if len(_item) == 2:
-                # src and dest are identical
-                if _item[0] == _item[1]:
-                    continue
-                _mapping_dict = {}
-                _src = _item[0].split(".")
-                _src_name = {}
-                if len(_src) == 1:
-                    # "rolename"
-                    if _src[0] == role:
-                        continue
-                    _src_name["src_owner"] = None
-                    _src_name["role"] = _src[0]
-                    _mapping_dict["src_name"] = _src_name
-                elif len(_src) == 2:
-                    # "linux-system-roles.rolename" or "fedora.linux_system_roles"
-                    if _src[1] == role:
-                        continue
-                    elif _src[0] == "fedora" and _src[1] == "linux_system_roles":
-                        _src_name["src_coll"] = _item[0]
-                    else:
-                        _src_name["src_owner"] = _src[0]
-                        _src_name["role"] = _src[1]
-                    _mapping_dict["src_name"] = _src_name
-                elif len(_src) == 3:
-                    # FQCN
-                    _src_name["src_coll"] = _item[0]
-                    _mapping_dict["src_name"] = _src_name
-
-                _dest = _item[1].split(".")
-                _dest_name = {}
-                if len(_src) == 1 or len(_src) == 2:
-                    if len(_dest) == 1:
-                        # "rolename"
-                        _dest_name["dest_prefix"] = None
-                        _dest_name["role"] = _dest[0]
-                    elif len(_dest) == 2:
-                        # "collection.rolename" or "namespace.collection"
-                        if (
-                            _src[0] == "fedora" and _src[1] == "linux_system_roles"
-                        ) or (_dest[0] == namespace and _dest[1] == collection):
-                            _dest_name["dest_coll"] = _item[1]
-                        else:
-                            _dest_name["dest_prefix"] = "{0}.{1}.".format(
-                                namespace, _dest[0]
-                            )
-                            _dest_name["role"] = _dest[1]
-                    elif len(_dest) == 3:
-                        # "namespace.collection.rolename"
-                        _dest_name["dest_prefix"] = "{0}.{1}.".format(
-                            _dest[0], _dest[1]
-                        )
-                        _dest_name["role"] = _dest[2]
-                    _mapping_dict["dest_name"] = _dest_name
-                    if (
-                        "dest_coll" in _dest_name.keys()
-                        and _dest_name["dest_coll"] == _item[1]
-                    ):
-                        _mapping_coll_list.append(_mapping_dict)
-                    else:
-                        _mapping_role_list.append(_mapping_dict)
-                elif len(_src) == 3:
-                    if len(_dest) == 1:
-                        # "rolename"
-                        _dest_name["dest_coll"] = "{0}.{1}.{2}".format(
-                            namespace, collection, _item[1]
-                        )
-                    elif len(_dest) == 2:
-                        # "collection.rolename"
-                        _dest_name["dest_coll"] = "{0}.{1}".format(namespace, _item[1])
-                    elif len(_dest) == 3:
-                        # FQCN
-                        _dest_name["dest_coll"] = _item[1]
-                    _mapping_dict["dest_name"] = _dest_name
-                    _mapping_coll_list.append(_mapping_dict)
-                else:
-                    print(
-                        "ERROR: Ignoring invalid extra-mapping value {0}".format(_map)
-                    )
-        return _mapping_role_list, _mapping_coll_list
-
-    extra_mapping, extra_coll_mapping = parse_extra_mapping(
-        args.extra_mapping, namespace, collection, role
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=int(os.environ.get("COLLECTION_JOBS", 1)),
+        help=(
+            "Number of processes to use to transform the role yml files in "
+            "parallel; default to 1"
+        ),
     )
-
-    extra_mapping_src_owner = list(
-        map(itemgetter("src_owner"), list(map(itemgetter("src_name"), extra_mapping)))
+    parser.add_argument(
+        "--role-jobs",
+        type=int,
+        default=int(os.environ.get("COLLECTION_ROLE_JOBS", 1)),
+        help=(
+            "Number of roles to convert concurrently when converting several "
+            "roles; default to 1"
+        ),
     )
-    extra_mapping_src_role = list(
-        map(itemgetter("role"), list(map(itemgetter("src_name"), extra_mapping)))
+    parser.add_argument(
+        "--phase-jobs",
+        type=int,
+        default=int(os.environ.get("COLLECTION_PHASE_JOBS", 1)),
+        help=(
+            "Number of threads in which to convert the independent parts of "
+            "each role - the role dirs, the tests, the docs, the plugins and "
+            "the sub-roles - concurrently; default to 1"
+        ),
     )
-    extra_mapping_dest_prefix = list(
-        map(
-            itemgetter("dest_prefix"), list(map(itemgetter("dest_name"), extra_mapping))
-        )
+    parser.add_argument(
+        "--copy-mode",
+        choices=["copy", "hardlink"],
+        default=os.environ.get("COLLECTION_COPY_MODE", "copy"),
+        help=(
+            "How to copy the role files to the collection - 'copy' clones the "
+            "data with a reflink or copy_file_range if the filesystem supports "
+            "it; 'hardlink' hardlinks the files which are never rewritten "
+            "(i.e. not yml, md, html or py files) to the source files; "
+            "default to copy"
+        ),
     )
-    extra_mapping_dest_role = list(
-        map(itemgetter("role"), list(map(itemgetter("dest_name"), extra_mapping)))
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        default=os.environ.get("COLLECTION_PIPELINE") == "true",
+        help=(
+            "Convert the role files while they are copied to the collection - "
+            "each file is read once, converted in memory, and written once, "
+            "instead of being rewritten in place by each conversion; default "
+            "to false"
+        ),
     )
-
-    dest_path = Path.joinpath(
-        top_dest_path, "ansible_collections/" + namespace + "/" + collection
+    parser.add_argument(
+        "--dry-run",
+        nargs="?",
+        const="diff",
+        choices=["diff", "files"],
+        default=os.environ.get("COLLECTION_DRY_RUN", None),
+        help=(
+            "Convert the roles into a copy of the collection in a staging "
+            "directory, in memory if /dev/shm is available, instead of into "
+            "DEST_PATH, and print the unified diff between DEST_PATH and the "
+            "result, or with 'files', the list of the added (A), deleted (D) "
+            "and modified (M) files.  DEST_PATH is not changed.  The exit "
+            "status is 1 if the conversion would change DEST_PATH; default "
+            "to converting into DEST_PATH"
+        ),
     )
-    _tests_dest_path = args.tests_dest_path
-    if _tests_dest_path:
-        tests_dest_path = Path(_tests_dest_path)
-    else:
-        tests_dest_path = dest_path
-
-    os.makedirs(dest_path, exist_ok=True)
-
-    roles_dir = dest_path / "roles"
-    tests_dir = tests_dest_path / "tests"
-    plugin_dir = dest_path / "plugins"
-    modules_dir = plugin_dir / "modules"
-    module_utils_dir = plugin_dir / "module_utils"
-    docs_dir = dest_path / "docs"
-    meta_dir = dest_path / "meta"
-
-    src_path = args.src_path.resolve()
-    src_owner = args.src_owner
-    if not src_owner:
-        src_owner = os.path.basename(src_path)
-    _tasks_main = src_path / "tasks/main.yml"
-    if not _tasks_main.exists():
-        src_path = src_path / role
-        _tasks_main = src_path / "tasks/main.yml"
-
-    if not _tasks_main.exists():
-        logging.error(
-            f"Neither {src_path} nor {src_path.parent} is a role top directory."
-        )
-        sys.exit(errno.ENOENT)
-
-    extra_script = args.extra_script
-    if extra_script and not which(extra_script):
-        logging.error(f"The extra-script {extra_script} is not an executable.")
-        sys.exit(errno.ENOENT)
-    elif not extra_script:
-        extra_script = src_path / EXTRA_SCRIPT
-        if not which(extra_script):
-            extra_script = None
-
-    _extras = set(os.listdir(src_path)).difference(ALL_DIRS)
-    for dir in (".git", "plans"):
-        try:
-            _extras.remove(dir)
-        except KeyError:
-            pass
-    extras = [src_path / e for e in _extras]
-
-    global config
-    config = {
-        "namespace": namespace,
-        "collection": collection,
-        "role": new_role,
-        "src_path": src_path,
-        "dest_path": dest_path,
-        "module_utils_dir": module_utils_dir,
-    }
-
-    transformer_args = {
-        "namespace": namespace,
-        "collection": collection,
-        "prefix": prefix,
-        "subrole_prefix": subrole_prefix,
-        "replace_dot": replace_dot,
-        # get role modules - will need to find and convert these to use FQCN
-        "role_modules": get_role_modules(src_path),
-        "src_owner": src_owner,
-        "top_dir": current_dest,
-        "extra_mapping_src_owner": extra_mapping_src_owner,
-        "extra_mapping_src_role": extra_mapping_src_role,
-        "extra_mapping_dest_prefix": extra_mapping_dest_prefix,
-        "extra_mapping_dest_role": extra_mapping_dest_role,
-    }
-
-    # Role - copy subdirectories, tasks, defaults, vars, etc., in the system role to
-    # DEST_PATH/ansible_collections/NAMESPACE/COLLECTION/roles/ROLE.
-    copy_tree_with_replace(
-        src_path, dest_path, role, new_role, ROLE_DIRS, transformer_args
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        default=os.environ.get("COLLECTION_WATCH") == "true",
+        help=(
+            "After converting the roles, watch their sources with inotify and "
+            "convert the changed files again into DEST_PATH, until "
+            "interrupted with Ctrl-C.  Linux only; default to false"
+        ),
     )
-
-    # ==============================================================================
-
-    copy_tree_with_replace(
-        src_path,
-        tests_dest_path,
-        role,
-        new_role,
-        TESTS,
-        transformer_args,
-        isrole=False,
-        ignoreme=[
-            "artifacts",
-            "linux-system-roles.*",
-            "__pycache__",
-            ".git*",
-            "ansible-sshd",
-        ],
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        default=os.environ.get("COLLECTION_PROFILE", None),
+        help=(
+            "Path of a JSON file to write the wall and CPU time of each phase "
+            "of the conversion, per role, and of each converted file to; the "
+            "phases and the slowest files are also printed; default to no "
+            "profiling"
+        ),
     )
+    parser.add_argument(
+        "--profile-top",
+        type=int,
+        default=int(os.environ.get("COLLECTION_PROFILE_TOP", 10)),
+        help="Number of the slowest files to print with '--profile'; default to 10",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=os.environ.get("COLLECTION_CACHE_DIR", None),
+        help=(
+            "Directory in which to cache the converted files.  A file whose "
+            "contents and conversion arguments are unchanged since a previous "
+            "run is taken from the cache instead of being converted again; "
+            "default to no cache"
+        ),
+    )
+    return parser
 
-    # remove symlinks in the tests/role.
-    removeme = ["library", "modules", "module_utils", "roles"]
-    cleanup_symlinks(tests_dir / new_role, role, removeme)
-
-    # ==============================================================================
-
-    def update_readme(src_path, filename, rolename, comment, issubrole=False):
-        if not filename.startswith("README"):
-            return
-        if filename == "README.md":
-            title = rolename
-        else:
-            m = re.match(r"README(.*)(\.md)", filename)
-            title = rolename + m.group(1)
-        main_doc = dest_path / "README.md"
-        if not main_doc.exists():
-            if readme_path and Path(readme_path).exists():
-                with open(readme_path, encoding="utf-8") as f:
-                    _s = f.read()
-            else:
-                _s = textwrap.dedent("""\
-                    # {0} {1} collections
-                    """).format(namespace, collection)
 
-            s = textwrap.dedent("""\
-                {0}
+def get_roles(args):
+    """Return the list of roles to convert given on the command line"""
+    roles = []
+    if args.role:
+        for role in args.role:
+            roles.extend(role.split(","))
+    elif os.environ.get("COLLECTION_ROLE"):
+        roles.extend(os.environ["COLLECTION_ROLE"].split(","))
+    if args.roles_from:
+        roles.extend(get_roles_from_release_yml(args.roles_from))
+    # drop empty and duplicate names, preserving the order
+    return list(dict.fromkeys(role for role in roles if role))
 
-                {1}
 
-                <!--ts-->
-                  * {2}
-                <!--te-->
-                """).format(_s, comment, title)
-            with open(main_doc, "w", encoding="utf-8") as f:
-                f.write(s)
-        else:
-            with open(main_doc, encoding="utf-8") as f:
-                s = f.read()
-            role_link = "{0}".format(title)
-            if role_link not in s:
-                if comment not in s:
-                    text = s + textwrap.dedent("""\
-
-                        {2}
-
-                        <!--ts-->
-                          * {3}
-                        <!--te-->
-                        """).format(namespace, collection, comment, role_link)
-                else:
-                    find = r"({0}\n\n<!--ts-->\n)(( |\*|\w|\[|\]|\(|\)|\.|/|-|\n|\r)+)".format(
-                        comment
-                    )
-                    replace = r"\1\2  * {0}\n".format(role_link)
-                    text = re.sub(find, replace, s, flags=re.M)
-                with open(main_doc, "w", encoding="utf-8") as f:
-                    f.write(text)
+def role2collection(argv=None):
+    parser = get_parser()
+    args, unknown = parser.parse_known_args(argv)
 
-    # Copy docs, design_docs, and examples to
-    # DEST_PATH/ansible_collections/NAMESPACE/COLLECTION/docs/ROLE.
-    # Copy README.md to DEST_PATH/ansible_collections/NAMESPACE/COLLECTION/roles/ROLE.
-    # Generate a top level README.md which contains links to roles/ROLE/README.md.
-    def process_readme(
-        src_path, filename, role, new_role, original=None, issubrole=False
-    ):
-        """
-        Copy src_path/filename to dest_path/docs/new_role.
-        filename could be README.md, README-something.md, or something.md.
-        Create a primary README.md in dest_path, which points to dest_path/docs/new_role/filename
-        with the title new_role or new_role-something.
-        """
-        src = src_path / filename
-        dest = roles_dir / new_role / filename
-        # copy
-        logging.info(f"Copying doc {filename} to {dest}")
-        copy2(src, dest, follow_symlinks=False)
-        dest = roles_dir / new_role
-        file_patterns = ["*.md", "*.html"]
-        file_replace(dest, src_owner + "." + role, prefix + new_role, file_patterns)
-        # --extra-mapping SRCROLENAME:DESTROLENAME(or FQCN)
-        for _emap in extra_mapping:
-            # Replacing SRC_OWNER.ROLE with FQCN
-            _from = "{0}.{1}".format(
-                (
-                    _emap["src_name"]["src_owner"]
-                    if _emap["src_name"]["src_owner"]
-                    else src_owner
-                ),
-                _emap["src_name"]["role"],
-            )
-            _to = "{0}{1}".format(
-                (
-                    _emap["dest_name"]["dest_prefix"]
-                    if _emap["dest_name"]["dest_prefix"]
-                    else prefix
-                ),
-                _emap["dest_name"]["role"],
-            )
-            file_replace(dest, _from, _to, file_patterns)
-            # Replacing unprefixed ROLE with FQCN
-            _from = " {0}".format(_emap["src_name"]["role"])
-            _to = " {0}{1}".format(
-                (
-                    _emap["dest_name"]["dest_prefix"]
-                    if _emap["dest_name"]["dest_prefix"]
-                    else prefix
-                ),
-                _emap["dest_name"]["role"],
-            )
-            file_replace(dest, _from, _to, file_patterns)
-        if original:
-            file_replace(dest, original, prefix + new_role, file_patterns)
-        if filename == "README.md":
-            if issubrole:
-                comment = "### Private Roles"
-            else:
-                comment = "### Supported Roles"
-            update_readme(src_path, filename, new_role, comment, issubrole)
+    roles = get_roles(args)
+    if not roles:
+        parser.print_help()
+        logging.error("Message: role is not specified.")
+        os._exit(errno.EINVAL)
 
-    ignoreme = ["linux-system-roles.*"]
-    dest = docs_dir / new_role
-    for doc in DOCS:
-        src = src_path / doc
-        if src.is_dir():
-            logging.info(f"Copying docs {src} to {dest}")
-            lsr_copytree(
-                src,
-                dest,
-                symlinks=False,
-                ignore=ignore_patterns(*ignoreme),
-                dirs_exist_ok=True,
-            )
-            if doc == "examples":
-                lsrxfrm = LSRTransformer(
-                    dest,
-                    transformer_args,
-                    False,
-                    role,
-                    new_role,
-                    LSRFileTransformer,
-                )
-                lsrxfrm.run()
-        elif src.is_file():
-            process_readme(src_path, doc, role, new_role)
-
-    # Remove symlinks in the docs/role (e.g., in the examples).
-    removeme = ["library", "modules", "module_utils", "roles"]
-    cleanup_symlinks(dest, new_role, removeme)
-
-    # ==============================================================================
-
-    # Copy library, module_utils, plugins
-    # Library and plugins are copied to dest_path/plugins
-    # If plugin is in SUBDIR (currently, just module_utils),
-    #   module_utils/*.py are to dest_path/plugins/module_utils/ROLE/*.py
-    #   module_utils/subdir/*.py are to dest_path/plugins/module_utils/subdir/*.py
-    SUBDIR = ("module_utils",)
-    for plugin in PLUGINS:
-        src = src_path / plugin
-        plugin_name = dir_to_plugin(plugin)
-        if not src.is_dir():
-            continue
-        if plugin in SUBDIR:
-            for sr in src.iterdir():
-                if sr.is_dir():
-                    # If src/sr is a directory, copy it to the dest
-                    dest = plugin_dir / plugin_name / sr.name
-                    logging.info(f"Copying plugin {sr} to {dest}")
-                    lsr_copytree(sr, dest)
-                else:
-                    # Otherwise, copy it to the plugins/plugin_name/ROLE
-                    dest = plugin_dir / plugin_name / new_role
-                    dest.mkdir(parents=True, exist_ok=True)
-                    logging.info(f"Copying plugin {sr} to {dest}")
-                    copy2(sr, dest, follow_symlinks=False)
-        else:
-            dest = plugin_dir / plugin_name
-            logging.info(f"Copying plugin {src} to {dest}")
-            lsr_copytree(src, dest)
-
-    # Convert symlinks in tests plugin directories to point to collection plugins.
-    convert_tests_plugin_symlinks(tests_dir / new_role, new_role, dest_path)
-
-    # Update the python codes which import modules in plugins/{modules,modules_dir}.
-    config["module_utils"] = gather_module_utils_parts(module_utils_dir)
-    additional_rewrites = []
-    config["additional_rewrites"] = additional_rewrites
-    for rewrite_dir in (module_utils_dir, modules_dir):
-        if rewrite_dir.is_dir():
-            for root, dirs, files in os.walk(rewrite_dir):
-                for filename in files:
-                    if os.path.splitext(filename)[1] != ".py":
-                        continue
-                    full_path = Path(root) / filename
-                    text = full_path.read_bytes()
-                    new_text = IMPORT_RE.sub(import_replace, text)
-                    new_text = FROM_RE.sub(from_replace, new_text)
-                    for rewrite in additional_rewrites:
-                        pattern = re.compile(
-                            re.escape(rb"ansible.module_utils.%s" % b".".join(rewrite))
-                        )
-                        new_text = pattern.sub(rewrite[-1], new_text)
-
-                    if text != new_text:
-                        logging.info("Rewriting imports for {}".format(full_path))
-                        full_path.write_bytes(new_text)
-                        additional_rewrites[:] = []
-
-    # ==============================================================================
-
-    # Extra files and directories including the sub-roles
-    for extra in extras:
-        if extra.name in TOX:
-            continue
-        if extra.name.endswith(".md"):
-            # E.g., contributing.md, README-devel.md and README-testing.md
-            process_readme(extra.parent, extra.name, role, new_role)
-        elif extra.is_dir():
-            # Copying sub-roles to the roles dir and its tests and README are also
-            # handled in the same way as the parent role's are.
-            if extra.name == "roles":
-                for sr in extra.iterdir():
-                    # If a role name contains '.', replace it with replace_dot
-                    # convert nested subroles to prefix name with subrole_prefix.
-                    dr = sr.name.replace(".", replace_dot)
-                    if subrole_prefix and not dr.startswith(subrole_prefix):
-                        dr = subrole_prefix + dr
-                    copy_tree_with_replace(
-                        sr, dest_path, dr, dr, ROLE_DIRS, transformer_args
-                    )
-                    # copy tests dir to dest_path/"tests"
-                    copy_tree_with_replace(
-                        sr,
-                        tests_dest_path,
-                        dr,
-                        dr,
-                        TESTS,
-                        transformer_args,
-                        isrole=False,
-                        ignoreme=[
-                            "artifacts",
-                            "linux-system-roles.*",
-                            "__pycache__",
-                            ".git*",
-                        ],
-                    )
-                    # Convert symlinks in tests plugin directories to point to collection plugins.
-                    convert_tests_plugin_symlinks(tests_dir / dr, dr, dest_path)
-                    # remove symlinks in the tests/new_role.
-                    removeme = ["library", "modules", "module_utils", "roles"]
-                    cleanup_symlinks(tests_dir / dr, dr, removeme)
-                    # copy README.md to dest_path/roles/sr.name
-                    _readme = sr / "README.md"
-                    if _readme.is_file():
-                        process_readme(
-                            sr, "README.md", dr, dr, original=sr.name, issubrole=True
-                        )
-                    if sr.name != dr:
-                        # replace "sr.name" with "dr" in role_dir
-                        dirs = ["roles", "docs", "tests"]
-                        for dir in dirs:
-                            role_dir = dest_path / dir
-                            file_patterns = ["*.yml", "*.md"]
-                            file_replace(
-                                role_dir,
-                                re.escape("\b" + sr.name + "\b"),
-                                dr,
-                                file_patterns,
-                            )
-            elif extra.name == ".ostree":
-                # copy to role directory within collection
-                dest = dest_path / "roles" / new_role / extra.name
-                logging.info(f"Copying extra {extra} to {dest}")
-                lsr_copytree(extra, dest)
-            # Other extra directories are copied to the collection dir as they are.
-            else:
-                dest = dest_path / extra.name
-                logging.info(f"Copying extra {extra} to {dest}")
-                lsr_copytree(extra, dest)
-        # Other extra files.
-        else:
-            do_copy = True
-            if extra.name.endswith(".yml") and "playbook" in extra.name:
-                # some-playbook.yml is copied to docs/role dir.
-                dest = dest_path / "docs" / new_role
-                dest.mkdir(parents=True, exist_ok=True)
-            elif extra.name == ".ansible-lint":
-                # process .ansible-lint
-                dest = dest_path / "roles" / new_role / ".ansible-lint"
-                process_ansible_lint(extra, dest, new_role)
-                do_copy = False
-            else:
-                # If the extra file 'filename' has no extension, it is copied to the collection dir as
-                # 'filename-ROLE'. If the extra file is 'filename.ext', it is copied to 'filename-ROLE.ext'.
-                dest = dest_path / add_rolename(extra.name, new_role)
-            if do_copy:
-                logging.info(f"Copying extra {extra} to {dest}")
-                copy2(extra, dest, follow_symlinks=False)
-
-    dest = dest_path / "docs" / new_role
-    if dest.is_dir():
-        lsrxfrm = LSRTransformer(
-            dest, transformer_args, False, role, new_role, LSRFileTransformer
-        )
-        lsrxfrm.run()
+    if args.new_role and len(roles) > 1:
+        parser.print_help()
+        logging.error("Message: new-role cannot be used with more than one role.")
+        os._exit(errno.EINVAL)
 
-    if not meta_dir.exists():
-        meta_dir.mkdir()
-    copyfile(src_meta_runtime, meta_dir / "runtime.yml")
+    src_meta_runtime = Path(args.meta_runtime)
+    if not src_meta_runtime.exists():
+        parser.print_help()
+        logging.error("There is no source file specified for the meta/runtime.yml")
+        os._exit(errno.EINVAL)
 
-    if extra_script:
-        env = {}
-        env.update(os.environ)
-        env.update(
-            {
-                "LSR_ROLES_DIR": roles_dir / role,
-                "LSR_TESTS_DIR": tests_dir / role,
-                "LSR_NAMESPACE": namespace,
-                "LSR_COLLECTION": collection,
-                "LSR_ROLE": role,
-                "LSR_NEW_ROLE": new_role,
-            }
-        )
-        subprocess.check_call(
-            [str(extra_script.resolve())],
-            cwd=roles_dir / role,
-            env=env,
-        )
+    if args.watch and args.dry_run:
+        parser.print_help()
+        logging.error("Message: watch cannot be used with dry-run.")
+        os._exit(errno.EINVAL)
 
-    # Handle --extra-mapping FQCN0:FQCN1 or FQCN2:ROLE3
-    file_patterns = ["*.yml", "*.md"]
-    for _emap in extra_coll_mapping:
-        # Replacing SRC_OWNER.ROLE with FQCN
-        _from = "{0}".format(_emap["src_name"]["src_coll"])
-        _to = "{0}".format(_emap["dest_name"]["dest_coll"])
-        # role
-        file_replace(roles_dir / new_role, _from, _to, file_patterns)
-        # subroles
-        for sr in roles_dir.iterdir():
-            if sr.name.startswith(subrole_prefix):
-                file_replace(roles_dir / sr.name, _from, _to, file_patterns)
-        # tests
-        file_replace(tests_dir / new_role, _from, _to, file_patterns)
-        # docs
-        file_replace(docs_dir / new_role, _from, _to, file_patterns)
-        # meta
-        file_replace(meta_dir, _from, _to, file_patterns)
-
-    # Copy processed README.md to the docs dir after renaming it to README_ROLENAME.md
-    role_readmes = [
-        roles_dir / new_role / "README.md",
-        roles_dir / new_role / "README.html",
-    ]
-    for readme in role_readmes:
-        if readme.is_file():
-            if not docs_dir.is_dir():
-                if docs_dir.exists():
-                    docs_dir.unlink()
-                docs_dir.mkdir()
-            docs_readme = docs_dir / "README_{0}{1}".format(
-                new_role, os.path.splitext(readme)[1]
-            )
-            copyfile(readme, docs_readme)
-
-    # Copy CHANGELOG.md to the docs dir after renaming it to CHANGELOG_ROLENAME.md
-    changelog_md = src_path / "CHANGELOG.md"
-    if changelog_md.is_file():
-        if not docs_dir.is_dir():
-            if docs_dir.exists():
-                docs_dir.unlink()
-            docs_dir.mkdir()
-        role_changelog_md = docs_dir / "CHANGELOG_{0}.md".format(new_role)
-        copyfile(changelog_md, role_changelog_md)
-
-    default_collections_paths = "~/.ansible/collections:/usr/share/ansible/collections"
-    default_collections_paths_list = list(
-        map(os.path.expanduser, default_collections_paths.split(":"))
-    )
-    # top_dest_path is not in the default collections path.
-    # suggest to run ansible-playbook with ANSIBLE_COLLECTIONS_PATH env var.
-    if current_dest not in default_collections_paths_list:
-        ansible_collections_paths = current_dest + ":" + default_collections_paths
-        logging.debug(
-            f"Run ansible-playbook with environment variable ANSIBLE_COLLECTIONS_PATH={ansible_collections_paths}"
-        )
+    converter = LSRCollectionConverter(args)
+    roles = [{"role": role, "new_role": args.new_role} for role in roles]
+    if args.watch:
+        try:
+            converter.watch(roles, jobs=args.role_jobs)
+        except LSRException as lsrex:
+            logging.error(lsrex)
+            return errno.ENOENT
+        return 0
+    try:
+        converter.convert_roles(roles, jobs=args.role_jobs)
+    except LSRException as lsrex:
+        logging.error(lsrex)
+        return errno.ENOENT
+    converter.finish()
+    if converter.changes:
+        # the collection is not up to date
+        return 1
     return 0
 
 
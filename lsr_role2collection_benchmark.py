@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+# Usage:
+# lsr_role2collection_benchmark.py [--size small|medium|large]
+#                                  [--task-files N] [--tasks N] [--depth N]
+#                                  [--subroles N] [--module-utils N]
+#                                  [--tests N] [--mappings N]
+#                                  [--repeat N] [--work-dir DIR]
+#                                  [--script lsr_role2collection.py]
+#                                  [--baseline FILE [--name NAME]
+#                                   [--update-baseline] [--tolerance PCT]]
+#                                  [-- LSR_ROLE2COLLECTION_ARGS ...]
+#
+# Generate a synthetic role of the given size, convert it to a collection with
+# lsr_role2collection.py, and print the conversion throughput (files/sec,
+# MB/sec) and the peak memory of the conversion, and how long creating a
+# ruamel YAML engine for each .yml file would take.  The arguments after "--" are
+# passed to lsr_role2collection.py, e.g. "-- --jobs 4 --pipeline".
+#
+# With --baseline FILE, the result is compared to the result of the same NAME
+# stored in FILE, and the script exits with 1 if the throughput is lower or the
+# peak memory is higher than the baseline by more than the tolerance.  If there
+# is no such result in FILE yet, or with --update-baseline, the result is stored
+# in FILE instead.  The baseline results depend on the machine, so each machine
+# should have its own baseline file.
+
+"""Benchmark lsr_role2collection.py with synthetic roles"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+TOPDIR = Path(__file__).resolve().parent
+SRC_OWNER = "linux-system-roles"
+ROLE = "benchrole"
+NAMESPACE = "bench"
+COLLECTION = "system_roles"
+
+# N task files with M tasks each, nested in blocks of the given depth
+SIZES = {
+    "small": {
+        "task_files": 10,
+        "tasks": 10,
+        "depth": 2,
+        "subroles": 2,
+        "module_utils": 2,
+        "tests": 5,
+        "mappings": 5,
+    },
+    "medium": {
+        "task_files": 50,
+        "tasks": 20,
+        "depth": 3,
+        "subroles": 5,
+        "module_utils": 10,
+        "tests": 25,
+        "mappings": 20,
+    },
+    "large": {
+        "task_files": 200,
+        "tasks": 40,
+        "depth": 4,
+        "subroles": 10,
+        "module_utils": 40,
+        "tests": 100,
+        "mappings": 100,
+    },
+}
+
+# the result values which are compared to the baseline, and whether a higher
+# value is better
+COMPARED = {"files_per_sec": True, "mb_per_sec": True, "peak_rss_mb": False}
+
+
+def write_file(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def gen_task(params, idx):
+    """Return the lines of the task number idx, cycling through the kinds of
+    tasks which the conversion rewrites."""
+    kind = idx % 5
+    other = "{0}.other{1}".format(SRC_OWNER, idx % max(params["mappings"], 1))
+    if kind == 0:
+        return [
+            "- name: Include role {0}".format(other),
+            "  include_role:",
+            "    name: {0}".format(other),
+        ]
+    if kind == 1:
+        return [
+            "- name: Call module {0}".format(idx),
+            "  {0}_module{1}:".format(ROLE, idx % max(params["module_utils"], 1)),
+            "    name: item{0}".format(idx),
+            "    state: present",
+        ]
+    if kind == 2 and params["subroles"]:
+        return [
+            "- name: Import subrole {0}".format(idx),
+            "  import_role:",
+            '    name: "{{{{ role_path }}}}/roles/sub{0}"'.format(
+                idx % params["subroles"]
+            ),
+        ]
+    if kind == 3:
+        return [
+            "- name: Include vars {0}".format(idx),
+            "  include_vars: /path/to/{0}.{1}/vars/main.yml".format(SRC_OWNER, ROLE),
+        ]
+    return [
+        "- name: Debug {0}  # comment".format(idx),
+        "  debug:",
+        '    msg: "Using {0}.{1} item {2}"'.format(SRC_OWNER, ROLE, idx),
+        "  when: item{0} | d(false)".format(idx),
+    ]
+
+
+def gen_tasks(params, start, count, depth):
+    """Return the lines of count tasks nested in blocks up to depth."""
+    if depth <= 1 or count <= 2:
+        lines = []
+        for idx in range(start, start + count):
+            lines.extend(gen_task(params, idx))
+            lines.append("")
+        return lines
+    half = count // 2
+    lines = gen_tasks(params, start, half, 1)
+    lines.extend(["- name: Block {0}".format(start), "  block:"])
+    inner = gen_tasks(params, start + half, count - half, depth - 1)
+    lines.extend("    " + line if line else line for line in inner)
+    lines.extend(
+        [
+            "  rescue:",
+            "    - name: Rescue {0}".format(start),
+            "      debug:",
+            "        msg: failed",
+            "",
+        ]
+    )
+    return lines
+
+
+def gen_role(src_path, params):
+    """Create the synthetic role in src_path/linux-system-roles/benchrole and
+    return its path."""
+    role = src_path / SRC_OWNER / ROLE
+    if role.exists():
+        shutil.rmtree(role)
+    header = "# SPDX-License-Identifier: MIT\n---\n"
+    others = [
+        "{0}.other{1}".format(SRC_OWNER, idx) for idx in range(params["mappings"])
+    ]
+
+    # tasks
+    includes = []
+    for fidx in range(params["task_files"]):
+        name = "tasks_{0}.yml".format(fidx)
+        lines = gen_tasks(
+            params, fidx * params["tasks"], params["tasks"], params["depth"]
+        )
+        write_file(role / "tasks" / name, header + "\n".join(lines))
+        includes.extend(
+            ["- name: Include {0}".format(name), "  include_tasks: " + name, ""]
+        )
+    write_file(role / "tasks" / "main.yml", header + "\n".join(includes))
+    write_file(role / "defaults" / "main.yml", header + "benchrole_var: value\n")
+    write_file(role / "vars" / "main.yml", header + "# vars\nbenchrole_list: []\n")
+    write_file(
+        role / "handlers" / "main.yml",
+        header + "- name: Restart\n  service:\n    name: bench\n    state: restarted\n",
+    )
+    write_file(
+        role / "meta" / "main.yml",
+        header
+        + "galaxy_info:\n  author: bench\ndependencies:\n"
+        + "".join("  - {0}\n".format(other) for other in others[:5]),
+    )
+    write_file(role / "templates" / "bench.conf.j2", "value = {{ benchrole_var }}\n")
+    write_file(role / "files" / "bench.txt", "static\n" * 100)
+
+    # subroles
+    for sidx in range(params["subroles"]):
+        sub = role / "roles" / "sub{0}".format(sidx)
+        lines = gen_tasks(params, sidx, params["tasks"], params["depth"])
+        write_file(sub / "tasks" / "main.yml", header + "\n".join(lines))
+        write_file(sub / "meta" / "main.yml", header + "dependencies: []\n")
+        write_file(sub / "README.md", "# sub{0}\n\nPart of {1}.\n".format(sidx, ROLE))
+
+    # modules and module_utils packages which import each other
+    pkg_top = role / "module_utils" / (ROLE + "_lsr")
+    write_file(pkg_top / "__init__.py", "")
+    count = params["module_utils"]
+    for pidx in range(count):
+        pkg = "ansible.module_utils.{0}_lsr.pkg{{0}}".format(ROLE)
+        write_file(pkg_top / "pkg{0}".format(pidx) / "__init__.py", "")
+        write_file(
+            pkg_top / "pkg{0}".format(pidx) / "util.py",
+            "from {0}.util import helper  # noqa\n"
+            "import {0}.util\n\n\n"
+            "def helper{1}():\n    return {1}\n".format(
+                pkg.format((pidx + 1) % count), pidx
+            ),
+        )
+        write_file(
+            role / "library" / "{0}_module{1}.py".format(ROLE, pidx),
+            "from {0}.util import helper{1}\n"
+            "from ansible.module_utils.basic import AnsibleModule\n\n\n"
+            "def main():\n    helper{1}()\n    AnsibleModule(argument_spec={{}})\n".format(
+                pkg.format(pidx), pidx
+            ),
+        )
+
+    # tests, with the plugin dirs symlinked to the role
+    tests = role / "tests"
+    for tidx in range(params["tests"]):
+        write_file(
+            tests / "tests_{0}.yml".format(tidx),
+            header + "- name: Test {0}\n  hosts: all\n  roles:\n    - {1}.{2}\n"
+            "  tasks:\n    - name: Include {3}\n      include_role:\n"
+            "        name: {3}\n".format(
+                tidx, SRC_OWNER, ROLE, others[tidx % len(others)] if others else ROLE
+            ),
+        )
+    for pidx in range(count):
+        name = "{0}_module{1}.py".format(ROLE, pidx)
+        (tests / "library").mkdir(parents=True, exist_ok=True)
+        (tests / "library" / name).symlink_to(Path("../../library") / name)
+    (tests / "module_utils").mkdir(parents=True, exist_ok=True)
+    (tests / "module_utils" / (ROLE + "_lsr")).symlink_to(
+        Path("../../module_utils") / (ROLE + "_lsr")
+    )
+    (tests / "roles").mkdir(parents=True, exist_ok=True)
+    (tests / "roles" / "{0}.{1}".format(SRC_OWNER, ROLE)).symlink_to("../..")
+
+    # top level files
+    write_file(
+        role / "README.md",
+        "# {0}\n\nUse {1}.{0} with:\n\n".format(ROLE, SRC_OWNER)
+        + "".join("* {0}\n".format(other) for other in others),
+    )
+    write_file(role / "CHANGELOG.md", "Changelog\n=========\n")
+    write_file(role / "LICENSE", "license\n")
+    write_file(role / ".ansible-lint", header + "exclude_paths:\n  - tests/roles/\n")
+    write_file(
+        role / "examples" / "simple.yml",
+        header + "- hosts: all\n  roles:\n    - {0}.{1}\n".format(SRC_OWNER, ROLE),
+    )
+    return role
+
+
+def get_mappings(params):
+    """Return the --extra-mapping value which maps each other role."""
+    return ",".join(
+        "{0}.other{1}:mynamespace.mycoll.newother{1}".format(SRC_OWNER, idx)
+        for idx in range(params["mappings"])
+    )
+
+
+def get_tree_size(path):
+    """Return the number of regular files under path and their total size,
+    without following symlinks."""
+    files = 0
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            st = os.lstat(os.path.join(dirpath, filename))
+            if stat.S_ISREG(st.st_mode):
+                files += 1
+                size += st.st_size
+    return files, size
+
+
+def measure_yaml_setup(role, repeat):
+    """Return the number of the .yml files of the role, and the time in
+    seconds which creating and configuring a round-trip YAML for each of them
+    takes, compared to reusing one YAML for all of them as the conversion
+    does.  The fastest of repeat measurements is returned."""
+    from ruamel.yaml import YAML
+
+    def new_yaml():
+        yml = YAML(typ="rt")
+        yml.default_flow_style = False
+        yml.preserve_quotes = True
+        yml.width = 1024
+        yml.indent(mapping=2, sequence=4, offset=2)
+        return yml
+
+    texts = [path.read_text() for path in sorted(role.rglob("*.yml"))]
+    fresh = []
+    reused = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            new_yaml().load(text)
+        fresh.append(time.perf_counter() - start)
+        yml = new_yaml()
+        start = time.perf_counter()
+        for text in texts:
+            yml.load(text)
+        reused.append(time.perf_counter() - start)
+    return len(texts), max(min(fresh) - min(reused), 0.0)
+
+
+def run_conversion(script, src_path, dest_path, params, extra_args):
+    """Convert the synthetic role once into an empty dest_path, and return the
+    wall time, the CPU time, and the peak RSS in MB of the conversion."""
+    if dest_path.exists():
+        shutil.rmtree(dest_path)
+    dest_path.mkdir(parents=True)
+    cmd = [
+        sys.executable,
+        str(script),
+        "--namespace",
+        NAMESPACE,
+        "--collection",
+        COLLECTION,
+        "--src-path",
+        str(src_path / SRC_OWNER),
+        "--dest-path",
+        str(dest_path),
+        "--role",
+        ROLE,
+        "--readme",
+        str(TOPDIR / "lsr_role2collection" / "collection_readme.md"),
+        "--meta-runtime",
+        str(TOPDIR / "lsr_role2collection" / "runtime.yml"),
+        "--extra-mapping",
+        get_mappings(params),
+    ] + extra_args
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    # wait4 returns the resource usage of this conversion only - which includes
+    # the worker processes it waited for
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.monotonic() - start
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return wall, rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss / 1024.0
+
+
+def run_benchmark(args, params):
+    """Generate the role, convert it args.repeat times, and return the result
+    of the fastest run."""
+    work_dir = args.work_dir
+    tmpdir = None
+    if work_dir is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        work_dir = Path(tmpdir.name)
+    try:
+        src_path = work_dir / "src"
+        role = gen_role(src_path, params)
+        files, size = get_tree_size(role)
+        yml_files, yaml_setup = measure_yaml_setup(role, args.repeat)
+        runs = [
+            run_conversion(
+                args.script, src_path, work_dir / "dest", params, args.extra_args
+            )
+            for _ in range(args.repeat)
+        ]
+    finally:
+        if tmpdir:
+            tmpdir.cleanup()
+    wall, cpu, _ = min(runs)
+    return {
+        "params": params,
+        "args": args.extra_args,
+        "files": files,
+        "bytes": size,
+        "wall": round(wall, 3),
+        "cpu": round(cpu, 3),
+        "files_per_sec": round(files / wall, 1),
+        "mb_per_sec": round(size / wall / 1024.0 / 1024.0, 3),
+        "peak_rss_mb": round(max(run[2] for run in runs), 1),
+        "yml_files": yml_files,
+        "yaml_setup_ms": round(yaml_setup * 1000.0, 1),
+        "repeat": args.repeat,
+        "python": platform.python_version(),
+        "machine": "{0} {1} cpus".format(platform.machine(), os.cpu_count()),
+    }
+
+
+def compare_result(result, baseline, tolerance):
+    """Print result compared to baseline, and return the list of the values
+    which regressed by more than tolerance percent."""
+    regressions = []
+    for key, higher_is_better in COMPARED.items():
+        old = baseline[key]
+        new = result[key]
+        change = (new - old) * 100.0 / old if old else 0.0
+        regressed = -change if higher_is_better else change
+        status = ""
+        if regressed > tolerance:
+            status = "REGRESSION"
+            regressions.append(key)
+        print(
+            "{0:>14} {1:>12} {2:>12} {3:>+8.1f}% {4}".format(
+                key, old, new, change, status
+            )
+        )
+    return regressions
+
+
+def load_baselines(path):
+    if path.exists():
+        with open(path) as bf:
+            return json.load(bf)
+    return {}
+
+
+def save_baselines(path, baselines):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as bf:
+        json.dump(baselines, bf, indent=2, sort_keys=True)
+        bf.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        usage="%(prog)s [options] [-- LSR_ROLE2COLLECTION_ARGS ...]",
+    )
+    parser.add_argument(
+        "--size",
+        choices=sorted(SIZES),
+        default="medium",
+        help="Size of the synthetic role; default to medium",
+    )
+    for option, help_str in (
+        ("task-files", "Number of task files"),
+        ("tasks", "Number of tasks in each task file and subrole"),
+        ("depth", "Depth of the nested blocks in each task file"),
+        ("subroles", "Number of subroles under roles/"),
+        ("module-utils", "Number of modules and module_utils packages"),
+        ("tests", "Number of test playbooks"),
+        ("mappings", "Number of roles mapped with --extra-mapping"),
+    ):
+        parser.add_argument(
+            "--" + option,
+            type=int,
+            default=None,
+            help="{0}; default to the value for --size".format(help_str),
+        )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of conversions; the fastest one is reported; default to 3",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=Path,
+        default=None,
+        help="Directory in which to generate and convert the role; default to "
+        "a temporary directory which is removed afterwards",
+    )
+    parser.add_argument(
+        "--script",
+        type=Path,
+        default=TOPDIR / "lsr_role2collection.py",
+        help="lsr_role2collection.py to benchmark; default to the one next to "
+        "this script",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=None,
+        help="JSON file of the baseline results to compare the result to, or "
+        "to store the result in",
+    )
+    parser.add_argument(
+        "--name",
+        default=None,
+        help="Name of the result in the baseline file; default to the size and "
+        "the lsr_role2collection.py arguments",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Store the result in the baseline file instead of comparing it",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=10.0,
+        help="Percentage by which the result may be worse than the baseline; "
+        "default to 10",
+    )
+    argv = sys.argv[1:]
+    extra_args = []
+    if "--" in argv:
+        idx = argv.index("--")
+        argv, extra_args = argv[:idx], argv[idx:][1:]
+    args = parser.parse_args(argv)
+    args.extra_args = extra_args
+
+    params = dict(SIZES[args.size])
+    for key in params:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    name = args.name or " ".join([args.size] + extra_args)
+
+    result = run_benchmark(args, params)
+    print(
+        "{0}: {1} files, {2:.2f} MB in {3:.3f}s ({4:.3f}s CPU): "
+        "{5} files/sec, {6} MB/sec, peak RSS {7} MB".format(
+            name,
+            result["files"],
+            result["bytes"] / 1024.0 / 1024.0,
+            result["wall"],
+            result["cpu"],
+            result["files_per_sec"],
+            result["mb_per_sec"],
+            result["peak_rss_mb"],
+        )
+    )
+    print(
+        "YAML engine setup: {0} ms for {1} .yml files, {2:.1f}% of the conversion "
+        "CPU time if not reused".format(
+            result["yaml_setup_ms"],
+            result["yml_files"],
+            result["yaml_setup_ms"] / 10.0 / result["cpu"] if result["cpu"] else 0.0,
+        )
+    )
+    if args.baseline is None:
+        return 0
+
+    baselines = load_baselines(args.baseline)
+    baseline = baselines.get(name)
+    if baseline and baseline["params"] != params and not args.update_baseline:
+        print(
+            "ERROR: baseline {0} was measured with {1} - use --update-baseline "
+            "or another --name".format(name, baseline["params"])
+        )
+        return 2
+    if baseline is None or args.update_baseline:
+        baselines[name] = result
+        save_baselines(args.baseline, baselines)
+        print("Stored baseline {0} in {1}".format(name, args.baseline))
+        return 0
+    print("{0:>14} {1:>12} {2:>12} {3:>9}".format("", "baseline", "result", "change"))
+    if compare_result(result, baseline, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,12 +17,26 @@ fi
 if [ ! -d "$COLLECTION_DEST_PATH" ]; then
     mkdir -p "$COLLECTION_DEST_PATH"
 fi
+role_args=()
 for role in $ROLES
 do
     if [ ! -d "$COLLECTION_SRC_PATH/$role" ]; then
-        cd "$COLLECTION_SRC_PATH" || exit
-        git clone https://github.com/linux-system-roles/"$role"
+        if [ -n "${COLLECTION_MIRROR_PATH:-}" ]; then
+            # same mirror layout as release_collection.py --mirror-path
+            mirror="$COLLECTION_MIRROR_PATH/linux-system-roles/$role.git"
+            if [ -d "$mirror" ]; then
+                git -C "$mirror" fetch -q --tags origin
+            else
+                git clone -q --mirror https://github.com/linux-system-roles/"$role" "$mirror"
+                git -C "$mirror" config gc.pruneExpire never
+            fi
+            git clone --shared "$mirror" "$COLLECTION_SRC_PATH/$role"
+        else
+            cd "$COLLECTION_SRC_PATH" || exit
+            git clone https://github.com/linux-system-roles/"$role"
+        fi
     fi
     cd "$CWD" || exit
-    python lsr_role2collection.py --readme lsr_role2collection/collection_readme.md --role "$role" --src-owner "$COLLECTION_SRC_OWNER" --namespace "$COLLECTION_NAMESPACE" --collection "$COLLECTION_NAME"
+    role_args+=(--role "$role")
 done
+python lsr_role2collection.py --readme lsr_role2collection/collection_readme.md "${role_args[@]}" --src-owner "$COLLECTION_SRC_OWNER" --namespace "$COLLECTION_NAMESPACE" --collection "$COLLECTION_NAME"
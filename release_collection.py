@@ -13,14 +13,25 @@
 """
 
 import argparse
+import fcntl
+import fnmatch
+import hashlib
+import io
 import logging
 import os
+import queue
 import re
 import shutil
 import subprocess
+import stat
 import sys
+import tarfile
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from pathlib import Path
 
 try:
     import yaml
@@ -29,6 +40,8 @@ except ImportError:
 
 import json
 
+import lsr_role2collection
+
 try:
     from packaging.version import parse as parse_version
 except ImportError:
@@ -224,34 +237,200 @@ def ref_is_hash(ref):
     raise ValueError(f"The ref [{str(ref)}] has no recognized format")
 
 
-def get_latest_tag_hash(args, rolename, cur_ref, org, repo, use_commit_hash):
+GIT_QUERY_CACHE = "lsr_release_query.json"
+DESCRIBE_RE = re.compile(r"^(.+)-([0-9]+)-g([0-9a-f]{40})$")
+
+
+def git_main_branch(roledir):
+    """Return the name of the main branch of the origin of the repo."""
+    output = run_cmd(["git", "rev-parse", "--abbrev-ref", "origin/HEAD"], roledir)
+    return output.stdout.strip().split("/", 1)[1]
+
+
+def git_describe(roledir, refs):
     """
-    Get the latest tag, hash, and tag_is_latest from the upstream repo.
+    Describe the refs with the latest tag reachable from each of them in
+    one git process.
 
-    Clone and/or update the local copies of the repos.  Get
-    the latest tag and/or commit hash for each repo.  Indicate if
-    the tag is the latest commit.
+    Return a list of (tag, n_commits, commit_hash) tuples, or None in
+    place of a ref from which no tag is reachable.
+    """
+    describe_cmd = ["git", "describe", "--tags", "--long", "--abbrev=40", "--always"]
+    output = run_cmd(describe_cmd + refs, roledir)
+    rv = []
+    for line in output.stdout.splitlines():
+        match = DESCRIBE_RE.match(line.strip())
+        rv.append(match.groups() if match else None)
+    return rv
+
+
+def git_query_role(roledir, cur_ref, use_commit_hash):
+    """
+    Query the metadata of the checked out main branch HEAD of the role repo
+    needed to update its ref: the number of commits since cur_ref, the
+    latest tag and the number of commits since it, the commit hash, the
+    commit subjects since cur_ref, and the latest tag before cur_ref if
+    cur_ref is a commit hash.
+
+    The result depends only on the HEAD and cur_ref commits and on the tags,
+    so it is cached in the git dir of the repo keyed by their hashes - when
+    nothing changed upstream, the only git processes run are the rev-parse
+    of the commits and the listing of the tags.
+    """
+    shas = [run_cmd(["git", "rev-parse", "HEAD"], roledir).stdout.strip()]
+    cur_ref_found = False
+    if cur_ref:
+        try:
+            cur_ref_output = run_cmd(
+                ["git", "rev-parse", "--verify", "-q", cur_ref + "^{commit}"], roledir
+            )
+            shas.append(cur_ref_output.stdout.strip())
+            cur_ref_found = True
+        except subprocess.CalledProcessError:
+            # e.g. the tag was deleted upstream - like git log CUR_REF.. did,
+            # fall back to the latest tag of HEAD, with no previous tag
+            logging.debug(f"ref {cur_ref} not found in {roledir}")
+            shas.append("")
+    # a new or moved tag changes what describe returns for the same commits
+    tags_output = run_cmd(
+        ["git", "for-each-ref", "--format=%(objectname) %(refname)", "refs/tags"],
+        roledir,
+    )
+    tags_hash = hashlib.sha256(tags_output.stdout.encode("utf-8")).hexdigest()
+    key = ":".join(shas + [tags_hash, str(bool(use_commit_hash))])
+    cache_file = os.path.join(roledir, ".git", GIT_QUERY_CACHE)
+    try:
+        with open(cache_file, encoding="utf-8") as cf:
+            cache = json.load(cf)
+    except (OSError, ValueError):
+        cache = {}
+    if cache.get("key") == key:
+        logging.debug(f"using cached git metadata for {roledir} {key}")
+        return cache["query"]
+    since = f"{cur_ref}..HEAD" if cur_ref else "HEAD"
+    count_output = run_cmd(
+        ["git", "rev-list", "--count", since if cur_ref_found else "HEAD"], roledir
+    )
+    query = {
+        "count": count_output.stdout.strip(),
+        "tag": None,
+        "n_commits": "0",
+        "commit_hash": shas[0],
+        "commit_msgs": "",
+        "prev_tag": None,
+    }
+    if query["count"] != "0":
+        describe_refs = ["HEAD"]
+        if cur_ref_found and ref_is_hash(cur_ref):
+            describe_refs.append(cur_ref)
+        described = git_describe(roledir, describe_refs)
+        if described[0]:
+            query["tag"], query["n_commits"], _ = described[0]
+        else:
+            # no tags
+            query["n_commits"] = query["count"]
+        if len(described) > 1 and described[1]:
+            query["prev_tag"] = described[1][0]
+        if query["n_commits"] != "0" and use_commit_hash:
+            # get commit messages to use for changelog
+            log_cmd = [
+                "git",
+                "log",
+                "--no-merges",
+                "--reverse",
+                "--pretty=format:%s",
+                since,
+            ]
+            log_output = run_cmd(log_cmd, roledir)
+            query["commit_msgs"] = log_output.stdout.replace("\\r", "")
+    # only the query for the current key is ever used - keep just that one
+    cache = {"key": key, "query": query}
+    try:
+        tmp = cache_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as cf:
+            json.dump(cache, cf, sort_keys=True)
+        os.replace(tmp, cache_file)
+    except OSError as exc:
+        logging.debug(f"Could not save the git metadata cache {cache_file}: {exc}")
+    return query
+
+
+# guards mirror_locks - the role repos may be refreshed in several threads
+mirrors_lock = threading.Lock()
+# the lock for each mirror, held while it is created or fetched
+mirror_locks = {}
+# the mirrors fetched in this run
+mirrors_fetched = set()
+
+
+def refresh_mirror(args, org, repo):
+    """
+    Create or update the bare mirror of the repo under --mirror-path.
+
+    The mirror is fetched from the network at most once per run, however
+    many role clones are made from it.  Return the path of the mirror.
+    """
+    mirror = os.path.join(args.mirror_path, org, repo + ".git")
+    with mirrors_lock:
+        lock = mirror_locks.setdefault(mirror, threading.Lock())
+    with lock:
+        if mirror in mirrors_fetched:
+            pass
+        elif os.path.isdir(mirror):
+            _ = run_cmd(["git", "fetch", "-q", "--tags", "origin"], mirror)
+        else:
+            _ = run_cmd(
+                [
+                    "git",
+                    "clone",
+                    "-q",
+                    "--mirror",
+                    f"{DEFAULT_GIT_SITE}/{org}/{repo}",
+                    mirror,
+                ],
+            )
+            # the clones made from the mirror share its objects - they must
+            # never be pruned from it
+            _ = run_cmd(["git", "config", "gc.pruneExpire", "never"], mirror)
+        mirrors_fetched.add(mirror)
+    return mirror
+
+
+def refresh_role_repo(args, rolename, cur_ref, org, repo):
+    """
+    Clone and/or update the local copy of the role repo.
+
+    Check out the main branch and pull the tags, or with --no-update,
+    check out cur_ref.  This is all of the network access needed by
+    get_latest_tag_hash.  Return the name of the main branch.
     """
     roledir = os.path.join(args.src_path, rolename)
+    upstream_url = f"{DEFAULT_GIT_SITE}/{org}/{repo}"
+    if args.mirror_path:
+        # a new clone is made locally from the mirror, and uses it as the
+        # origin, so the fetch below does not use the network either
+        url = refresh_mirror(args, org, repo)
+        clone_opts = ["--shared"]
+    else:
+        url = upstream_url
+        clone_opts = []
     # clone and/or update role repo
     if os.path.isdir(roledir):
-        _ = run_cmd(["git", "fetch"], roledir)
+        if url != upstream_url:
+            # an existing clone of the upstream repo is switched to the mirror
+            # - a clone of another origin is left alone
+            origin = run_cmd(["git", "remote", "get-url", "origin"], roledir)
+            if origin.stdout.strip() == upstream_url:
+                _ = run_cmd(["git", "remote", "set-url", "origin", url], roledir)
+        _ = run_cmd(["git", "fetch", "--tags"], roledir)
     else:
         _ = run_cmd(
-            [
-                "git",
-                "-c",
-                "advice.detachedHead=false",
-                "clone",
-                "-q",
-                f"{DEFAULT_GIT_SITE}/{org}/{repo}",
-                roledir,
-            ],
+            ["git", "-c", "advice.detachedHead=false", "clone", "-q"]
+            + clone_opts
+            + [url, roledir],
         )
-    branch_output = run_cmd(["git", "branch", "-r"], roledir)
     # determine what is the main branch, check it out, and update it
-    mmatch = re.search(r"origin/HEAD -> origin/(\w+)", branch_output.stdout)
-    main_branch = mmatch.group(1)
+    main_branch = git_main_branch(roledir)
     if args.no_update:
         if cur_ref:
             ref_to_checkout = cur_ref
@@ -262,79 +441,99 @@ def get_latest_tag_hash(args, rolename, cur_ref, org, repo, use_commit_hash):
             # ensure it is up-to-date - if roledir already existed, we may
             # need to update the main branch
             _ = run_cmd(["git", "pull"], roledir)
+    else:
+        # the fetch above got the tags - the main branch only has to be
+        # fast-forwarded, without fetching again
+        _ = run_cmd(["git", "checkout", main_branch], roledir)
+        _ = run_cmd(["git", "merge", "--ff-only", "-q", "@{upstream}"], roledir)
+    return main_branch
+
+
+def refresh_role_repos(args, coll_rel, rolenames):
+    """
+    Refresh the role repos with up to --git-jobs git processes at a time.
+
+    Most of the time spent in git is waiting for the network, so the repos
+    are refreshed concurrently while the version and changelog decisions are
+    made, and the roles converted, one role at a time.  Yield the role name
+    and the name of its main branch, in the order of rolenames, as soon as
+    each role repo is refreshed.  If any repo cannot be refreshed, the errors
+    of all of the roles are reported after all of the repos are done, and an
+    exception is raised.
+    """
+    with ThreadPoolExecutor(max_workers=max(args.git_jobs, 1)) as executor:
+        futures = {
+            rolename: executor.submit(
+                refresh_role_repo,
+                args,
+                rolename,
+                coll_rel[rolename]["ref"],
+                coll_rel[rolename].get("org", args.src_owner),
+                coll_rel[rolename].get("repo", rolename),
+            )
+            for rolename in rolenames
+        }
+        for rolename, future in futures.items():
+            if future.exception():
+                break
+            yield rolename, future.result()
+        else:
+            return
+    failed = []
+    for rolename, future in futures.items():
+        exc = future.exception()
+        if isinstance(exc, subprocess.CalledProcessError):
+            logging.error(
+                "Could not refresh the repo of role %s: %s\n%s",
+                rolename,
+                exc,
+                (exc.stderr or "").strip(),
+            )
+            failed.append(rolename)
+        elif exc:
+            logging.error("Could not refresh the repo of role %s: %s", rolename, exc)
+            failed.append(rolename)
+    raise Exception("Could not refresh the repos of roles {}".format(", ".join(failed)))
+
+
+def get_latest_tag_hash(
+    args, rolename, cur_ref, org, repo, use_commit_hash, main_branch=None
+):
+    """
+    Get the latest tag, hash, and tag_is_latest from the upstream repo.
+
+    Clone and/or update the local copies of the repos, unless main_branch
+    is given, meaning that refresh_role_repo has already done it.  Get
+    the latest tag and/or commit hash for each repo.  Indicate if
+    the tag is the latest commit.
+    """
+    roledir = os.path.join(args.src_path, rolename)
+    if main_branch is None:
+        main_branch = refresh_role_repo(args, rolename, cur_ref, org, repo)
+    if args.no_update:
         # we're done - the rest of this stuff is to figure out how to update to
         # the latest tag or commit hash
         return (cur_ref, None, True, "", None)
-    _ = run_cmd(["bash", "-c", f"git checkout {main_branch}; git pull --tags"], roledir)
-    # see if there have been any commits since the last time we checked
-    if cur_ref:
-        count_output = run_cmd(
-            ["bash", "-c", f"git log --oneline {cur_ref}.. | wc -l"],
-            roledir,
-        )
-    else:
-        count_output = run_cmd(
-            ["bash", "-c", "git log --oneline | wc -l"],
-            roledir,
-        )
     # NOTE: At this point, main HEAD is checked out
+    query = git_query_role(roledir, cur_ref, use_commit_hash)
     ref_to_checkout = cur_ref  # checkout this ref, may be changed below
     tag, commit_hash, n_commits, prev_tag = None, None, "0", None
     commit_msgs = ""
-    if count_output.stdout == "0":
+    if query["count"] == "0":
         logging.debug(f"no changes to role {rolename} since ref {cur_ref}")
     else:
-        # get latest tag and commit hash
-        try:
-            describe_cmd = ["git", "describe", "--tags", "--long", "--abbrev=40"]
-            describe_output = run_cmd(describe_cmd, roledir)
-            tag, n_commits, g_hash = describe_output.stdout.strip().rsplit("-", 2)
-            # NOTE: if the role hasn't been tagged since cur_ref, then tag == cur_ref
-            if tag == cur_ref:
-                tag = None
-            else:
-                ref_to_checkout = tag  # use the new tag to build collection
-            # commit hash - skip leading "g"
-            if use_commit_hash:
-                commit_hash = g_hash[1:]
-        except subprocess.CalledProcessError:
-            # no tags
-            tag, n_commits = None, count_output.stdout
-            if use_commit_hash:
-                rev_parse_output = run_cmd(["git", "rev-parse", "HEAD"], roledir)
-                commit_hash = rev_parse_output.stdout.strip()
+        # NOTE: if the role hasn't been tagged since cur_ref, then tag == cur_ref
+        tag, n_commits = query["tag"], query["n_commits"]
+        if tag == cur_ref:
+            tag = None
+        elif tag:
+            ref_to_checkout = tag  # use the new tag to build collection
+        if use_commit_hash:
+            commit_hash = query["commit_hash"]
         if n_commits != "0" and use_commit_hash:
-            # get commit messages to use for changelog
-            log_cmd = [
-                "git",
-                "log",
-                "--oneline",
-                "--no-merges",
-                "--reverse",
-                "--pretty=format:%s",
-            ]
-            if cur_ref:
-                log_cmd.append(f"{cur_ref}..")
-            log_output = run_cmd(log_cmd, roledir)
-            commit_msgs = log_output.stdout.replace("\\r", "")
+            commit_msgs = query["commit_msgs"]
             ref_to_checkout = commit_hash
-        # get previous tag in case cur_ref is a commit hash
-        if ref_is_hash(cur_ref):
-            try:
-                describe_cmd = [
-                    "git",
-                    "describe",
-                    "--tags",
-                    "--long",
-                    "--abbrev=40",
-                    cur_ref,
-                ]
-                describe_output = run_cmd(describe_cmd, roledir)
-                prev_tag = describe_output.stdout.strip().split("-")[0]
-            except subprocess.CalledProcessError:
-                prev_tag = None  # no previous tag
-        else:
-            prev_tag = None  # no previous tag
+        prev_tag = query["prev_tag"]
     if ref_to_checkout:
         # make sure the right tag/commit is checked out
         _ = run_cmd(["git", "checkout", ref_to_checkout], roledir)
@@ -403,22 +602,206 @@ def process_ignore_and_lint_files(args, coll_dir):
                 ign_fd.writelines(lines)
 
 
-def role_to_collection(
-    args,
-    rolename,
-    namespace,
-    collection_name,
-    collection_readme,
-):
-    """Convert the role to collection format."""
-    subrole_prefix = f"private_{rolename}_subrole_"
+class ConverterLogFilter(logging.Filter):
+    """Only let the errors from the converter through.  The converter may run
+    in another thread while this script logs, so the level of the root logger
+    cannot be used for this."""
+
+    def filter(self, record):
+        return (
+            record.levelno >= logging.ERROR
+            or record.module != lsr_role2collection.__name__
+        )
+
+
+# ioctl to share the data blocks of a file with another one (reflink)
+FICLONE = 0x40049409
+
+
+def clone_file(src, dest):
+    """Copy the file src to dest, sharing its data blocks if the filesystem
+    supports it."""
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+            cloned = True
+        except OSError:
+            cloned = False
+    if not cloned:
+        shutil.copyfile(src, dest)
+    shutil.copymode(src, dest)
+
+
+# the sha256 of the files whose contents are known, e.g. the files copied from
+# the RoleTreeCache - path: (size, mtime_ns, sha256)
+known_file_hashes = {}
+
+
+def remember_file_hash(path, digest):
+    """Record the sha256 digest of the contents of the file path, which is
+    valid as long as the size and modification time of the file are."""
+    st = os.stat(path)
+    known_file_hashes[path] = (st.st_size, st.st_mtime_ns, digest)
+
+
+def get_known_file_hash(path):
+    """Return the recorded sha256 of the file path, or None if it is not known
+    or the file was changed since."""
+    known = known_file_hashes.get(path)
+    if known:
+        st = os.stat(path)
+        if known[:2] == (st.st_size, st.st_mtime_ns):
+            return known[2]
+    return None
+
+
+class RoleTreeCache(object):
+    """
+    Cache of the files which the conversion of a role contributes to the
+    collection - its roles/, tests/, docs/ and plugins/ files, README links
+    and meta mappings.
+
+    An entry is keyed by the role name, the commit hash of the role source,
+    the collection namespace and name, the conversion arguments of the role
+    and the version of lsr_role2collection, so a role which did not change
+    since the last release is copied from the cache instead of converted.
+    The files are copied with reflinks where possible - they are not hard
+    linked because the release rewrites some collection files in place.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def make_key(self, args, role, namespace, collection_name):
+        """Return the cache key of role, or None if its source is not a clean
+        git checkout."""
+        roledir = os.path.join(args.src_path, role["role"])
+        try:
+            commit_hash = run_cmd(["git", "rev-parse", "HEAD"], roledir).stdout
+            status = run_cmd(["git", "status", "--porcelain"], roledir).stdout
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        if status.strip():
+            logging.debug(f"role {role['role']} has local changes - not cached")
+            return None
+        data = json.dumps(
+            [
+                commit_hash.strip(),
+                namespace,
+                collection_name,
+                args.src_owner,
+                role,
+                lsr_role2collection.get_converter_version(),
+            ],
+            sort_keys=True,
+        )
+        return role["role"] + "-" + hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the path of the entry for key, or None if not cached."""
+        entry = os.path.join(self.cache_dir, key)
+        if key and os.path.isfile(os.path.join(entry, "role.json")):
+            return entry
+        return None
+
+    def convert(self, conv_args, role, key):
+        """Convert role alone into a new entry for key, and return its path.
+        If key is None, the entry is only a temporary one."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        staging = tempfile.mkdtemp(
+            prefix=(key or role["role"]) + ".", dir=self.cache_dir
+        )
+        role_args = argparse.Namespace(**vars(conv_args))
+        role_args.dest_path = Path(staging)
+        converter = lsr_role2collection.LSRCollectionConverter(role_args)
+        converter.convert_roles([role])
+        dest = str(converter.dest_path)
+        # The paths to the role in the collection are absolute in some files,
+        # e.g. include_vars: /path/to/ROLE/vars/main.yml
+        rewrite = []
+        hashes = {}
+        for root, dirs, files in os.walk(dest):
+            for filename in files:
+                path = os.path.join(root, filename)
+                if not os.path.islink(path):
+                    with open(path, "rb") as fd:
+                        data = fd.read()
+                    if dest.encode("utf-8") in data:
+                        rewrite.append(os.path.relpath(path, dest))
+                    else:
+                        relpath = os.path.relpath(path, dest)
+                        hashes[relpath] = hashlib.sha256(data).hexdigest()
+        role_json = {
+            "dest": dest,
+            "coll_path": os.path.relpath(dest, os.path.realpath(staging)),
+            "rewrite": rewrite,
+            "hashes": hashes,
+            "readme_entries": converter.readme_entries,
+            "meta_mappings": converter.meta_mappings,
+        }
+        with open(os.path.join(staging, "role.json"), "w") as fd:
+            json.dump(role_json, fd)
+        if not key:
+            return staging
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # converted concurrently by another release
+            shutil.rmtree(staging)
+        return entry
+
+    def materialize(self, entry, converter):
+        """Copy the files of the entry into the collection of converter, and
+        add its README links and meta mappings."""
+        with open(os.path.join(entry, "role.json")) as fd:
+            role_json = json.load(fd)
+        src_dest = role_json["dest"]
+        coll_dest = str(converter.dest_path)
+        rewrite = set(role_json["rewrite"])
+        hashes = role_json["hashes"]
+        src_top = os.path.join(entry, role_json["coll_path"])
+        for root, dirs, files in os.walk(src_top):
+            relroot = os.path.relpath(root, src_top)
+            os.makedirs(os.path.join(coll_dest, relroot), exist_ok=True)
+            for name in dirs + files:
+                src = os.path.join(root, name)
+                relpath = os.path.normpath(os.path.join(relroot, name))
+                dest = os.path.join(coll_dest, relpath)
+                if os.path.islink(src):
+                    if os.path.lexists(dest):
+                        os.unlink(dest)
+                    os.symlink(os.readlink(src), dest)
+                elif os.path.isdir(src):
+                    continue
+                elif relpath in rewrite:
+                    with open(src, "rb") as fd:
+                        data = fd.read()
+                    data = data.replace(
+                        src_dest.encode("utf-8"), coll_dest.encode("utf-8")
+                    )
+                    if os.path.lexists(dest):
+                        os.unlink(dest)
+                    with open(dest, "wb") as fd:
+                        fd.write(data)
+                    shutil.copymode(src, dest)
+                    remember_file_hash(dest, hashlib.sha256(data).hexdigest())
+                else:
+                    if os.path.lexists(dest):
+                        os.unlink(dest)
+                    clone_file(src, dest)
+                    remember_file_hash(dest, hashes[relpath])
+        converter.add_entries(
+            [tuple(item) for item in role_json["readme_entries"]],
+            [tuple(item) for item in role_json["meta_mappings"]],
+        )
+
+
+def get_converter_args(args, namespace, collection_name, collection_readme):
+    """Return the lsr_role2collection arguments used to convert the roles."""
     cmd = [
-        sys.executable,
-        "lsr_role2collection.py",
         "--src-owner",
         args.src_owner,
-        "--role",
-        rolename,
         "--src-path",
         args.src_path,
         "--dest-path",
@@ -427,22 +810,99 @@ def role_to_collection(
         namespace,
         "--collection",
         collection_name,
-        "--subrole-prefix",
-        subrole_prefix,
         "--readme",
         collection_readme,
+        "--role-jobs",
+        str(args.role_jobs),
     ]
-    extra_mapping = ""
-    comma = ""
-    if rolename == "sshd":
-        # HACK - special case for ansible-sshd - not fully qualified
-        extra_mapping = f"ansible-sshd:{namespace}.{collection_name}.{rolename}"
-        comma = ","
-    if args.extra_mapping:
-        extra_mapping = extra_mapping + comma + args.extra_mapping
-    if extra_mapping:
-        cmd.extend(["--extra-mapping", extra_mapping])
-    _ = run_cmd(cmd)
+    return lsr_role2collection.get_parser().parse_args(cmd)
+
+
+def cached_roles_to_collection(
+    args, conv_args, converter, roles, namespace, collection_name
+):
+    """Convert the roles into the collection of converter through the cache
+    in --role-cache-dir.  The roles which are not cached are converted alone,
+    up to --role-jobs at a time, into new cache entries.  Then the entries
+    are copied into the collection in the order of roles."""
+    cache = RoleTreeCache(args.role_cache_dir)
+    with ThreadPoolExecutor(max_workers=max(args.role_jobs, 1)) as executor:
+        entries = []
+        for role in roles:
+            key = cache.make_key(args, role, namespace, collection_name)
+            entry = cache.get(key)
+            if entry:
+                logging.info("Using the cached conversion of role [%s]", role["role"])
+                entries.append((key, entry))
+            else:
+                entries.append(
+                    (key, executor.submit(cache.convert, conv_args, role, key))
+                )
+        for key, entry in entries:
+            if not isinstance(entry, str):
+                entry = entry.result()
+            cache.materialize(entry, converter)
+            if not key:
+                shutil.rmtree(entry)
+
+
+def roles_to_collection(
+    args,
+    rolenames,
+    namespace,
+    collection_name,
+    collection_readme,
+):
+    """Convert the roles to collection format in one run of the converter.
+
+    rolenames may be a generator which yields each role when its sources
+    are ready - the role is converted while the next ones are waited for."""
+    conv_args = get_converter_args(args, namespace, collection_name, collection_readme)
+
+    def get_roles():
+        for rolename in rolenames:
+            extra_mapping = ""
+            comma = ""
+            if rolename == "sshd":
+                # HACK - special case for ansible-sshd - not fully qualified
+                extra_mapping = f"ansible-sshd:{namespace}.{collection_name}.{rolename}"
+                comma = ","
+            if args.extra_mapping:
+                extra_mapping = extra_mapping + comma + args.extra_mapping
+            yield {
+                "role": rolename,
+                "subrole_prefix": f"private_{rolename}_subrole_",
+                "extra_mapping": extra_mapping,
+            }
+
+    root_logger = logging.getLogger()
+    log_filter = ConverterLogFilter()
+    if not args.debug:
+        # only show the errors from the converter
+        root_logger.addFilter(log_filter)
+    try:
+        converter = lsr_role2collection.LSRCollectionConverter(conv_args)
+        if args.role_cache_dir:
+            cached_roles_to_collection(
+                args, conv_args, converter, get_roles(), namespace, collection_name
+            )
+        else:
+            converter.convert_roles(get_roles(), jobs=conv_args.role_jobs)
+        converter.finish()
+    finally:
+        root_logger.removeFilter(log_filter)
+
+
+def queued_roles(role_queue):
+    """Yield the role names put in role_queue until None is put.  An exception
+    put in role_queue is raised."""
+    while True:
+        rolename = role_queue.get()
+        if rolename is None:
+            return
+        if isinstance(rolename, Exception):
+            raise rolename
+        yield rolename
 
 
 def update_galaxy_version(args, galaxy, versions_updated):
@@ -539,6 +999,250 @@ def create_collection_extra_files(args, coll_dir, galaxy=None):
                     eef.write("  {0}\n".format(eed))
 
 
+# the format of MANIFEST.json and FILES.json
+MANIFEST_FORMAT = 1
+# the keys of galaxy.yml, and their defaults, as ansible-galaxy reads them
+GALAXY_LIST_KEYS = ("authors", "license", "tags", "build_ignore")
+GALAXY_STR_KEYS = (
+    "namespace",
+    "name",
+    "version",
+    "readme",
+    "description",
+    "license_file",
+    "repository",
+    "documentation",
+    "homepage",
+    "issues",
+)
+# the dirs which ansible-galaxy never puts in the collection artifact
+BUILD_IGNORE_DIRS = frozenset(
+    ["CVS", ".bzr", ".hg", ".git", ".svn", "__pycache__", ".tox"]
+)
+
+
+def get_collection_meta(coll_dir):
+    """Return the contents of the galaxy.yml of the collection, with the
+    defaults that ansible-galaxy uses for the missing keys."""
+    with open(os.path.join(coll_dir, "galaxy.yml")) as galaxy_fd:
+        meta = yaml.safe_load(galaxy_fd)
+    for key in GALAXY_STR_KEYS:
+        meta.setdefault(key, None)
+    for key in GALAXY_LIST_KEYS:
+        if meta.get(key) is None:
+            meta[key] = []
+        elif not isinstance(meta[key], list):
+            meta[key] = [meta[key]]
+    meta.setdefault("dependencies", {})
+    if not meta["version"]:
+        meta["version"] = "*"
+    return meta
+
+
+def is_child_path(path, parent):
+    """Is path, or the target of the symlink path, in or under parent?"""
+    path = os.path.realpath(path)
+    return path == parent or path.startswith(parent + os.sep)
+
+
+def get_collection_files(coll_dir, meta):
+    """
+    Return the (relative path, ftype) of each dir and file to put in the
+    collection artifact, in the same way as ansible-galaxy collection build
+    does it, except that the entries are sorted.
+    """
+    ignore_patterns = [
+        "MANIFEST.json",
+        "FILES.json",
+        "galaxy.yml",
+        "galaxy.yaml",
+        ".git",
+        "*.pyc",
+        "*.retry",
+        "tests/output",
+        f"{meta['namespace']}-{meta['name']}-*.tar.gz",
+    ] + meta["build_ignore"]
+    coll_dir = os.path.realpath(coll_dir)
+    entries = []
+
+    def walk(reldir):
+        for item in sorted(os.listdir(os.path.join(coll_dir, reldir))):
+            relpath = os.path.join(reldir, item)
+            path = os.path.join(coll_dir, relpath)
+            ignored = any(fnmatch.fnmatch(relpath, pat) for pat in ignore_patterns)
+            if os.path.isdir(path):
+                if item in BUILD_IGNORE_DIRS or ignored:
+                    continue
+                if os.path.islink(path) and not is_child_path(path, coll_dir):
+                    logging.warning(
+                        "Skipping %s as it is a symbolic link to a directory "
+                        "outside the collection",
+                        path,
+                    )
+                    continue
+                entries.append((relpath, "dir"))
+                if not os.path.islink(path):
+                    walk(relpath)
+            elif not ignored:
+                entries.append((relpath, "file"))
+
+    walk("")
+    return entries
+
+
+def hash_collection_file(path):
+    """Return the sha256 of the contents of the file path, and the contents,
+    or None if the sha256 was already known."""
+    realpath = os.path.realpath(path)
+    if not os.path.exists(realpath):
+        raise Exception(
+            f"Failed to find the target path '{realpath}' for the symlink '{path}'."
+        )
+    digest = get_known_file_hash(realpath)
+    if digest:
+        return digest, None
+    with open(realpath, "rb") as fd:
+        data = fd.read()
+    return hashlib.sha256(data).hexdigest(), data
+
+
+def build_collection_tarball(args, coll_dir):
+    """
+    Build the NAMESPACE-NAME-VERSION.tar.gz collection artifact in
+    --dest-path, in the same format as ansible-galaxy collection build.
+
+    The files are hashed in --build-jobs threads, unless their hashes are
+    already known, and each file is read once - the contents of the files
+    which had to be hashed are kept to be written to the tarball.  Return
+    the path of the artifact.
+    """
+    meta = get_collection_meta(coll_dir)
+    coll_dir = os.path.realpath(coll_dir)
+    artifact = os.path.join(
+        args.dest_path, f"{meta['namespace']}-{meta['name']}-{meta['version']}.tar.gz"
+    )
+    if os.path.isdir(artifact):
+        raise Exception(
+            f"The output collection artifact '{artifact}' already exists, "
+            "but is a directory - aborting"
+        )
+    if os.path.exists(artifact) and not args.force:
+        raise Exception(
+            f"The file '{artifact}' already exists. You can use --force to "
+            "re-create the collection artifact."
+        )
+    entries = get_collection_files(coll_dir, meta)
+    file_paths = [
+        os.path.join(coll_dir, relpath) for relpath, ftype in entries if ftype == "file"
+    ]
+    with ThreadPoolExecutor(max_workers=max(args.build_jobs, 1)) as executor:
+        hashed = dict(zip(file_paths, executor.map(hash_collection_file, file_paths)))
+
+    def make_entry(name, ftype, chksum=None):
+        return {
+            "name": name,
+            "ftype": ftype,
+            "chksum_type": "sha256" if chksum else None,
+            "chksum_sha256": chksum,
+            "format": MANIFEST_FORMAT,
+        }
+
+    files_manifest = {
+        "files": [make_entry(".", "dir")],
+        "format": MANIFEST_FORMAT,
+    }
+    for relpath, ftype in entries:
+        if ftype == "file":
+            digest = hashed[os.path.join(coll_dir, relpath)][0]
+            files_manifest["files"].append(make_entry(relpath, ftype, digest))
+        else:
+            files_manifest["files"].append(make_entry(relpath, ftype))
+    files_json = json.dumps(files_manifest, indent=True).encode("utf-8")
+    manifest = {
+        "collection_info": {
+            "namespace": meta["namespace"],
+            "name": meta["name"],
+            "version": meta["version"],
+            "authors": meta["authors"],
+            "readme": meta["readme"],
+            "tags": meta["tags"],
+            "description": meta["description"],
+            "license": meta["license"],
+            "license_file": meta["license_file"] or None,
+            "dependencies": meta["dependencies"],
+            "repository": meta["repository"],
+            "documentation": meta["documentation"],
+            "homepage": meta["homepage"],
+            "issues": meta["issues"],
+        },
+        "file_manifest_file": {
+            "name": "FILES.json",
+            "ftype": "file",
+            "chksum_type": "sha256",
+            "chksum_sha256": hashlib.sha256(files_json).hexdigest(),
+            "format": MANIFEST_FORMAT,
+        },
+        "format": MANIFEST_FORMAT,
+    }
+    manifest_json = json.dumps(manifest, indent=True).encode("utf-8")
+
+    def reset_stat(tarinfo):
+        if tarinfo.type != tarfile.SYMTYPE:
+            if tarinfo.mode & stat.S_IXUSR or tarinfo.isdir():
+                tarinfo.mode = 0o755
+            else:
+                tarinfo.mode = 0o644
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ""
+        return tarinfo
+
+    tmp_fd, tmp_artifact = tempfile.mkstemp(dir=args.dest_path, suffix=".tar.gz")
+    try:
+        with os.fdopen(tmp_fd, "wb") as tmp_file, tarfile.open(
+            fileobj=tmp_file, mode="w:gz"
+        ) as tar_file:
+            for name, data in (
+                ("MANIFEST.json", manifest_json),
+                ("FILES.json", files_json),
+            ):
+                tar_info = tarfile.TarInfo(name)
+                tar_info.size = len(data)
+                tar_info.mtime = int(time.time())
+                tar_info.mode = 0o644
+                tar_file.addfile(tar_info, io.BytesIO(data))
+            for relpath, ftype in entries:
+                path = os.path.join(coll_dir, relpath)
+                if os.path.islink(path) and is_child_path(path, coll_dir):
+                    tar_info = tarfile.TarInfo(relpath)
+                    tar_info.type = tarfile.SYMTYPE
+                    tar_info.linkname = os.path.relpath(
+                        os.path.realpath(path), os.path.dirname(path)
+                    )
+                    tar_file.addfile(reset_stat(tar_info))
+                    continue
+                tar_info = reset_stat(
+                    tar_file.gettarinfo(os.path.realpath(path), arcname=relpath)
+                )
+                if ftype == "dir":
+                    tar_file.addfile(tar_info)
+                    continue
+                data = hashed[path][1]
+                if data is None:
+                    with open(os.path.realpath(path), "rb") as fd:
+                        tar_file.addfile(tar_info, fd)
+                else:
+                    tar_file.addfile(tar_info, io.BytesIO(data))
+        os.chmod(tmp_artifact, 0o644)
+        os.replace(tmp_artifact, artifact)
+    except BaseException:
+        os.unlink(tmp_artifact)
+        raise
+    logging.info(
+        "Created collection for %s.%s at %s", meta["namespace"], meta["name"], artifact
+    )
+    return artifact
+
+
 def build_collection(args, coll_dir, galaxy=None):
     create_collection_extra_files(args, coll_dir, galaxy)
     # removing dot files/dirs
@@ -553,6 +1257,13 @@ def build_collection(args, coll_dir, galaxy=None):
             else:
                 os.unlink(full_name)
 
+    if args.native_build and "manifest" in get_collection_meta(coll_dir):
+        logging.info(
+            "galaxy.yml has a manifest key - building with ansible-galaxy instead"
+        )
+    elif args.native_build:
+        build_collection_tarball(args, coll_dir)
+        return
     if shutil.which("ansible-galaxy"):
         build_args = ["ansible-galaxy", "collection", "build", "-v"]
         if args.force:
@@ -606,6 +1317,84 @@ def convert_md2rst(coll_dir):
         )
 
 
+def update_role(
+    args, galaxy, coll_rel, rolename, main_branch, versions_updated, cl_manager
+):
+    """
+    Update the ref of the role in collection_release.yml, versions_updated,
+    the changelog, and the collection dependencies of galaxy.
+
+    The role repo has already been refreshed by refresh_role_repo, unless
+    --skip-git is used.
+    """
+    if not args.skip_git:
+        if args.use_commit_hash and rolename not in args.use_commit_hash_role:
+            args.use_commit_hash_role.append(rolename)
+        cur_ref = coll_rel[rolename]["ref"]
+        tag, cm_hash, tag_is_latest, commit_msgs, prev_tag = get_latest_tag_hash(
+            args,
+            rolename,
+            coll_rel[rolename]["ref"],
+            coll_rel[rolename].get("org", args.src_owner),
+            coll_rel[rolename].get("repo", rolename),
+            rolename in args.use_commit_hash_role,
+            main_branch,
+        )
+        if tag or cm_hash:
+            if tag_is_latest or rolename not in args.use_commit_hash_role:
+                coll_rel[rolename]["ref"] = tag
+            else:
+                coll_rel[rolename]["ref"] = cm_hash
+            if not tag_is_latest and not args.no_auto_version:
+                logging.debug(
+                    f"role {rolename} tag {tag} is not the latest commit {cm_hash}"
+                )
+            check_versions_updated(cur_ref, coll_rel[rolename]["ref"], versions_updated)
+        # If a version update is detected, retrieve the new changelogs from CHANGELOG.md
+        if not args.skip_changelog:
+            new_ref = coll_rel[rolename]["ref"]
+            if comp_versions(cur_ref, new_ref) < 0:
+                if prev_tag is None:
+                    prev_tag = cur_ref
+                logging.info(
+                    "The role [%s] is updated. Getting changelog entries from [%s] to [%s].",
+                    rolename,
+                    prev_tag,
+                    new_ref,
+                )
+                cl_manager.addRoleChangelog(
+                    args, rolename, commit_msgs, prev_tag, new_ref
+                )
+            else:
+                logging.info("No updates for role [%s] since [%s]", rolename, cur_ref)
+    this_collection = galaxy["namespace"] + "." + galaxy["name"]
+    legacy_rqf = "requirements.yml"
+    coll_rqf = "collection-requirements.yml"
+    for rqf in [legacy_rqf, coll_rqf]:
+        req_yml = os.path.join(args.src_path, rolename, "meta", rqf)
+        if os.path.isfile(req_yml):
+            req_yml_hsh = yaml.safe_load(open(req_yml))
+            if isinstance(req_yml_hsh, list):
+                continue  # legacy role format
+            if rqf == legacy_rqf:
+                logging.warning(
+                    "The role %s is still using %s - please convert to %s instead",
+                    rolename,
+                    rqf,
+                    coll_rqf,
+                )
+            for coll in req_yml_hsh.get("collections", []):
+                if isinstance(coll, dict):
+                    coll_name = coll["name"]
+                    coll_ver = coll.get("version", "*")
+                else:
+                    coll_name = coll
+                    coll_ver = "*"
+                if coll_name != this_collection:
+                    galaxy_deps = galaxy.setdefault("dependencies", {})
+                    galaxy_deps[coll_name] = coll_ver
+
+
 def update_collection(args, galaxy, coll_rel):
     """
     Update refs in collection_release.yml.
@@ -630,89 +1419,56 @@ def update_collection(args, galaxy, coll_rel):
             )
     os.makedirs(coll_dir, exist_ok=True)
     collection_readme = os.path.join("lsr_role2collection", "collection_readme.md")
+    cl_manager = None
     if not args.skip_changelog:
         cl_manager = ChangelogManager()
     # major, minor, micro, hash
     versions_updated = [False, False, False, False]
-    for rolename in args.include:
-        if rolename == "mainid":
-            continue
-        if not args.skip_git:
-            if args.use_commit_hash and rolename not in args.use_commit_hash_role:
-                args.use_commit_hash_role.append(rolename)
-            cur_ref = coll_rel[rolename]["ref"]
-            tag, cm_hash, tag_is_latest, commit_msgs, prev_tag = get_latest_tag_hash(
-                args,
-                rolename,
-                coll_rel[rolename]["ref"],
-                coll_rel[rolename].get("org", args.src_owner),
-                coll_rel[rolename].get("repo", rolename),
-                rolename in args.use_commit_hash_role,
-            )
-            if tag or cm_hash:
-                if tag_is_latest or rolename not in args.use_commit_hash_role:
-                    coll_rel[rolename]["ref"] = tag
-                else:
-                    coll_rel[rolename]["ref"] = cm_hash
-                if not tag_is_latest and not args.no_auto_version:
-                    logging.debug(
-                        f"role {rolename} tag {tag} is not the latest commit {cm_hash}"
-                    )
-                check_versions_updated(
-                    cur_ref, coll_rel[rolename]["ref"], versions_updated
-                )
-            # If a version update is detected, retrieve the new changelogs from CHANGELOG.md
-            if not args.skip_changelog:
-                new_ref = coll_rel[rolename]["ref"]
-                if comp_versions(cur_ref, new_ref) < 0:
-                    if prev_tag is None:
-                        prev_tag = cur_ref
-                    logging.info(
-                        "The role [%s] is updated. Getting changelog entries from [%s] to [%s].",
-                        rolename,
-                        prev_tag,
-                        new_ref,
-                    )
-                    cl_manager.addRoleChangelog(
-                        args, rolename, commit_msgs, prev_tag, new_ref
-                    )
-                else:
-                    logging.info(
-                        "No updates for role [%s] since [%s]", rolename, cur_ref
-                    )
-        role_to_collection(
+    rolenames = [rolename for rolename in args.include if rolename != "mainid"]
+    if args.skip_git:
+        refreshed = ((rolename, None) for rolename in rolenames)
+    else:
+        refreshed = refresh_role_repos(args, coll_rel, rolenames)
+    # Each role is converted in another thread as soon as its ref is decided
+    # and checked out, while the next role repos are refreshed.  The decisions
+    # are still made one role at a time, in order.
+    role_queue = queue.Queue()
+    # the worker processes of the converter are forked - this must be done
+    # before the conversion thread is started
+    conv_args = get_converter_args(
+        args, galaxy["namespace"], galaxy["name"], collection_readme
+    )
+    lsr_role2collection.start_xfrm_pool(conv_args.jobs)
+    with ThreadPoolExecutor(max_workers=1) as conversion_thread:
+        conversion = conversion_thread.submit(
+            roles_to_collection,
             args,
-            rolename,
+            queued_roles(role_queue),
             galaxy["namespace"],
             galaxy["name"],
             collection_readme,
         )
-        this_collection = galaxy["namespace"] + "." + galaxy["name"]
-        legacy_rqf = "requirements.yml"
-        coll_rqf = "collection-requirements.yml"
-        for rqf in [legacy_rqf, coll_rqf]:
-            req_yml = os.path.join(args.src_path, rolename, "meta", rqf)
-            if os.path.isfile(req_yml):
-                req_yml_hsh = yaml.safe_load(open(req_yml))
-                if isinstance(req_yml_hsh, list):
-                    continue  # legacy role format
-                if rqf == legacy_rqf:
-                    logging.warning(
-                        "The role %s is still using %s - please convert to %s instead",
-                        rolename,
-                        rqf,
-                        coll_rqf,
-                    )
-                for coll in req_yml_hsh.get("collections", []):
-                    if isinstance(coll, dict):
-                        coll_name = coll["name"]
-                        coll_ver = coll.get("version", "*")
-                    else:
-                        coll_name = coll
-                        coll_ver = "*"
-                    if coll_name != this_collection:
-                        galaxy_deps = galaxy.setdefault("dependencies", {})
-                        galaxy_deps[coll_name] = coll_ver
+        try:
+            for rolename, main_branch in refreshed:
+                update_role(
+                    args,
+                    galaxy,
+                    coll_rel,
+                    rolename,
+                    main_branch,
+                    versions_updated,
+                    cl_manager,
+                )
+                role_queue.put(rolename)
+                if conversion.done():
+                    # the conversion failed - stop the release now instead of
+                    # after all of the roles are updated
+                    conversion.result()
+        except BaseException:
+            role_queue.put(Exception("the roles were not all updated"))
+            raise
+        role_queue.put(None)
+        conversion.result()
     # Existing changelogs
     orig_cl_file = "lsr_role2collection/COLLECTION_CHANGELOG.md"
     # Collection changelog file path
@@ -1053,6 +1809,54 @@ def main():
             "and collection as well as the given FQCN with other FQCN."
         ),
     )
+    parser.add_argument(
+        "--role-jobs",
+        type=int,
+        default=int(os.environ.get("COLLECTION_ROLE_JOBS", 1)),
+        help="Number of roles to convert to collection format concurrently.",
+    )
+    parser.add_argument(
+        "--role-cache-dir",
+        type=str,
+        default=os.environ.get("COLLECTION_ROLE_CACHE_DIR"),
+        help=(
+            "Path to a directory to cache the converted roles in.  A role "
+            "whose commit and conversion arguments did not change is copied "
+            "from the cache instead of converted."
+        ),
+    )
+    parser.add_argument(
+        "--mirror-path",
+        type=str,
+        default=os.environ.get("COLLECTION_MIRROR_PATH"),
+        help=(
+            "Path to a directory of bare mirrors of the role repos, "
+            "MIRROR_PATH/ORG/REPO.git, created if missing.  The role repos "
+            "are cloned from the mirrors with --shared, and the existing "
+            "clones of the upstream repos are switched to fetch from them."
+        ),
+    )
+    parser.add_argument(
+        "--git-jobs",
+        type=int,
+        default=int(os.environ.get("COLLECTION_GIT_JOBS", 1)),
+        help="Number of role repos to clone or update concurrently.",
+    )
+    parser.add_argument(
+        "--native-build",
+        default=False,
+        action="store_true",
+        help=(
+            "Build the collection artifact in this script instead of with "
+            "ansible-galaxy collection build."
+        ),
+    )
+    parser.add_argument(
+        "--build-jobs",
+        type=int,
+        default=int(os.environ.get("COLLECTION_BUILD_JOBS", 1)),
+        help="Number of threads to hash the collection files with, for --native-build.",
+    )
     parser.add_argument(
         "--changelog-rst",
         default=False,
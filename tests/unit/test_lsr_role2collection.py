@@ -1,22 +1,46 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 """unit tests for lsr_role2collection"""
 
+import io
+import json
 import os
 import re
 import shutil
 import tempfile
 import textwrap
+import threading
 from pathlib import Path
 import unittest
+from unittest import mock
 
+import lsr_role2collection
 from lsr_role2collection import (
     file_replace,
     copy_tree_with_replace,
-    import_replace,
-    from_replace,
+    LSRCollectionReadme,
+    LSRFileTransformer,
+    LSRImportRewriter,
+    LSRModuleUtilsIndex,
+    LSRPipeline,
+    LSRProfiler,
+    LSRPrefilter,
+    LSRReplacer,
+    LSRRoleNames,
+    LSRScheduler,
+    LSRSymlinks,
+    LSRTransformer,
+    LSRWatcher,
+    lsr_copytree,
     gather_module_utils_parts,
     add_rolename,
-    config,
+    diff_trees,
+    get_tree_file_diff,
+    get_yaml_engine,
+    new_yaml_engine,
+    profile_phase,
+    profile_role,
+    yaml_dump,
+    yaml_load,
 )
 
 src_path = os.environ.get("COLLECTION_SRC_PATH", "/var/tmp/linux-system-roles")
@@ -156,6 +180,56 @@ class LSRRole2Collection(unittest.TestCase):
         )
         self.check_test_tree(Path(tmpdir.name), test_yaml_str, post_params, ".yml")
 
+    def test_lsr_replacer(self):
+        """test LSRReplacer applies all mappings in one pass"""
+
+        tmpdir = tempfile.TemporaryDirectory()
+        top = Path(tmpdir.name)
+        (top / "sub").mkdir()
+        (top / "README.md").write_text(
+            "linux-system-roles.other0 and other1 here\nfedora.linux_system_roles.x\n"
+        )
+        (top / "sub" / "unchanged.md").write_text("nothing to see\n")
+        (top / "sub" / "skipped.txt").write_text("linux-system-roles.other0\n")
+        os.utime(top / "sub" / "unchanged.md", (0, 0))
+        replacer = LSRReplacer(
+            [
+                ("linux-system-roles.other0", otherprefixdot + newotherroles[0]),
+                (" other1", " " + prefixdot + newotherroles[1]),
+                (r"fedora\.linux_system_roles\.(\w+)", r"ns.coll.\1"),
+                # output of the first mapping is not replaced again
+                (otherprefixdot, "not.this."),
+            ]
+        )
+        replacer.replace_in_tree(top, ["*.md"])
+        self.assertEqual(
+            (top / "README.md").read_text(),
+            "{0}{1} and {2}{3} here\nns.coll.x\n".format(
+                otherprefixdot, newotherroles[0], prefixdot, newotherroles[1]
+            ),
+        )
+        self.assertEqual(
+            (top / "sub" / "skipped.txt").read_text(), "linux-system-roles.other0\n"
+        )
+        # files with no match are not rewritten
+        self.assertEqual((top / "sub" / "unchanged.md").stat().st_mtime, 0)
+        self.assertEqual(LSRReplacer([]).sub("text"), "text")
+        # backreferences
+        self.assertEqual(LSRReplacer([(r"(a)\1", "X")]).sub("aab"), "Xb")
+        self.assertEqual(
+            LSRReplacer([("b", "B"), (r"(a)\1", "X"), ("c", "C")]).sub("aabc"),
+            "XBC",
+        )
+        # lookarounds with group references in the replacement
+        self.assertEqual(
+            LSRReplacer([(r"foo(?=x)", r"\g<0>bar")]).sub("foox fooy"),
+            "foobarx fooy",
+        )
+        replacer = LSRReplacer(
+            [("b", "B"), (r"foo(?=x)", r"\g<0>bar"), (r"(?<=x)(y)", r"[\1]")]
+        )
+        self.assertEqual(replacer.sub("foox fooy xy b"), "foobarx fooy x[y] B")
+
     def test_copy_tree_with_replace(self):
         """test copy_tree_with_replace"""
 
@@ -577,6 +651,704 @@ class LSRRole2Collection(unittest.TestCase):
         )
         shutil.rmtree(coll_path)
 
+    def test_lsr_transformer_jobs(self):
+        """test LSRTransformer with a process pool gives the same result"""
+
+        pre_params = [
+            {
+                "keyword": "roles",
+                "role_or_task_name": "linux-system-roles." + rolename,
+                "task_subkey": "",
+                "task_value": "",
+                "task_delim": "",
+                "task_subvalue": "",
+            },
+            {
+                "keyword": "tasks",
+                "role_or_task_name": "include_role:",
+                "task_subkey": "name:",
+                "task_value": "linux-system-roles",
+                "task_delim": ".",
+                "task_subvalue": rolename,
+            },
+        ]
+        transformer_args = {
+            "namespace": namespace,
+            "collection": collection_name,
+            "prefix": prefixdot,
+            "subrole_prefix": "",
+            "replace_dot": "_",
+            "role_modules": set(),
+            "src_owner": "linux-system-roles",
+            "top_dir": dest_path,
+            "extra_mapping_src_owner": [],
+            "extra_mapping_src_role": [],
+            "extra_mapping_dest_prefix": [],
+            "extra_mapping_dest_role": [],
+        }
+        tmpdir = tempfile.TemporaryDirectory()
+        results = []
+        for jobs in (1, 3):
+            path = Path(tmpdir.name) / str(jobs)
+            self.create_test_tree(path, test_yaml_str, pre_params * 4, ".yml")
+            # not a vars, meta, or tasks file - LSRException - left as is
+            (path / "scalar.yml").write_text("just a string\n")
+            transformer_args["jobs"] = jobs
+            LSRTransformer(
+                path, transformer_args, False, rolename, rolename, LSRFileTransformer
+            ).run()
+            results.append(
+                {
+                    str(pp.relative_to(path)): pp.read_text()
+                    for pp in path.rglob("*.yml")
+                }
+            )
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1]["scalar.yml"], "just a string\n")
+        self.assertIn(prefixdot + rolename, results[1]["sub0/test0.yml"])
+
+    def test_lsr_transformer_cache(self):
+        """test LSRTransformer takes unchanged files from the cache"""
+
+        params = [
+            {
+                "keyword": "roles",
+                "role_or_task_name": "linux-system-roles." + rolename,
+                "task_subkey": "",
+                "task_value": "",
+                "task_delim": "",
+                "task_subvalue": "",
+            },
+        ]
+        tmpdir = tempfile.TemporaryDirectory()
+        transformer_args = {
+            "namespace": namespace,
+            "collection": collection_name,
+            "prefix": prefixdot,
+            "subrole_prefix": "",
+            "replace_dot": "_",
+            "role_modules": set(),
+            "src_owner": "linux-system-roles",
+            "top_dir": dest_path,
+            "extra_mapping_src_owner": [],
+            "extra_mapping_src_role": [],
+            "extra_mapping_dest_prefix": [],
+            "extra_mapping_dest_role": [],
+            "cache_dir": Path(tmpdir.name) / "cache",
+        }
+        transform_file = lsr_role2collection.transform_file
+        results = []
+        for run in range(2):
+            path = Path(tmpdir.name) / str(run)
+            self.create_test_tree(path, test_yaml_str, params * 2, ".yml")
+            if run:
+                # only the changed file is transformed again
+                (path / "sub0" / "sub1" / "test1.yml").write_text(
+                    "---\n- hosts: x\n  roles:\n    - linux-system-roles.%s\n"
+                    % rolename
+                )
+            with mock.patch(
+                "lsr_role2collection.transform_file", return_value=None
+            ) as mock_xfrm:
+                if not run:
+                    mock_xfrm.side_effect = transform_file
+                LSRTransformer(
+                    path,
+                    transformer_args,
+                    False,
+                    rolename,
+                    rolename,
+                    LSRFileTransformer,
+                ).run()
+            results.append(mock_xfrm.call_args_list)
+        self.assertEqual(len(results[0]), 2)
+        self.assertEqual(len(results[1]), 1)
+        self.assertTrue(results[1][0][0][1].endswith("test1.yml"))
+        self.assertIn(
+            prefixdot + rolename,
+            (Path(tmpdir.name) / "1" / "sub0" / "test0.yml").read_text(),
+        )
+
+    def test_lsr_file_transformer_unchanged(self):
+        """test LSRFileTransformer does not rewrite a file it did not change"""
+
+        tmpdir = tempfile.TemporaryDirectory()
+        transformer_args = {
+            "namespace": namespace,
+            "collection": collection_name,
+            "prefix": prefixdot,
+            "subrole_prefix": "",
+            "replace_dot": "_",
+            "role_modules": set(),
+            "src_owner": "linux-system-roles",
+            "top_dir": dest_path,
+            "extra_mapping_src_owner": [],
+            "extra_mapping_src_role": [],
+            "extra_mapping_dest_prefix": [],
+            "extra_mapping_dest_role": [],
+        }
+        unchanged = Path(tmpdir.name) / "unchanged.yml"
+        # not the canonical ruamel format - dumping would reformat it
+        unchanged_str = (
+            "# uses " + rolename + "\n- hosts: all\n  roles:\n      - other_role\n"
+        )
+        unchanged.write_text(unchanged_str)
+        os.utime(unchanged, (0, 0))
+        changed = Path(tmpdir.name) / "changed.yml"
+        changed.write_text(
+            "- hosts: all\n  roles:\n      - linux-system-roles." + rolename + "\n"
+        )
+        for path in (unchanged, changed):
+            lsrft = LSRFileTransformer(str(path), rolename, rolename, transformer_args)
+            lsrft.run()
+            lsrft.write()
+        self.assertEqual(unchanged.read_text(), unchanged_str)
+        self.assertEqual(unchanged.stat().st_mtime, 0)
+        self.assertIn(prefixdot + rolename, changed.read_text())
+
+    def test_yaml_engine(self):
+        """test the YAML engine of a thread is reused, and dumps each document
+        the same way as a new one does"""
+
+        yml = get_yaml_engine()
+        self.assertIs(get_yaml_engine(), yml)
+        self.assertIsNot(get_yaml_engine(explicit_start=True), yml)
+        engines = []
+        thread = threading.Thread(target=lambda: engines.append(get_yaml_engine()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(engines[0], yml)
+
+        docs = [
+            "%TAG !lsr! tag:example.com,2024:\n---\nkey: !lsr!thing 'quoted'\n",
+            'list:\n- a  # comment\n- "b"\n',
+        ]
+        expected = []
+        for doc in docs:
+            fresh = new_yaml_engine()
+            outstrm = io.StringIO()
+            fresh.dump(fresh.load(doc), outstrm)
+            expected.append(outstrm.getvalue())
+        # load both documents before dumping them
+        loaded = [yaml_load(yml, doc) for doc in docs]
+        for (data, tags), result in zip(loaded, expected):
+            outstrm = io.StringIO()
+            yaml_dump(yml, data, tags, outstrm)
+            self.assertEqual(outstrm.getvalue(), result)
+
+    def test_lsr_copytree_existing(self):
+        """test lsr_copytree keeps identical files and removes stale ones"""
+
+        tmpdir = tempfile.TemporaryDirectory()
+        src = Path(tmpdir.name) / "src"
+        dest = Path(tmpdir.name) / "dest"
+        (src / "sub").mkdir(parents=True)
+        (src / "sub" / "same.txt").write_text("same\n")
+        (src / "sub" / "changed.txt").write_text("old\n")
+        (src / "sub" / "stale.txt").write_text("stale\n")
+        (src / "sub" / "link.txt").symlink_to("same.txt")
+        lsr_copytree(src, dest, dirs_exist_ok=True)
+        same_ino = (dest / "sub" / "same.txt").stat().st_ino
+        (src / "sub" / "changed.txt").write_text("new contents\n")
+        (src / "sub" / "stale.txt").unlink()
+        lsr_copytree(src, dest, dirs_exist_ok=True)
+        self.assertEqual((dest / "sub" / "same.txt").stat().st_ino, same_ino)
+        self.assertEqual((dest / "sub" / "changed.txt").read_text(), "new contents\n")
+        self.assertFalse((dest / "sub" / "stale.txt").exists())
+        self.assertEqual(os.readlink(dest / "sub" / "link.txt"), "same.txt")
+
+        with mock.patch.object(lsr_role2collection, "copy_mode", "hardlink"):
+            (src / "sub" / "main.yml").write_text("---\n")
+            (src / "sub" / "new.txt").write_text("new\n")
+            lsr_copytree(src, dest, dirs_exist_ok=True)
+        # yml files may be rewritten in place - never hardlinked
+        self.assertFalse((dest / "sub" / "main.yml").samefile(src / "sub" / "main.yml"))
+        self.assertTrue((dest / "sub" / "new.txt").samefile(src / "sub" / "new.txt"))
+
+    def test_lsr_symlinks(self):
+        """test LSRSymlinks removes and converts the symlinks of a tests tree"""
+
+        tmpdir = tempfile.TemporaryDirectory()
+        coll = Path(tmpdir.name) / "coll"
+        (coll / "plugins" / "modules").mkdir(parents=True)
+        (coll / "plugins" / "modules" / "my_module.py").write_text("")
+        (coll / "plugins" / "module_utils" / "myrole_lsr").mkdir(parents=True)
+        tests = coll / "tests" / "myrole"
+        for subdir in ("library", "module_utils", "roles", "linux-system-roles.myrole"):
+            (tests / subdir).mkdir(parents=True)
+        (tests / "library" / "my_module.py").symlink_to("../../library/my_module.py")
+        (tests / "library" / "missing.py").symlink_to("../../library/missing.py")
+        (coll / "plugins" / "module_utils" / "myrole_lsr" / "util.py").write_text("")
+        (tests / "module_utils" / "util.py").symlink_to("../../module_utils/util.py")
+        (tests / "module_utils" / "library").symlink_to("../../library")
+        # classified by the first of PLUGINS in the target, not the last one
+        (coll / "plugins" / "modules" / "module_utils").mkdir()
+        (coll / "plugins" / "modules" / "module_utils" / "x.py").write_text("")
+        (tests / "module_utils" / "x.py").symlink_to("../../library/module_utils/x.py")
+        (tests / "roles" / "linux-system-roles.myrole").symlink_to("../..")
+        (tests / "vars.yml").symlink_to("tests_default.yml")
+        symlinks = LSRSymlinks(tests)
+        self.assertEqual(len(symlinks.links), 7)
+        symlinks.cleanup("myrole", ["library", "modules", "module_utils", "roles"])
+        self.assertFalse((tests / "roles").exists())
+        self.assertFalse((tests / "linux-system-roles.myrole").exists())
+        self.assertFalse(os.path.lexists(tests / "module_utils" / "library"))
+        self.assertEqual(os.readlink(tests / "vars.yml"), "tests_default.yml")
+        symlinks.convert_plugins("myrole", coll)
+        self.assertEqual(
+            os.readlink(tests / "library" / "my_module.py"),
+            "../../../plugins/modules/my_module.py",
+        )
+        self.assertEqual(
+            os.readlink(tests / "library" / "missing.py"), "../../library/missing.py"
+        )
+        self.assertEqual(
+            os.readlink(tests / "module_utils" / "util.py"),
+            "../../../plugins/module_utils/myrole_lsr/util.py",
+        )
+        self.assertEqual(
+            os.readlink(tests / "module_utils" / "x.py"),
+            "../../../plugins/modules/module_utils/x.py",
+        )
+
+    def test_diff_trees(self):
+        """test diff_trees and get_tree_file_diff compare two trees"""
+
+        tmpdir = tempfile.TemporaryDirectory()
+        old = Path(tmpdir.name) / "old"
+        new = Path(tmpdir.name) / "new"
+        for top in (old, new):
+            (top / "sub").mkdir(parents=True)
+            (top / "same.yml").write_text("---\nsame: 1\n")
+            (top / "sub" / "changed.yml").write_text("---\na: 1\nb: 2\n")
+            (top / "script.sh").write_text("true\n")
+        (old / "deleted.md").write_text("gone\n")
+        (new / "added.md").write_text("new\n")
+        (new / "sub" / "changed.yml").write_text("---\na: 1\nb: 3\n")
+        (new / "script.sh").chmod(0o755)
+        (old / "link").symlink_to("same.yml")
+        (new / "link").symlink_to("sub/changed.yml")
+        changes = diff_trees(old, new)
+        self.assertEqual(
+            changes,
+            [
+                ("A", "added.md"),
+                ("D", "deleted.md"),
+                ("M", "link"),
+                ("M", "script.sh"),
+                ("M", "sub/changed.yml"),
+            ],
+        )
+        diff = get_tree_file_diff(
+            old / "sub" / "changed.yml", new / "sub" / "changed.yml", "sub/changed.yml"
+        )
+        self.assertIn("--- a/sub/changed.yml\n+++ b/sub/changed.yml\n", diff)
+        self.assertIn("\n-b: 2\n+b: 3\n", diff)
+        diff = get_tree_file_diff(old / "script.sh", new / "script.sh", "script.sh")
+        self.assertIn("old mode 100644\nnew mode 100755\n", diff)
+        diff = get_tree_file_diff(None, new / "added.md", "added.md")
+        self.assertIn("--- /dev/null\n+++ b/added.md\n", diff)
+
+    def test_lsr_scheduler(self):
+        """test LSRScheduler runs each step after the steps it depends on, and
+        raises the exception of a failed step"""
+
+        for jobs in (1, 4):
+            done = []
+            lock = threading.Lock()
+
+            def step(name, deps=()):
+                with lock:
+                    self.assertTrue(set(deps).issubset(done))
+                    done.append(name)
+                return name
+
+            sched = LSRScheduler(jobs)
+            copies = [sched.add(step, "copy{0}".format(idx)) for idx in range(5)]
+            flush = sched.add(
+                step, "flush", ["copy{0}".format(idx) for idx in range(5)], deps=copies
+            )
+            sched.add(step, "symlinks", ["flush"], deps=[flush])
+            sched.add(step, "docs")
+            results = sched.run()
+            self.assertEqual(
+                results,
+                ["copy0", "copy1", "copy2", "copy3", "copy4"]
+                + ["flush", "symlinks", "docs"],
+            )
+            self.assertEqual(sorted(done), sorted(results))
+            if jobs == 1:
+                self.assertEqual(done, results)
+
+            def fail():
+                raise lsr_role2collection.LSRException("failed")
+
+            sched = LSRScheduler(jobs)
+            failed = sched.add(fail)
+            sched.add(step, "after", deps=[failed])
+            done = []
+            with self.assertRaisesRegex(lsr_role2collection.LSRException, "failed"):
+                sched.run()
+            self.assertEqual(done, [])
+
+    def test_lsr_watcher(self):
+        """test LSRWatcher reports the changed, renamed, removed and new
+        files and directories"""
+
+        tmpdir = tempfile.TemporaryDirectory()
+        top = Path(tmpdir.name)
+        (top / "tasks").mkdir()
+        (top / "tasks" / "main.yml").write_text("---\n")
+        (top / "vars").mkdir()
+        (top / "vars" / "main.yml").write_text("---\n")
+        (top / ".git").mkdir()
+        watcher = LSRWatcher([top], delay=0.05)
+        self.addCleanup(watcher.close)
+        (top / "tasks" / "main.yml").write_text("---\n- debug:\n")
+        (top / "vars" / "main.yml").rename(top / "vars" / "other.yml")
+        (top / ".git" / "index").write_text("")
+        self.assertEqual(
+            watcher.wait(),
+            {
+                str(top / "tasks" / "main.yml"),
+                str(top / "vars" / "main.yml"),
+                str(top / "vars" / "other.yml"),
+            },
+        )
+        (top / "tests").mkdir()
+        self.assertEqual(watcher.wait(), {str(top / "tests")})
+        # the new directory is watched
+        (top / "tests" / "tests_default.yml").write_text("---\n")
+        shutil.rmtree(top / "vars")
+        self.assertEqual(
+            watcher.wait(),
+            {
+                str(top / "tests" / "tests_default.yml"),
+                str(top / "vars"),
+                str(top / "vars" / "other.yml"),
+            },
+        )
+
+    def test_lsr_pipeline(self):
+        """test LSRPipeline converts the files the same way as converting them
+        in place after copying them"""
+
+        params = [
+            {
+                "keyword": "roles",
+                "role_or_task_name": "linux-system-roles." + rolename,
+                "task_subkey": "",
+                "task_value": "",
+                "task_delim": "",
+                "task_subvalue": "",
+            },
+            {
+                "keyword": "tasks",
+                "role_or_task_name": "include_role:",
+                "task_subkey": "name:",
+                "task_value": "linux-system-roles",
+                "task_delim": ".",
+                "task_subvalue": rolename,
+            },
+        ]
+        transformer_args = {
+            "namespace": namespace,
+            "collection": collection_name,
+            "prefix": prefixdot,
+            "subrole_prefix": "",
+            "replace_dot": "_",
+            "role_modules": set(),
+            "src_owner": "linux-system-roles",
+            "top_dir": dest_path,
+            "extra_mapping_src_owner": [],
+            "extra_mapping_src_role": [],
+            "extra_mapping_dest_prefix": [],
+            "extra_mapping_dest_role": [],
+        }
+        tmpdir = tempfile.TemporaryDirectory()
+        role_path = Path(tmpdir.name) / "src" / rolename
+        self.create_test_tree(role_path / "tasks", test_yaml_str, params, ".yml")
+        (role_path / "files").mkdir()
+        (role_path / "files" / "data.yml").write_text("Ensure: 1\n")
+        mappings = [("Ensure", "Make sure")]
+        results = []
+        for use_pipeline in (False, True):
+            coll_path = Path(tmpdir.name) / str(use_pipeline)
+            pipeline = None
+            if use_pipeline:
+                pipeline = LSRPipeline(
+                    LSRReplacer(mappings), [(coll_path / "roles", ["*.yml"])]
+                )
+            copy_tree_with_replace(
+                role_path,
+                coll_path,
+                rolename,
+                rolename,
+                ("tasks", "files"),
+                transformer_args,
+                pipeline=pipeline,
+            )
+            if not pipeline:
+                LSRReplacer(mappings).replace_in_tree(coll_path / "roles", ["*.yml"])
+            results.append(
+                {
+                    str(pp.relative_to(coll_path)): pp.read_text()
+                    for pp in coll_path.rglob("*.yml")
+                }
+            )
+        self.assertEqual(results[0], results[1])
+        self.assertIn(
+            prefixdot + rolename, results[1]["roles/%s/tasks/sub0/test0.yml" % rolename]
+        )
+        self.assertIn("Make sure", results[1]["roles/%s/files/data.yml" % rolename])
+        self.assertEqual(len(pipeline.transformed), 2)
+        self.assertEqual(len(pipeline.replaced), 3)
+
+    def test_lsr_profiler(self):
+        """test LSRProfiler records the phases and the files of each role"""
+
+        params = [
+            {
+                "keyword": "roles",
+                "role_or_task_name": "linux-system-roles." + rolename,
+                "task_subkey": "",
+                "task_value": "",
+                "task_delim": "",
+                "task_subvalue": "",
+            },
+        ]
+        transformer_args = {
+            "namespace": namespace,
+            "collection": collection_name,
+            "prefix": prefixdot,
+            "subrole_prefix": "",
+            "replace_dot": "_",
+            "role_modules": set(),
+            "src_owner": "linux-system-roles",
+            "top_dir": dest_path,
+            "extra_mapping_src_owner": [],
+            "extra_mapping_src_role": [],
+            "extra_mapping_dest_prefix": [],
+            "extra_mapping_dest_role": [],
+        }
+        tmpdir = tempfile.TemporaryDirectory()
+        path = Path(tmpdir.name) / "tasks"
+        self.create_test_tree(path, test_yaml_str, params * 3, ".yml")
+        profiler = LSRProfiler()
+        with mock.patch.object(lsr_role2collection, "profiler", profiler):
+            with profile_role(rolename):
+                with profile_phase("transform"):
+                    LSRTransformer(
+                        path,
+                        transformer_args,
+                        False,
+                        rolename,
+                        rolename,
+                        LSRFileTransformer,
+                    ).run()
+            with profile_phase("readme"):
+                pass
+        report_path = Path(tmpdir.name) / "profile.json"
+        with mock.patch("builtins.print") as mock_print:
+            profiler.save(report_path, top=2)
+        report = json.loads(report_path.read_text())
+        self.assertEqual(set(report["roles"]), {rolename, "collection"})
+        self.assertEqual(report["phases"]["transform"]["count"], 1)
+        self.assertIn("readme", report["roles"]["collection"]["phases"])
+        self.assertEqual(len(report["files"]), 3)
+        self.assertEqual(report["files"][0]["role"], rolename)
+        self.assertGreaterEqual(report["files"][0]["wall"], report["files"][1]["wall"])
+        # the phases and the 2 slowest files are printed
+        self.assertEqual(mock_print.call_count, 2 + 2 + 1 + 2)
+
+    def test_lsr_role_names(self):
+        """test LSRRoleNames resolves each spelling of the role names"""
+
+        transformer_args = {
+            "prefix": prefixdot,
+            "subrole_prefix": "private_my_role_",
+            "replace_dot": "_",
+            "src_owner": "linux-system-roles",
+            "extra_mapping_src_owner": ["linux-system-roles", None, "other-owner"],
+            "extra_mapping_src_role": ["other0", "other1", "other1"],
+            "extra_mapping_dest_prefix": [otherprefixdot, None, None],
+            "extra_mapping_dest_role": ["newother0", "newother1", "unused"],
+        }
+        names = LSRRoleNames("my.role", "newrole", transformer_args)
+        for name in ("linux-system-roles.my.role", "my.role", "my_role", "myrole"):
+            self.assertEqual(names.resolve(name), prefixdot + "newrole")
+        self.assertEqual(names.resolve("other0"), otherprefixdot + "newother0")
+        self.assertEqual(
+            names.resolve("linux-system-roles.other0"), otherprefixdot + "newother0"
+        )
+        self.assertIsNone(names.resolve("someone.other0"))
+        # the first mapping of a role is used
+        self.assertEqual(
+            names.resolve("linux-system-roles.other1"), prefixdot + "newother1"
+        )
+        self.assertIsNone(names.resolve("other-owner.other1"))
+        self.assertEqual(
+            names.resolve("{{ role_path }}/roles/sub.role"),
+            prefixdot + "private_my_role_sub_role",
+        )
+        self.assertEqual(
+            names.resolve("{{ role_path }}/roles/private_my_role_sub.x"),
+            prefixdot + "private_my_role_sub_x",
+        )
+        self.assertIsNone(names.resolve("unknown.role"))
+        self.assertIn("unknown.role", names.names)
+
+    def test_lsr_prefilter(self):
+        """test LSRPrefilter only passes files which may have to be transformed"""
+
+        prefilter = LSRPrefilter(
+            "my_role",
+            {
+                "src_owner": "linux-system-roles",
+                "replace_dot": "_",
+                "role_modules": {"my_module"},
+                "extra_mapping_src_role": ["other0"],
+            },
+        )
+        may_change = [
+            b"roles:\n  - linux-system-roles.my_role\n",
+            b"roles:\n  - myrole\n",
+            b"- include_role:\n    name: my.role\n",
+            b"dependencies:\n  - other0\n",
+            b"- import_role:\n    name: '{{ role_path }}/roles/sub'\n",
+            b"- include_vars: ../linux-system-roles.x/vars/main.yml\n",
+            b"- my_module:\n    name: x\n",
+            b"vars:\n  roletoinclude: linux-system-roles.my_role\n",
+        ]
+        no_change = [
+            b"---\nmy_role_var: true\n",
+            b"- name: Restart\n  service:\n    name: my_role\n",
+            b"roles:\n  - other1\n",
+            b"- include_vars: vars/main.yml\n",
+        ]
+        for data in may_change:
+            self.assertTrue(prefilter.may_change(data), data)
+        for data in no_change:
+            self.assertFalse(prefilter.may_change(data), data)
+
+    def test_collection_readme(self):
+        """test LSRCollectionReadme renders the role links, and loads them back"""
+
+        tmpdir = tempfile.TemporaryDirectory()
+        main_doc = Path(tmpdir.name) / "README.md"
+        readme = LSRCollectionReadme.from_template(None, namespace, collection_name)
+        readme.add_link("README.md", "sshd", "### Supported Roles")
+        readme.add_link("README.md", "ssh", "### Supported Roles")
+        readme.add_link("README.md", "private_sshd_sub", "### Private Roles")
+        readme.add_link("README-devel.md", "sshd", "### Supported Roles")
+        readme.add_link("CHANGELOG.md", "sshd", "### Supported Roles")
+        readme.write(main_doc)
+        expected = textwrap.dedent("""\
+            # {0} {1} collections
+
+
+            ### Supported Roles
+
+            <!--ts-->
+              * sshd
+              * ssh
+              * sshd-devel
+            <!--te-->
+
+            ### Private Roles
+
+            <!--ts-->
+              * private_sshd_sub
+            <!--te-->
+            """).format(namespace, collection_name)
+        self.assertEqual(main_doc.read_text(), expected)
+
+        readme = LSRCollectionReadme.load(main_doc)
+        readme.add_link("README.md", "ssh", "### Supported Roles")
+        self.assertFalse(readme.changed)
+        readme.add_link("README.md", "timesync", "### Supported Roles")
+        self.assertTrue(readme.changed)
+        self.assertEqual(
+            readme.render(),
+            expected.replace("  * sshd-devel\n", "  * sshd-devel\n  * timesync\n"),
+        )
+
+    def test_collection_converter_roles(self):
+        """test converting several roles in one LSRCollectionConverter"""
+
+        tmpdir = tempfile.TemporaryDirectory()
+        top = Path(tmpdir.name)
+        roles = ["role0", "role1", "role2"]
+        for role in roles:
+            role_path = top / "linux-system-roles" / role
+            (role_path / "tasks").mkdir(parents=True)
+            (role_path / "tasks" / "main.yml").write_text(
+                "---\n- name: Include\n  include_role:\n"
+                "    name: linux-system-roles.{0}\n".format(role)
+            )
+            (role_path / "README.md").write_text("# linux-system-roles.%s\n" % role)
+            (role_path / "roles" / "sub" / "tasks").mkdir(parents=True)
+            (role_path / "roles" / "sub" / "tasks" / "main.yml").write_text("---\n")
+            (role_path / "roles" / "sub" / "README.md").write_text("# sub\n")
+        release_yml = top / "collection_release.yml"
+        release_yml.write_text(
+            "mainid:\n  ref: 1.0.0\n"
+            + "".join("{0}:\n  ref: 1.0.0\n".format(role) for role in roles[1:])
+        )
+        args = lsr_role2collection.get_parser().parse_args(
+            [
+                "--role",
+                roles[0],
+                "--roles-from",
+                str(release_yml),
+                "--src-path",
+                str(top / "linux-system-roles"),
+                "--dest-path",
+                str(top / "collections"),
+                "--namespace",
+                namespace,
+                "--collection",
+                collection_name,
+            ]
+        )
+        self.assertEqual(lsr_role2collection.get_roles(args), roles)
+        for jobs in (1, 3):
+            converter = lsr_role2collection.LSRCollectionConverter(args)
+            coll_path = converter.dest_path
+            converter.convert_roles(
+                [
+                    {"role": role, "subrole_prefix": "private_%s_subrole_" % role}
+                    for role in roles
+                ],
+                jobs=jobs,
+            )
+            # the collection README.md is only written by finish
+            self.assertFalse((coll_path / "README.md").exists())
+            converter.finish()
+            for role in roles:
+                self.assertIn(
+                    prefixdot + role,
+                    (coll_path / "roles" / role / "tasks" / "main.yml").read_text(),
+                )
+                self.assertTrue(
+                    (coll_path / "roles" / ("private_%s_subrole_sub" % role)).is_dir()
+                )
+            readme = (coll_path / "README.md").read_text()
+            self.assertIn(
+                "### Supported Roles\n\n<!--ts-->\n"
+                "  * role0\n  * role1\n  * role2\n<!--te-->",
+                readme,
+            )
+            self.assertIn(
+                "### Private Roles\n\n<!--ts-->\n"
+                "  * private_role0_subrole_sub\n"
+                "  * private_role1_subrole_sub\n"
+                "  * private_role2_subrole_sub\n<!--te-->",
+                readme,
+            )
+            self.assertTrue((coll_path / "meta" / "runtime.yml").is_file())
+            shutil.rmtree(coll_path)
+
     def test_import_replace(self):
         module_names = ["util0", "util1"]
         src_module_utils = []
@@ -611,18 +1383,19 @@ class LSRRole2Collection(unittest.TestCase):
         IMPORT_RE = re.compile(
             rb"(\bimport) (ansible\.module_utils\.)(\S+)(.*)(\s+#.+|.*)$", flags=re.M
         )
-        config["namespace"] = namespace
-        config["collection"] = collection_name
-        config["role"] = rolename
-        config["src_path"] = Path(src_path) / rolename
-        config["dest_path"] = dest_base_dir
-        config["module_utils_dir"] = dest_module_dir_core
-        config["module_utils"] = [
-            [b"util0"],
-            [b"util1"],
-        ]
-        config["additional_rewrites"] = []
-        output = IMPORT_RE.sub(import_replace, input)
+        rewriter = LSRImportRewriter(
+            namespace,
+            collection_name,
+            rolename,
+            Path(src_path) / rolename,
+            dest_base_dir,
+            dest_module_dir_core,
+            [
+                [b"util0"],
+                [b"util1"],
+            ],
+        )
+        output = IMPORT_RE.sub(lambda match: rewriter.import_replace(match, []), input)
         self.assertEqual(output, expected)
         shutil.rmtree(src_module_dir_core)
         shutil.rmtree(dest_module_dir_core)
@@ -696,25 +1469,104 @@ class LSRRole2Collection(unittest.TestCase):
             rb"(\bfrom) (ansible\.module_utils\.?)(\S+)? import (\(*(?:\n|\r\n)?)(.+)(\s+#.+|.*)$",
             flags=re.M,
         )
-        config["namespace"] = namespace
-        config["collection"] = collection_name
-        config["role"] = rolename
-        config["src_path"] = Path(src_path) / rolename
-        config["dest_path"] = dest_base_dir
-        config["module_utils_dir"] = dest_module_dir_core
-        config["module_utils"] = [
-            [b"util0"],
-            [b"util0", b"test3"],
-            [b"util0", b"test2"],
-            [b"util0", b"test1"],
-            [b"util0", b"test0"],
-        ]
-        config["additional_rewrites"] = []
-        output = FROM_RE.sub(from_replace, input)
+        rewriter = LSRImportRewriter(
+            namespace,
+            collection_name,
+            rolename,
+            Path(src_path) / rolename,
+            dest_base_dir,
+            dest_module_dir_core,
+            [
+                [b"util0"],
+                [b"util0", b"test3"],
+                [b"util0", b"test2"],
+                [b"util0", b"test1"],
+                [b"util0", b"test0"],
+            ],
+        )
+        output = FROM_RE.sub(rewriter.from_replace, input)
         self.assertEqual(output, expected)
         shutil.rmtree(src_module_dir)
         shutil.rmtree(dest_module_dir)
 
+    def test_module_utils_index(self):
+        """test LSRModuleUtilsIndex answers from the index of its trees"""
+
+        tmpdir = tempfile.TemporaryDirectory()
+        top = Path(tmpdir.name)
+        module_utils_dir = top / "plugins" / "module_utils"
+        (module_utils_dir / rolename / "sub").mkdir(parents=True)
+        (module_utils_dir / rolename / "__init__.py").touch()
+        (module_utils_dir / rolename / "sub" / "util0.py").touch()
+        (top / "other.py").touch()
+        index = LSRModuleUtilsIndex(
+            gather_module_utils_parts(module_utils_dir), [module_utils_dir]
+        )
+        self.assertIn([rolename.encode()], index)
+        self.assertIn([rolename.encode(), b"sub", b"util0"], index)
+        self.assertNotIn([b"sub"], index)
+        # the indexed tree is not looked at again
+        (module_utils_dir / rolename / "sub" / "util0.py").unlink()
+        self.assertTrue(index.is_dir(module_utils_dir / rolename / "sub"))
+        self.assertTrue(index.is_file(module_utils_dir / rolename / "sub" / "util0.py"))
+        self.assertFalse(index.is_dir(module_utils_dir / "sub"))
+        self.assertFalse(index.exists(module_utils_dir / rolename / "util0.py"))
+        self.assertTrue(
+            index.any_file(
+                module_utils_dir / "util0.py",
+                module_utils_dir / rolename / "__init__.py",
+            )
+        )
+        # other paths are checked in the filesystem
+        self.assertTrue(index.is_file(top / "other.py"))
+        self.assertFalse(index.is_dir(top / "other.py"))
+
+    def test_lsr_import_rewriter(self):
+        """test LSRImportRewriter rewrites the imports of a role"""
+
+        tmpdir = tempfile.TemporaryDirectory()
+        top = Path(tmpdir.name)
+        role_path = top / rolename
+        (role_path / "module_utils").mkdir(parents=True)
+        module_utils_dir = top / "coll" / "plugins" / "module_utils"
+        (module_utils_dir / rolename).mkdir(parents=True)
+        (module_utils_dir / rolename / "util0.py").touch()
+        rewriter = LSRImportRewriter(
+            namespace,
+            collection_name,
+            rolename,
+            role_path,
+            top / "coll",
+            module_utils_dir,
+            gather_module_utils_parts(module_utils_dir),
+        )
+        prefix = "ansible_collections.{0}.{1}.plugins.module_utils.{2}".format(
+            namespace, collection_name, rolename
+        )
+        input = bytes(
+            "import ansible.module_utils.{0}.util0\n"
+            "x = ansible.module_utils.{0}.util0.func()\n"
+            "from ansible.module_utils.{0}.util0 import func\n"
+            "from ansible.module_utils.basic import AnsibleModule\n".format(rolename),
+            "utf-8",
+        )
+        expected = bytes(
+            "import {0}.util0 as util0\n"
+            "x = util0.func()\n"
+            "from {0}.util0 import func\n"
+            "from ansible.module_utils.basic import AnsibleModule\n".format(prefix),
+            "utf-8",
+        )
+        self.assertEqual(rewriter.rewrite(input), expected)
+        self.assertEqual(
+            rewriter.rewrite_texts([input, expected]), [expected, expected]
+        )
+        # in a pool, with the rewriter sent once with each batch of texts
+        texts = [input, expected, input, input, expected]
+        with mock.patch.object(lsr_role2collection, "REWRITE_POOL_MIN_SIZE", 0):
+            self.assertEqual(rewriter.rewrite_texts(texts, jobs=2), [expected] * 5)
+            self.assertEqual(rewriter.rewrite_texts(texts[:1], jobs=2), [expected])
+
     def test_add_rolename(self):
         input = "README.md"
         expected = "README-" + rolename + ".md"
@@ -0,0 +1,724 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+"""unit tests for release_collection"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import release_collection
+
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "test",
+    "GIT_AUTHOR_EMAIL": "test@example.com",
+    "GIT_COMMITTER_NAME": "test",
+    "GIT_COMMITTER_EMAIL": "test@example.com",
+}
+
+
+def git(cwd, *args):
+    """Run git with args in cwd and return its stripped output"""
+    env = dict(os.environ)
+    env.update(GIT_ENV)
+    return subprocess.run(
+        ["git"] + list(args),
+        cwd=str(cwd),
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+    ).stdout.strip()
+
+
+class ReleaseCollection(unittest.TestCase):
+    """test release_collection"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.top = Path(self.tmpdir.name)
+        self.site = self.top / "site"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_upstream(self, repo, org="lsr"):
+        """Create the upstream repo org/repo of a role with tag 1.0.0 and
+        one commit after it"""
+        path = self.site / org / repo
+        (path / "tasks").mkdir(parents=True)
+        (path / "tasks" / "main.yml").write_text("---\n- name: Task\n  debug:\n")
+        git(path, "init", "-q", "-b", "main")
+        git(path, "add", "-A")
+        git(path, "commit", "-q", "-m", "initial")
+        git(path, "tag", "1.0.0")
+        self.add_commit(repo, "fix: something", org=org)
+        return path
+
+    def add_commit(self, repo, message, org="lsr"):
+        """Add a commit with message to the upstream repo org/repo"""
+        path = self.site / org / repo
+        with open(path / "README.md", "a") as readme:
+            readme.write(message + "\n")
+        git(path, "add", "-A")
+        git(path, "commit", "-q", "-m", message)
+
+    def refresh_args(self, **kwargs):
+        """Return the arguments used by refresh_role_repos"""
+        args = argparse.Namespace(
+            src_path=str(self.top / "src"),
+            src_owner="lsr",
+            no_update=False,
+            git_jobs=1,
+            mirror_path=None,
+        )
+        for key, value in kwargs.items():
+            setattr(args, key, value)
+        return args
+
+    def refresh(self, args, coll_rel):
+        """Run refresh_role_repos for the roles in coll_rel as a new run from
+        the upstream repos in self.site.  Return the (role, main branch)
+        yielded, and the commands run."""
+        with mock.patch.object(
+            release_collection, "DEFAULT_GIT_SITE", "file://" + str(self.site)
+        ), mock.patch.object(
+            release_collection, "mirrors_fetched", set()
+        ), mock.patch.object(
+            release_collection, "run_cmd", wraps=release_collection.run_cmd
+        ) as run_cmd:
+            refreshed = list(
+                release_collection.refresh_role_repos(args, coll_rel, list(coll_rel))
+            )
+        return refreshed, [call[0] for call in run_cmd.call_args_list]
+
+    def test_refresh_mirror(self):
+        """test refreshing the role repos from the mirrors in --mirror-path"""
+
+        self.make_upstream("role0")
+        self.make_upstream("role2")
+        mirror_path = self.top / "mirror"
+        args = self.refresh_args(git_jobs=4, mirror_path=str(mirror_path))
+        # role1 is another clone of the role0 repo
+        coll_rel = {
+            "role0": {"ref": "1.0.0"},
+            "role1": {"ref": "1.0.0", "repo": "role0"},
+            "role2": {"ref": "1.0.0"},
+        }
+        mirrors = [
+            str(mirror_path / "lsr" / repo) for repo in ("role0.git", "role2.git")
+        ]
+
+        def mirror_cmds(cmds, git_cmd):
+            """Return the mirror of each git_cmd run on a mirror"""
+            found = []
+            for cmd in cmds:
+                cmdlist, cwd = cmd[0], cmd[1] if len(cmd) > 1 else None
+                if cmdlist[1] == git_cmd:
+                    found += [mm for mm in mirrors if mm == cwd or mm in cmdlist]
+            return sorted(found)
+
+        refreshed, cmds = self.refresh(args, coll_rel)
+        self.assertEqual(refreshed, [(role, "main") for role in coll_rel])
+        # each mirror is created once, and not fetched
+        self.assertEqual(mirror_cmds(cmds, "clone"), mirrors)
+        self.assertEqual(mirror_cmds(cmds, "fetch"), [])
+        # the clones share the objects of the mirror, and fetch from it
+        for role, repo in (("role0", "role0"), ("role1", "role0"), ("role2", "role2")):
+            roledir = self.top / "src" / role
+            alternates = roledir / ".git" / "objects" / "info" / "alternates"
+            self.assertEqual(
+                alternates.read_text().strip(),
+                str(mirror_path / "lsr" / (repo + ".git") / "objects"),
+            )
+            self.assertEqual(
+                git(roledir, "remote", "get-url", "origin"),
+                str(mirror_path / "lsr" / (repo + ".git")),
+            )
+
+        # the next run fetches each mirror once
+        self.add_commit("role0", "feat: new feature")
+        git(self.site / "lsr" / "role0", "tag", "1.1.0")
+        refreshed, cmds = self.refresh(args, coll_rel)
+        self.assertEqual(refreshed, [(role, "main") for role in coll_rel])
+        self.assertEqual(mirror_cmds(cmds, "clone"), [])
+        self.assertEqual(mirror_cmds(cmds, "fetch"), mirrors)
+        # the new tag and commit reached the existing clones through the mirror
+        for role in ("role0", "role1"):
+            roledir = self.top / "src" / role
+            self.assertIn("1.1.0", git(roledir, "tag", "-l").split())
+            self.assertEqual(
+                git(roledir, "rev-parse", "HEAD"),
+                git(self.site / "lsr" / "role0", "rev-parse", "HEAD"),
+            )
+
+    def test_refresh_mirror_existing_clone(self):
+        """test that an existing clone of the upstream repo is switched to
+        fetch from the mirror"""
+
+        self.make_upstream("role0")
+        coll_rel = {"role0": {"ref": "1.0.0"}}
+        self.refresh(self.refresh_args(), coll_rel)
+        roledir = self.top / "src" / "role0"
+        self.assertEqual(
+            git(roledir, "remote", "get-url", "origin"),
+            "file://" + str(self.site / "lsr" / "role0"),
+        )
+        git(self.site / "lsr" / "role0", "tag", "1.1.0")
+        mirror_path = self.top / "mirror"
+        args = self.refresh_args(mirror_path=str(mirror_path))
+        refreshed, cmds = self.refresh(args, coll_rel)
+        self.assertEqual(refreshed, [("role0", "main")])
+        mirror = str(mirror_path / "lsr" / "role0.git")
+        self.assertEqual(git(roledir, "remote", "get-url", "origin"), mirror)
+        self.assertIn("1.1.0", git(roledir, "tag", "-l").split())
+        # only the mirror was fetched from the upstream repo
+        self.assertEqual(
+            [cmd[0][:2] for cmd in cmds if str(self.site) in " ".join(cmd[0])],
+            [["git", "clone"]],
+        )
+
+    def test_refresh_role_repos_order(self):
+        """test that the roles are yielded in order, whichever is done first"""
+
+        coll_rel = {}
+        for role in ("role0", "role1", "role2"):
+            self.make_upstream(role)
+            coll_rel[role] = {"ref": "1.0.0"}
+        refresh_role_repo = release_collection.refresh_role_repo
+
+        def slow_refresh_role_repo(args, rolename, *rest):
+            if rolename == "role0":
+                time.sleep(0.5)
+            return refresh_role_repo(args, rolename, *rest)
+
+        with mock.patch.object(
+            release_collection, "refresh_role_repo", side_effect=slow_refresh_role_repo
+        ):
+            refreshed, _ = self.refresh(self.refresh_args(git_jobs=3), coll_rel)
+        self.assertEqual(refreshed, [(role, "main") for role in coll_rel])
+
+    def test_refresh_role_repos_error(self):
+        """test that a role repo which cannot be refreshed stops the roles, but
+        only after all of the repos are done, and that all errors are logged"""
+
+        coll_rel = {}
+        for role in ("role0", "missing1", "role2", "missing3", "role4"):
+            if not role.startswith("missing"):
+                self.make_upstream(role)
+            coll_rel[role] = {"ref": "1.0.0"}
+        args = self.refresh_args(git_jobs=2)
+        refreshed = []
+        with mock.patch.object(
+            release_collection, "DEFAULT_GIT_SITE", "file://" + str(self.site)
+        ), self.assertLogs(level="ERROR") as logs:
+            with self.assertRaisesRegex(Exception, "roles missing1, missing3$"):
+                for item in release_collection.refresh_role_repos(
+                    args, coll_rel, list(coll_rel)
+                ):
+                    refreshed.append(item)
+        self.assertEqual(refreshed, [("role0", "main")])
+        # the other jobs were done before the error was raised
+        for role in ("role2", "role4"):
+            self.assertEqual(
+                git(self.top / "src" / role, "rev-parse", "--abbrev-ref", "HEAD"),
+                "main",
+            )
+        self.assertEqual(len(logs.records), 2)
+        for record, role in zip(logs.records, ("missing1", "missing3")):
+            message = record.getMessage()
+            self.assertIn("role " + role + ":", message)
+            # the git stderr
+            self.assertIn("fatal: ", message)
+            self.assertIn(str(self.site / "lsr" / role), message)
+
+    def make_role_checkout(self, role):
+        """Create the upstream repo of role with a README, defaults, tasks and
+        tests, and clone it in the src path"""
+        path = self.make_upstream(role)
+        (path / "defaults").mkdir()
+        (path / "defaults" / "main.yml").write_text(f"---\n{role}_var: 1\n")
+        (path / "tests").mkdir()
+        (path / "tests" / "tests_default.yml").write_text(
+            f"---\n- name: Test\n  hosts: all\n  roles:\n    - {role}\n"
+        )
+        (path / "README.md").write_text(f"# {role}\n")
+        git(path, "add", "-A")
+        git(path, "commit", "-q", "-m", "feat: add tests")
+        roledir = self.top / "src" / role
+        git(self.top, "clone", "-q", str(path), str(roledir))
+        return roledir
+
+    def cache_args(self, dest, **kwargs):
+        """Return the arguments used by roles_to_collection"""
+        args = argparse.Namespace(
+            src_path=str(self.top / "src"),
+            src_owner="lsr",
+            dest_path=str(dest),
+            role_jobs=1,
+            extra_mapping=None,
+            debug=False,
+            role_cache_dir=None,
+        )
+        for key, value in kwargs.items():
+            setattr(args, key, value)
+        return args
+
+    def tree(self, top):
+        """Return path: (mode, contents or symlink target) of the tree top"""
+        result = {}
+        for root, dirs, files in os.walk(top):
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                relpath = os.path.relpath(path, top)
+                st = os.lstat(path)
+                if os.path.islink(path):
+                    result[relpath] = (st.st_mode, os.readlink(path))
+                elif os.path.isfile(path):
+                    result[relpath] = (st.st_mode, Path(path).read_bytes())
+                else:
+                    result[relpath] = (st.st_mode, None)
+        return result
+
+    def test_role_tree_cache_key(self):
+        """test the changes of a role which invalidate its cache key"""
+
+        roledir = self.make_role_checkout("role0")
+        cache = release_collection.RoleTreeCache(str(self.top / "cache"))
+        args = self.cache_args(self.top / "dest")
+        role = {"role": "role0", "subrole_prefix": "p_", "extra_mapping": ""}
+
+        def make_key(role=role):
+            return cache.make_key(args, role, "ns", "coll")
+
+        key = make_key()
+        self.assertTrue(key.startswith("role0-"))
+        self.assertEqual(make_key(), key)
+        self.assertIsNone(cache.get(key))
+        # a dirty checkout is not cached
+        (roledir / "defaults" / "main.yml").write_text("---\nrole0_var: 2\n")
+        self.assertIsNone(make_key())
+        git(roledir, "checkout", "-q", "--", ".")
+        self.assertEqual(make_key(), key)
+        (roledir / "new.txt").write_text("new\n")
+        self.assertIsNone(make_key())
+        (roledir / "new.txt").unlink()
+        # another extra mapping
+        self.assertNotEqual(make_key(dict(role, extra_mapping="a:b")), key)
+        # another converter
+        with mock.patch.object(
+            release_collection.lsr_role2collection,
+            "get_converter_version",
+            return_value="another",
+        ):
+            self.assertNotEqual(make_key(), key)
+        self.assertEqual(make_key(), key)
+        # a new commit
+        (roledir / "new.txt").write_text("new\n")
+        git(roledir, "add", "-A")
+        git(roledir, "commit", "-q", "-m", "fix: new")
+        self.assertNotEqual(make_key(), key)
+
+    def test_role_tree_cache_materialize(self):
+        """test that the absolute paths to the cached collection are rewritten
+        to the collection the entry is copied into"""
+
+        entry = self.top / "cache" / "role0-key"
+        old_dest = str(self.top / "staging" / "ansible_collections" / "ns" / "coll")
+        cached = entry / "ansible_collections" / "ns" / "coll"
+        (cached / "roles" / "role0" / "tasks").mkdir(parents=True)
+        (cached / "roles" / "role0" / "tasks" / "main.yml").write_text(
+            f"---\n- include_vars: {old_dest}/roles/role0/vars/main.yml\n"
+        )
+        (cached / "roles" / "role0" / "README.md").write_text("# role0\n")
+        (cached / "roles" / "role0" / "link").symlink_to("README.md")
+        readme_hash = hashlib.sha256(b"# role0\n").hexdigest()
+        role_json = {
+            "dest": old_dest,
+            "coll_path": "ansible_collections/ns/coll",
+            "rewrite": ["roles/role0/tasks/main.yml"],
+            "hashes": {"roles/role0/README.md": readme_hash},
+            "readme_entries": [["README.md", "role0", "comment"]],
+            "meta_mappings": [["a", "b"]],
+        }
+        (entry / "role.json").write_text(json.dumps(role_json))
+        coll_dest = self.top / "dest" / "ansible_collections" / "ns" / "coll"
+        converter = mock.Mock(dest_path=coll_dest)
+        cache = release_collection.RoleTreeCache(str(self.top / "cache"))
+        self.assertEqual(cache.get("role0-key"), str(entry))
+        cache.materialize(cache.get("role0-key"), converter)
+
+        tasks = coll_dest / "roles" / "role0" / "tasks" / "main.yml"
+        data = f"---\n- include_vars: {coll_dest}/roles/role0/vars/main.yml\n"
+        self.assertEqual(tasks.read_text(), data)
+        self.assertEqual(
+            release_collection.get_known_file_hash(str(tasks)),
+            hashlib.sha256(data.encode("utf-8")).hexdigest(),
+        )
+        readme = coll_dest / "roles" / "role0" / "README.md"
+        self.assertEqual(readme.read_text(), "# role0\n")
+        self.assertEqual(
+            release_collection.get_known_file_hash(str(readme)), readme_hash
+        )
+        self.assertEqual(
+            os.readlink(coll_dest / "roles" / "role0" / "link"), "README.md"
+        )
+        converter.add_entries.assert_called_once_with(
+            [("README.md", "role0", "comment")], [("a", "b")]
+        )
+
+    def test_role_tree_cache_convert(self):
+        """test that the collection converted through a cold and a warm cache
+        is the one converted without the cache"""
+
+        for role in ("role0", "role1"):
+            self.make_role_checkout(role)
+        readme = os.path.join(
+            os.path.dirname(release_collection.__file__),
+            "lsr_role2collection",
+            "collection_readme.md",
+        )
+        trees = []
+        for name, cache_dir in (
+            ("uncached", None),
+            ("cold", self.top / "cache"),
+            ("warm", self.top / "cache"),
+        ):
+            dest = self.top / name
+            args = self.cache_args(dest, role_cache_dir=cache_dir and str(cache_dir))
+            with mock.patch.object(
+                release_collection.RoleTreeCache,
+                "convert",
+                autospec=True,
+                side_effect=release_collection.RoleTreeCache.convert,
+            ) as convert:
+                release_collection.roles_to_collection(
+                    args, iter(["role0", "role1"]), "ns", "coll", readme
+                )
+            self.assertEqual(convert.call_count, 2 if name == "cold" else 0)
+            trees.append(self.tree(dest))
+            if name == "cold":
+                self.assertEqual(len(os.listdir(cache_dir)), 2)
+        self.assertIn(
+            os.path.join("ansible_collections", "ns", "coll", "roles", "role1"),
+            trees[0],
+        )
+        self.assertEqual(trees[1], trees[0])
+        self.assertEqual(trees[2], trees[0])
+
+    def make_collection(self):
+        """Create a small collection tree with an ignored file, an executable
+        file and a symlink, and return its path"""
+        coll_dir = self.top / "coll"
+        (coll_dir / "roles" / "role0" / "tasks").mkdir(parents=True)
+        (coll_dir / "plugins" / "modules").mkdir(parents=True)
+        (coll_dir / "docs").mkdir()
+        (coll_dir / ".git").mkdir()
+        (coll_dir / ".git" / "HEAD").write_text("ref: refs/heads/main\n")
+        (coll_dir / "galaxy.yml").write_text(
+            "---\n"
+            "namespace: ns\n"
+            "name: coll\n"
+            "version: 1.2.3\n"
+            "readme: README.md\n"
+            "authors:\n  - Someone\n"
+            "description: test collection\n"
+            "license: GPL-3.0-or-later\n"
+            "tags: [test]\n"
+            "repository: https://example.com/coll\n"
+            "build_ignore:\n  - '*.bak'\n"
+        )
+        (coll_dir / "README.md").write_text("# coll\n")
+        (coll_dir / "docs" / "old.bak").write_text("old\n")
+        (coll_dir / "roles" / "role0" / "tasks" / "main.yml").write_text("---\n")
+        (coll_dir / "roles" / "role0" / "main.yml").symlink_to("tasks/main.yml")
+        module = coll_dir / "plugins" / "modules" / "mod.py"
+        module.write_text("#!/usr/bin/python\n")
+        module.chmod(0o755)
+        return coll_dir
+
+    def build_args(self, **kwargs):
+        """Return the arguments used by build_collection_tarball"""
+        args = argparse.Namespace(
+            dest_path=str(self.top / "dest"), force=False, build_jobs=2
+        )
+        for key, value in kwargs.items():
+            setattr(args, key, value)
+        os.makedirs(args.dest_path, exist_ok=True)
+        return args
+
+    def read_artifact(self, artifact):
+        """Return name: (type, mode, linkname) of the members of artifact,
+        and its MANIFEST.json and FILES.json"""
+        with tarfile.open(artifact) as tar_file:
+            members = {
+                info.name: (info.type, info.mode, info.linkname)
+                for info in tar_file.getmembers()
+            }
+            manifest = json.load(tar_file.extractfile("MANIFEST.json"))
+            files = json.load(tar_file.extractfile("FILES.json"))
+        return members, manifest, files
+
+    def test_build_collection_tarball(self):
+        """test the collection artifact built without ansible-galaxy"""
+
+        coll_dir = self.make_collection()
+        args = self.build_args()
+        with mock.patch.object(release_collection, "known_file_hashes", {}):
+            artifact = release_collection.build_collection_tarball(args, str(coll_dir))
+        self.assertEqual(artifact, os.path.join(args.dest_path, "ns-coll-1.2.3.tar.gz"))
+        members, manifest, files = self.read_artifact(artifact)
+        dirtype, regtype = tarfile.DIRTYPE, tarfile.REGTYPE
+        self.assertEqual(
+            members,
+            {
+                "MANIFEST.json": (regtype, 0o644, ""),
+                "FILES.json": (regtype, 0o644, ""),
+                "README.md": (regtype, 0o644, ""),
+                "docs": (dirtype, 0o755, ""),
+                "plugins": (dirtype, 0o755, ""),
+                "plugins/modules": (dirtype, 0o755, ""),
+                "plugins/modules/mod.py": (regtype, 0o755, ""),
+                "roles": (dirtype, 0o755, ""),
+                "roles/role0": (dirtype, 0o755, ""),
+                "roles/role0/main.yml": (tarfile.SYMTYPE, 0o644, "tasks/main.yml"),
+                "roles/role0/tasks": (dirtype, 0o755, ""),
+                "roles/role0/tasks/main.yml": (regtype, 0o644, ""),
+            },
+        )
+        self.assertEqual(
+            manifest["collection_info"],
+            {
+                "namespace": "ns",
+                "name": "coll",
+                "version": "1.2.3",
+                "authors": ["Someone"],
+                "readme": "README.md",
+                "tags": ["test"],
+                "description": "test collection",
+                "license": ["GPL-3.0-or-later"],
+                "license_file": None,
+                "dependencies": {},
+                "repository": "https://example.com/coll",
+                "documentation": None,
+                "homepage": None,
+                "issues": None,
+            },
+        )
+        with tarfile.open(artifact) as tar_file:
+            files_json = tar_file.extractfile("FILES.json").read()
+        self.assertEqual(
+            manifest["file_manifest_file"]["chksum_sha256"],
+            hashlib.sha256(files_json).hexdigest(),
+        )
+        self.assertEqual(files["files"][0]["name"], ".")
+        checksums = {
+            item["name"]: item["chksum_sha256"]
+            for item in files["files"]
+            if item["ftype"] == "file"
+        }
+        self.assertEqual(
+            checksums,
+            {
+                name: hashlib.sha256((coll_dir / name).read_bytes()).hexdigest()
+                for name in (
+                    "README.md",
+                    "plugins/modules/mod.py",
+                    "roles/role0/main.yml",
+                    "roles/role0/tasks/main.yml",
+                )
+            },
+        )
+
+        # the known hashes are used instead of reading the files
+        readme = str(coll_dir / "README.md")
+        with mock.patch.object(release_collection, "known_file_hashes", {}):
+            release_collection.remember_file_hash(readme, "0" * 64)
+            with self.assertRaisesRegex(Exception, "already exists"):
+                release_collection.build_collection_tarball(args, str(coll_dir))
+            args.force = True
+            release_collection.build_collection_tarball(args, str(coll_dir))
+            _, _, files = self.read_artifact(artifact)
+            checksums = {item["name"]: item["chksum_sha256"] for item in files["files"]}
+            self.assertEqual(checksums["README.md"], "0" * 64)
+            # but not once the file is changed
+            (coll_dir / "README.md").write_text("# new coll\n")
+            release_collection.build_collection_tarball(args, str(coll_dir))
+            _, _, files = self.read_artifact(artifact)
+            checksums = {item["name"]: item["chksum_sha256"] for item in files["files"]}
+            self.assertEqual(
+                checksums["README.md"], hashlib.sha256(b"# new coll\n").hexdigest()
+            )
+
+    @unittest.skipUnless(shutil.which("ansible-galaxy"), "needs ansible-galaxy")
+    def test_build_collection_tarball_galaxy(self):
+        """test that the artifact is the one ansible-galaxy builds"""
+
+        coll_dir = self.make_collection()
+        galaxy_dest = self.top / "galaxy"
+        galaxy_dest.mkdir()
+        subprocess.run(
+            [
+                "ansible-galaxy",
+                "collection",
+                "build",
+                "--output-path",
+                str(galaxy_dest),
+                str(coll_dir),
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        with mock.patch.object(release_collection, "known_file_hashes", {}):
+            artifact = release_collection.build_collection_tarball(
+                self.build_args(), str(coll_dir)
+            )
+        members, manifest, files = self.read_artifact(artifact)
+        galaxy_members, galaxy_manifest, galaxy_files = self.read_artifact(
+            str(galaxy_dest / "ns-coll-1.2.3.tar.gz")
+        )
+        self.assertEqual(members, galaxy_members)
+        self.assertEqual(
+            manifest["collection_info"], galaxy_manifest["collection_info"]
+        )
+        # ansible-galaxy does not sort the files
+        self.assertEqual(
+            files["files"], sorted(galaxy_files["files"], key=lambda x: x["name"])
+        )
+
+    def update_args(self, rolenames):
+        """Return the arguments used by update_collection with --skip-git"""
+        args = argparse.Namespace(
+            src_path=str(self.top / "src"),
+            src_owner="lsr",
+            dest_path=str(self.top / "dest"),
+            role_jobs=1,
+            keep=False,
+            force=False,
+            skip_changelog=True,
+            skip_git=True,
+            no_update=True,
+            include=["mainid"] + rolenames,
+        )
+        return args
+
+    def test_update_collection_pipeline(self):
+        """test that the roles are converted in order as they are updated"""
+
+        rolenames = ["role0", "role1", "role2"]
+        coll_rel = {rolename: {"ref": "1.0.0"} for rolename in rolenames}
+        updated = []
+        converted = []
+
+        def update_role(args, galaxy, coll_rel, rolename, *rest):
+            updated.append(rolename)
+
+        def roles_to_collection(args, rolenames, *rest):
+            for rolename in rolenames:
+                # each role is updated before it is converted
+                self.assertIn(rolename, updated)
+                converted.append(rolename)
+
+        with mock.patch.object(
+            release_collection, "update_role", side_effect=update_role
+        ), mock.patch.object(
+            release_collection, "roles_to_collection", side_effect=roles_to_collection
+        ), mock.patch.object(
+            release_collection, "build_collection"
+        ) as build_collection:
+            release_collection.update_collection(
+                self.update_args(rolenames),
+                {"namespace": "ns", "name": "coll"},
+                coll_rel,
+            )
+        self.assertEqual(updated, rolenames)
+        self.assertEqual(converted, rolenames)
+        build_collection.assert_called_once()
+
+    def test_update_collection_conversion_error(self):
+        """test that a failed conversion stops the update of the roles"""
+
+        rolenames = ["role0", "role1", "role2", "role3", "role4"]
+        coll_rel = {rolename: {"ref": "1.0.0"} for rolename in rolenames}
+        updated = []
+        failed = threading.Event()
+
+        def update_role(args, galaxy, coll_rel, rolename, *rest):
+            if rolename == "role2":
+                # let the conversion of role1 fail first
+                self.assertTrue(failed.wait(10))
+                time.sleep(0.2)
+            updated.append(rolename)
+
+        def roles_to_collection(args, rolenames, *rest):
+            for rolename in rolenames:
+                if rolename == "role1":
+                    failed.set()
+                    raise Exception("conversion of role1 failed")
+
+        with mock.patch.object(
+            release_collection, "update_role", side_effect=update_role
+        ), mock.patch.object(
+            release_collection, "roles_to_collection", side_effect=roles_to_collection
+        ), mock.patch.object(
+            release_collection, "build_collection"
+        ) as build_collection:
+            with self.assertRaisesRegex(Exception, "conversion of role1 failed"):
+                release_collection.update_collection(
+                    self.update_args(rolenames),
+                    {"namespace": "ns", "name": "coll"},
+                    coll_rel,
+                )
+        self.assertEqual(updated, ["role0", "role1", "role2"])
+        build_collection.assert_not_called()
+
+    def test_git_query_role_new_tag(self):
+        """test that a new tag on an unchanged HEAD is not hidden by the cache"""
+
+        upstream = self.make_upstream("role0")
+        roledir = self.top / "src" / "role0"
+        git(self.top, "clone", "-q", str(upstream), str(roledir))
+        query = release_collection.git_query_role(str(roledir), "1.0.0", False)
+        self.assertEqual(query["count"], "1")
+        self.assertEqual((query["tag"], query["n_commits"]), ("1.0.0", "1"))
+        # cached
+        self.assertTrue((roledir / ".git" / "lsr_release_query.json").is_file())
+        self.assertEqual(
+            release_collection.git_query_role(str(roledir), "1.0.0", False), query
+        )
+        git(upstream, "tag", "1.1.0")
+        git(roledir, "fetch", "-q", "--tags")
+        query = release_collection.git_query_role(str(roledir), "1.0.0", False)
+        self.assertEqual((query["tag"], query["n_commits"]), ("1.1.0", "0"))
+        self.assertEqual(query["count"], "1")
+        # only the latest query is kept
+        with open(roledir / ".git" / "lsr_release_query.json") as cf:
+            self.assertEqual(json.load(cf)["query"], query)
+
+    def test_git_query_role_missing_ref(self):
+        """test that a cur_ref which is not in the repo, e.g. a tag deleted
+        upstream, gives the latest tag of HEAD"""
+
+        upstream = self.make_upstream("role0")
+        roledir = self.top / "src" / "role0"
+        git(self.top, "clone", "-q", str(upstream), str(roledir))
+        for cur_ref in ("0.9.0", "0" * 40):
+            query = release_collection.git_query_role(str(roledir), cur_ref, False)
+            self.assertEqual(query["count"], "2")
+            self.assertEqual((query["tag"], query["n_commits"]), ("1.0.0", "1"))
+            self.assertIsNone(query["prev_tag"])
+            self.assertEqual(query["commit_hash"], git(roledir, "rev-parse", "HEAD"))
+
+
+if __name__ == "__main__":
+    unittest.main()